@@ -1,7 +1,120 @@
+import json
+
+from django import forms
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.views.main import ORDER_VAR
+from django.contrib.admin.widgets import AutocompleteSelect
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+
+from .filters import match_equipment, search_equipment
+from .history import capture_history
 from .models import (
-    Site, Workshop, EquipmentType, Characteristic, Equipment, EquipmentCharacteristicValue
+    Site, Workshop, EquipmentType, Characteristic, Equipment, EquipmentCharacteristicValue, Job
 )
+from .roles import ROLE_ADMIN, get_user_roles
+
+
+def estimated_count(queryset):
+    """
+    Row count of ``queryset`` from the PostgreSQL planner: table statistics when
+    unfiltered, the plan's row estimate otherwise. Estimates below
+    ``CATALOG_ADMIN_EXACT_COUNT_LIMIT`` and other backends count exactly.
+    """
+    queryset = queryset.order_by()
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return queryset.count()
+    with connection.cursor() as cursor:
+        if not queryset.query.where:
+            cursor.execute("SELECT reltuples FROM pg_class WHERE oid = %s::regclass", [queryset.model._meta.db_table])
+            estimate = cursor.fetchone()[0]
+        else:
+            sql, params = queryset.query.sql_with_params()
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+            plan = cursor.fetchone()[0]
+            estimate = (json.loads(plan) if isinstance(plan, str) else plan)[0]["Plan"]["Plan Rows"]
+    if estimate < settings.CATALOG_ADMIN_EXACT_COUNT_LIMIT:
+        return queryset.count()
+    return int(estimate)
+
+
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        return estimated_count(self.object_list)
+
+
+class AutocompleteFilter(admin.FieldListFilter):
+    """
+    Foreign key filter with a select2 box fed by the admin autocomplete view
+    instead of a list of every related row. Only the selected object is loaded.
+    """
+    template = "admin/catalog/autocomplete_filter.html"
+
+    def __init__(self, field, request, params, model, model_admin, field_path):
+        self.lookup_kwarg = f"{field_path}__{field.target_field.name}__exact"
+        value = params.get(self.lookup_kwarg)
+        self.lookup_val = value[-1] if isinstance(value, list) else value
+        super().__init__(field, request, params, model, model_admin, field_path)
+        self.request = request
+        self.admin_site = model_admin.admin_site
+        self.query_string = ""
+
+    def expected_parameters(self):
+        return [self.lookup_kwarg]
+
+    def choices(self, changelist):
+        self.query_string = changelist.get_query_string(remove=[self.lookup_kwarg])
+        yield {"selected": self.lookup_val is None, "query_string": self.query_string, "display": _("All")}
+
+    def rendered_widget(self):
+        remote_admin = self.admin_site.get_model_admin(self.field.remote_field.model)
+        choice_field = forms.ModelChoiceField(
+            queryset=remote_admin.get_queryset(self.request),
+            widget=AutocompleteSelect(self.field, self.admin_site, attrs={"style": "width: 100%"}),
+            required=False,
+        )
+        return choice_field.widget.render(self.lookup_kwarg, self.lookup_val)
+
+
+class FastChangeListMixin:
+    """
+    Changelist for tables too big to count or list in full: planner estimates
+    instead of ``COUNT(*)``, no unfiltered total or facets, and the media of
+    ``AutocompleteFilter``.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    show_facets = admin.ShowFacets.NEVER
+
+    @property
+    def media(self):
+        return super().media + AutocompleteSelect(None, self.admin_site).media + forms.Media(
+            js=["admin/js/jquery.init.js", "catalog/admin/autocomplete_filter.js"],
+        )
+
+
+class ChangeHistoryAdminMixin:
+    """Writes the equipment changes of a POST to the change, delete or changelist view as one batch."""
+
+    def _with_history(self, view, request, *args, **kwargs):
+        if request.method != "POST":
+            return view(request, *args, **kwargs)
+        with capture_history("admin", request.user):
+            return view(request, *args, **kwargs)
+
+    def changeform_view(self, request, *args, **kwargs):
+        return self._with_history(super().changeform_view, request, *args, **kwargs)
+
+    def delete_view(self, request, *args, **kwargs):
+        return self._with_history(super().delete_view, request, *args, **kwargs)
+
+    def changelist_view(self, request, *args, **kwargs):
+        return self._with_history(super().changelist_view, request, *args, **kwargs)
 
 
 @admin.register(Site)
@@ -17,6 +130,11 @@ class WorkshopAdmin(admin.ModelAdmin):
     list_filter = ("site",)
     search_fields = ("name", "site__name")
     ordering = ("name",)
+    list_select_related = ("site",)
+
+    def get_queryset(self, request):
+        # __str__ shows the site, also in autocomplete results.
+        return super().get_queryset(request).select_related("site")
 
 
 class CharacteristicInline(admin.TabularInline):
@@ -34,20 +152,38 @@ class EquipmentTypeAdmin(admin.ModelAdmin):
 class EquipmentCharacteristicValueInline(admin.TabularInline):
     model = EquipmentCharacteristicValue
     extra = 1
+    autocomplete_fields = ("characteristic",)
 
 
 @admin.register(Equipment)
-class EquipmentAdmin(admin.ModelAdmin):
+class EquipmentAdmin(ChangeHistoryAdminMixin, FastChangeListMixin, admin.ModelAdmin):
     list_display = ("id", "name", "inventory_number", "equipment_type", "workshop", "parent", "created_at")
-    list_filter = ("equipment_type", "workshop", "workshop__site", "created_at")
-    search_fields = ("name", "inventory_number", "equipment_type__name", "workshop__name")
+    list_filter = (
+        ("equipment_type", AutocompleteFilter),
+        ("workshop", AutocompleteFilter),
+        ("workshop__site", AutocompleteFilter),
+        "created_at",
+    )
+    # Searched through search_equipment(), like ?search= of the API.
+    search_fields = ("name", "inventory_number")
+    search_help_text = "Name or inventory number"
     autocomplete_fields = ("equipment_type", "workshop", "parent")
     inlines = [EquipmentCharacteristicValueInline]
     ordering = ("name",)
-    list_select_related = ("equipment_type", "workshop", "parent")
+    list_select_related = ("equipment_type", "workshop__site", "parent")
 
     def has_delete_permission(self, request, obj=None):
-        return request.user.groups.filter(name="Admin").exists()
+        return ROLE_ADMIN in get_user_roles(request.user)
+
+    def get_search_results(self, request, queryset, search_term):
+        terms = search_term.split()
+        if not terms:
+            return queryset, False
+        results = search_equipment(queryset, terms)
+        if ORDER_VAR in request.GET:
+            # A sorted column wins over relevance.
+            results = results.order_by(*queryset.query.order_by)
+        return results, False
 
 
 @admin.register(Characteristic)
@@ -55,10 +191,34 @@ class CharacteristicAdmin(admin.ModelAdmin):
     list_display = ("id", "name", "equipment_type", "value_type")
     list_filter = ("equipment_type", "value_type")
     search_fields = ("name", "equipment_type__name")
+    list_select_related = ("equipment_type",)
+
+    def get_queryset(self, request):
+        # __str__ shows the equipment type, also in autocomplete results.
+        return super().get_queryset(request).select_related("equipment_type")
 
 
 @admin.register(EquipmentCharacteristicValue)
-class EquipmentCharacteristicValueAdmin(admin.ModelAdmin):
+class EquipmentCharacteristicValueAdmin(ChangeHistoryAdminMixin, FastChangeListMixin, admin.ModelAdmin):
     list_display = ("id", "equipment", "characteristic", "value")
-    list_filter = ("characteristic",)
-    search_fields = ("equipment__name", "characteristic__name", "value")
+    list_filter = (("characteristic", AutocompleteFilter), ("equipment", AutocompleteFilter))
+    # Matches the equipment's name or inventory number through the trigram indexes.
+    search_fields = ("equipment__name", "equipment__inventory_number")
+    search_help_text = "Equipment name or inventory number"
+    autocomplete_fields = ("equipment", "characteristic")
+    list_select_related = ("equipment", "characteristic__equipment_type")
+
+    def get_search_results(self, request, queryset, search_term):
+        terms = search_term.split()
+        if not terms:
+            return queryset, False
+        return queryset.filter(equipment__in=match_equipment(Equipment.objects.all(), terms)), False
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ("id", "kind", "status", "attempts", "progress_done", "progress_total", "created_by", "created_at",
+                    "finished_at")
+    list_filter = ("status", "kind")
+    list_select_related = ("created_by",)
+    readonly_fields = ("attempts", "worker", "heartbeat_at", "started_at", "finished_at", "result", "error")
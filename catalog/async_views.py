@@ -0,0 +1,146 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.http import Http404
+from django.views import View
+from rest_framework.response import Response
+from rest_framework.routers import DefaultRouter
+
+ASYNC_ACTIONS = ("list", "retrieve")
+
+
+class AsyncReadMixin:
+    """
+    Async ``list``/``retrieve`` for a ``GenericViewSet``.
+
+    Filters run in a worker thread because filterset validation may query
+    the database. Counting, fetching and prefetching rows use the async ORM.
+    Serializers must only touch data that ``get_queryset()`` already loads.
+
+    Both list paths render rows through ``get_list_reader()`` when
+    ``list_reader_class`` is set (see ``EquipmentListReader``) and through the
+    serializer otherwise.
+    """
+    list_reader_class = None
+
+    def get_list_reader(self):
+        if self.list_reader_class is None:
+            return None
+        return self.list_reader_class(**self.get_list_reader_kwargs())
+
+    def get_list_reader_kwargs(self):
+        return {}
+
+    def get_list_queryset(self, queryset):
+        reader = self.get_list_reader()
+        return queryset if reader is None else reader.get_queryset(queryset)
+
+    def serialize_list(self, rows):
+        reader = self.get_list_reader()
+        if reader is None:
+            return self.get_serializer(rows, many=True).data
+        return reader.to_representation(rows)
+
+    async def aserialize_list(self, rows):
+        reader = self.get_list_reader()
+        if reader is None:
+            return self.get_serializer(rows, many=True).data
+        return await reader.ato_representation(rows)
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.get_list_queryset(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.serialize_list(page))
+        return Response(self.serialize_list(queryset))
+
+    async def apaginate_queryset(self, queryset):
+        paginator = self.paginator
+        if paginator is None:
+            return None
+        if hasattr(paginator, "apaginate_queryset"):
+            return await paginator.apaginate_queryset(queryset, self.request, view=self)
+        return await sync_to_async(paginator.paginate_queryset)(queryset, self.request, view=self)
+
+    async def aget_object(self):
+        queryset = await sync_to_async(self.filter_queryset)(self.get_queryset())
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            obj = await queryset.aget(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        except (queryset.model.DoesNotExist, TypeError, ValueError, ValidationError):
+            raise Http404
+        self.check_object_permissions(self.request, obj)
+        return obj
+
+    async def alist(self, request, *args, **kwargs):
+        queryset = await sync_to_async(self.filter_queryset)(self.get_queryset())
+        queryset = self.get_list_queryset(queryset)
+        page = await self.apaginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(await self.aserialize_list(page))
+        rows = [row async for row in queryset]
+        return Response(await self.aserialize_list(rows))
+
+    async def aretrieve(self, request, *args, **kwargs):
+        instance = await self.aget_object()
+        return Response(self.get_serializer(instance).data)
+
+
+class AsyncReadView(View):
+    """
+    Serves GET through the viewset's ``alist``/``aretrieve`` on the event loop
+    and hands every other method to the synchronous DRF view of the same route.
+
+    Authentication, permissions and throttles are the viewset's own and run
+    through ``initial()`` exactly as in ``APIView.dispatch``.
+    """
+    viewset_view = None
+
+    async def get(self, request, *args, **kwargs):
+        action = self.viewset_view.actions["get"]
+        viewset = self.viewset_view.cls(**self.viewset_view.initkwargs)
+        viewset.action_map = {"get": action, "head": action}
+        viewset.args = args
+        viewset.kwargs = kwargs
+        drf_request = viewset.initialize_request(request, *args, **kwargs)
+        viewset.request = drf_request
+        viewset.headers = viewset.default_response_headers
+        try:
+            await sync_to_async(viewset.initial)(drf_request, *args, **kwargs)
+            response = await getattr(viewset, f"a{action}")(drf_request, *args, **kwargs)
+        except Exception as exc:
+            response = viewset.handle_exception(exc)
+        viewset.response = viewset.finalize_response(drf_request, response, *args, **kwargs)
+        return viewset.response
+
+    async def delegate(self, request, *args, **kwargs):
+        return await sync_to_async(self.viewset_view)(request, *args, **kwargs)
+
+    post = put = patch = delete = options = delegate
+
+
+def async_read_view(viewset_view):
+    view = AsyncReadView.as_view(viewset_view=viewset_view)
+    view.cls = viewset_view.cls
+    view.initkwargs = viewset_view.initkwargs
+    view.actions = viewset_view.actions
+    view.csrf_exempt = True
+    return view
+
+
+class AsyncReadRouter(DefaultRouter):
+    """
+    ``DefaultRouter`` that, with ``CATALOG_ASYNC_READS`` on, routes the list and
+    detail URLs of ``AsyncReadMixin`` viewsets through ``AsyncReadView``.
+    """
+
+    def get_urls(self):
+        urls = super().get_urls()
+        if not settings.CATALOG_ASYNC_READS:
+            return urls
+        for url in urls:
+            viewset = getattr(url.callback, "cls", None)
+            actions = getattr(url.callback, "actions", {})
+            if viewset and issubclass(viewset, AsyncReadMixin) and actions.get("get") in ASYNC_ACTIONS:
+                url.callback = async_read_view(url.callback)
+        return urls
@@ -0,0 +1,92 @@
+import statistics
+import time
+from contextlib import ExitStack
+
+from django.db import connections
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory
+
+from .models import Equipment, EquipmentCharacteristicValue
+from .views import EquipmentViewSet
+
+
+def scenarios():
+    """Requests to benchmark, built from data that exists in the current database."""
+    sample = Equipment.objects.order_by("id").first()
+    if sample is None:
+        return {}
+    term = sample.name.split()[0]
+    return {
+        "list": ("list", {}, None),
+        "list_cursor": ("list", {"pagination": "cursor", "page_size": 50}, None),
+        "list_page_100": ("list", {"page": 100}, None),
+        "detail": ("retrieve", {}, sample.pk),
+        "filter_workshop": ("list", {"workshop": sample.workshop_id}, None),
+        "filter_type": ("list", {"equipment_type": sample.equipment_type_id}, None),
+        "search": ("list", {"search": term}, None),
+        "descendants": ("descendants", {}, sample.pk),
+    }
+
+
+def measure(action, params, pk, iterations):
+    """
+    Median/p95 latency and query count of one EquipmentViewSet action.
+
+    Authentication, permissions and throttling are disabled so that only the
+    view itself (filtering, queries, serialization and rendering) is timed.
+    """
+    view = EquipmentViewSet.as_view(
+        {"get": action}, authentication_classes=[], permission_classes=[], throttle_classes=[]
+    )
+    factory = APIRequestFactory()
+    kwargs = {"pk": pk} if pk is not None else {}
+    timings = []
+    queries = 0
+    for iteration in range(iterations + 1):
+        request = factory.get("/api/equipment/", params, HTTP_ACCEPT="application/json")
+        with ExitStack() as stack:
+            # Reads may be routed to a replica, so every alias is counted.
+            captured = [stack.enter_context(CaptureQueriesContext(db)) for db in connections.all()]
+            started = time.perf_counter()
+            response = view(request, **kwargs)
+            response.render()
+            elapsed = (time.perf_counter() - started) * 1000
+        if iteration:
+            timings.append(elapsed)
+            queries = sum(len(context) for context in captured)
+    timings.sort()
+    return {
+        "status": response.status_code,
+        "median_ms": round(statistics.median(timings), 3),
+        "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+        "queries": queries,
+    }
+
+
+def run(iterations=20, only=None):
+    results = {}
+    for name, (action, params, pk) in scenarios().items():
+        if only and name not in only:
+            continue
+        results[name] = measure(action, params, pk, iterations)
+    return {
+        "catalog": {
+            "equipment": Equipment.objects.count(),
+            "characteristic_values": EquipmentCharacteristicValue.objects.count(),
+        },
+        "scenarios": results,
+    }
+
+
+def compare(results, baseline, threshold=0.2):
+    """Scenarios that got slower than ``threshold`` or issue more queries than in ``baseline``."""
+    regressions = []
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous is None:
+            continue
+        if current["queries"] > previous["queries"]:
+            regressions.append(f"{name}: queries {previous['queries']} -> {current['queries']}")
+        if current["median_ms"] > previous["median_ms"] * (1 + threshold):
+            regressions.append(f"{name}: median {previous['median_ms']}ms -> {current['median_ms']}ms")
+    return regressions
@@ -0,0 +1,444 @@
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .history import capture_history, characteristic_key, record_change
+from .models import (
+    Characteristic, Equipment, EquipmentCharacteristicValue, EquipmentHistory, EquipmentType, Workshop,
+    parse_characteristic_value,
+)
+from .serializers import EquipmentBulkItemSerializer
+from .stats import adjust_counters
+from .sync import record_changes
+from .tree import descendants, exceeds_max_depth, path_to, paths_to
+
+
+def in_chunks(values, using="default", params_per_value=1):
+    """Split a collection of lookup values so every ``IN`` fits the backend's parameter limit."""
+    values = list(values)
+    limit = connections[using].features.max_query_params
+    size = (limit and limit // params_per_value) or len(values) or 1
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def existing_ids(model, ids):
+    found = set()
+    for chunk in in_chunks(ids):
+        found.update(model.objects.filter(id__in=chunk).values_list("id", flat=True))
+    return found
+
+
+def existing_equipment(inventory_numbers):
+    rows = {}
+    for chunk in in_chunks(inventory_numbers):
+        for row in Equipment.objects.filter(inventory_number__in=chunk).values(
+            "id", "inventory_number", "name", "workshop_id", "equipment_type_id", "parent_id"
+        ):
+            rows[row["inventory_number"]] = row
+    return rows
+
+
+def existing_values(equipment_ids):
+    values = {}
+    for chunk in in_chunks(equipment_ids):
+        for equipment_id, characteristic_id, value in EquipmentCharacteristicValue.objects.filter(
+            equipment_id__in=chunk
+        ).values_list("equipment_id", "characteristic_id", "value"):
+            values[(equipment_id, characteristic_id)] = value
+    return values
+
+
+def _record_history(objects, rows, existing, previous_values):
+    for obj, (_, data) in zip(objects, rows):
+        previous = existing.get(obj.inventory_number) or {}
+        changes = {
+            field: [previous.get(column), getattr(obj, column)]
+            for field, column in (
+                ("name", "name"),
+                ("inventory_number", "inventory_number"),
+                ("equipment_type", "equipment_type_id"),
+                ("workshop", "workshop_id"),
+                ("parent", "parent_id"),
+            )
+        }
+        for value in data["characteristic_values"]:
+            key = (obj.pk, value["characteristic"])
+            changes[characteristic_key(value["characteristic"])] = [previous_values.get(key), value["value"]]
+        action = EquipmentHistory.ACTION_UPDATE if previous else EquipmentHistory.ACTION_CREATE
+        record_change(obj.pk, action, changes)
+
+
+def _delete_stale_values(objects, existing):
+    """Drop the characteristic values of retyped equipment that belong to its previous type."""
+    retyped = {}
+    for obj in objects:
+        previous = existing.get(obj.inventory_number)
+        if previous and previous["equipment_type_id"] != obj.equipment_type_id:
+            retyped.setdefault(obj.equipment_type_id, []).append(obj.pk)
+    for equipment_type_id, equipment_ids in retyped.items():
+        for chunk in in_chunks(equipment_ids):
+            EquipmentCharacteristicValue.objects.filter(equipment_id__in=chunk).exclude(
+                characteristic__equipment_type_id=equipment_type_id
+            ).delete()
+
+
+def _validate_items(items):
+    errors = {}
+    rows = []
+    seen = set()
+    for index, item in enumerate(items):
+        serializer = EquipmentBulkItemSerializer(data=item)
+        if not serializer.is_valid():
+            errors[index] = serializer.errors
+            continue
+        data = serializer.validated_data
+        if data["inventory_number"] in seen:
+            errors[index] = {"inventory_number": ["Duplicate inventory number in this batch."]}
+            continue
+        seen.add(data["inventory_number"])
+        rows.append((index, data))
+    return rows, errors
+
+
+def _supplies_parent(data):
+    """Whether a bulk row sets the parent; rows that don't keep the current one."""
+    return "parent" in data or "parent_inventory_number" in data
+
+
+def _cycle_rows(rows, existing):
+    """
+    Indexes of ``rows`` that would become their own ancestor, through other
+    rows of the batch and through the stored parents of everything else.
+    """
+    numbers = {data["inventory_number"] for _, data in rows}
+    batch_ids = {existing[number]["id"]: number for number in numbers if number in existing}
+
+    def key(parent_id):
+        if parent_id is None:
+            return None
+        return ("number", batch_ids[parent_id]) if parent_id in batch_ids else ("id", parent_id)
+
+    parents = {}
+    for _, data in rows:
+        number = data["inventory_number"]
+        parent_number = data.get("parent_inventory_number")
+        if parent_number:
+            parent = ("number", parent_number) if parent_number in numbers else key(existing[parent_number]["id"])
+        elif _supplies_parent(data):
+            parent = key(data.get("parent"))
+        else:
+            parent = key(existing.get(number, {}).get("parent_id"))
+        parents[("number", number)] = parent
+
+    # Only stored rows can lead back to the batch, and only to rows that are stored already.
+    outside = {parent[1] for parent in parents.values() if parent and parent[0] == "id"}
+    if batch_ids and outside:
+        # Every id is bound once, plus the depth limit.
+        for chunk in in_chunks(outside, params_per_value=2):
+            for item_id, parent_id in Equipment.objects.filter(id__in=paths_to(chunk)).values_list("id", "parent_id"):
+                if item_id not in batch_ids:
+                    parents[("id", item_id)] = key(parent_id)
+
+    cycles = set()
+    for index, data in rows:
+        start = ("number", data["inventory_number"])
+        node, seen = parents[start], set()
+        while node is not None and node != start and node not in seen:
+            seen.add(node)
+            node = parents.get(node)
+        if node == start:
+            cycles.add(index)
+    return cycles
+
+
+def _check_references(rows, errors):
+    type_ids = existing_ids(EquipmentType, {data["equipment_type"] for _, data in rows})
+    workshop_ids = existing_ids(Workshop, {data["workshop"] for _, data in rows})
+    parent_ids = existing_ids(Equipment, {data["parent"] for _, data in rows if data.get("parent")})
+    characteristics = {}
+    for chunk in in_chunks({value["characteristic"] for _, data in rows for value in data["characteristic_values"]}):
+        characteristics.update(
+            (pk, (equipment_type_id, value_type))
+            for pk, equipment_type_id, value_type in Characteristic.objects.filter(id__in=chunk).values_list(
+                "id", "equipment_type_id", "value_type"
+            )
+        )
+
+    batch_numbers = {data["inventory_number"] for _, data in rows}
+    parent_numbers = {data["parent_inventory_number"] for _, data in rows if data.get("parent_inventory_number")}
+    existing = existing_equipment(batch_numbers | parent_numbers)
+
+    valid = []
+    for index, data in rows:
+        row_errors = {}
+        if data["equipment_type"] not in type_ids:
+            row_errors["equipment_type"] = [f"Invalid pk \"{data['equipment_type']}\" - object does not exist."]
+        if data["workshop"] not in workshop_ids:
+            row_errors["workshop"] = [f"Invalid pk \"{data['workshop']}\" - object does not exist."]
+        if data.get("parent") and data["parent"] not in parent_ids:
+            row_errors["parent"] = [f"Invalid pk \"{data['parent']}\" - object does not exist."]
+        parent_number = data.get("parent_inventory_number")
+        if parent_number and parent_number not in batch_numbers and parent_number not in existing:
+            row_errors["parent_inventory_number"] = [f"Unknown inventory number \"{parent_number}\"."]
+        if parent_number == data["inventory_number"]:
+            row_errors["parent_inventory_number"] = ["Equipment cannot be its own parent."]
+        if data.get("parent") and data["parent"] == existing.get(data["inventory_number"], {}).get("id"):
+            row_errors["parent"] = ["Equipment cannot be its own parent."]
+
+        value_errors = {}
+        characteristic_ids = set()
+        for position, value in enumerate(data["characteristic_values"]):
+            characteristic_id = value["characteristic"]
+            equipment_type_id, value_type = characteristics.get(characteristic_id, (None, None))
+            if equipment_type_id != data["equipment_type"]:
+                value_errors[position] = {"characteristic": ["Characteristic does not belong to the equipment type."]}
+            elif characteristic_id in characteristic_ids:
+                value_errors[position] = {"characteristic": ["Duplicate characteristic."]}
+            else:
+                try:
+                    value["typed"] = (
+                        Characteristic.TYPED_VALUE_FIELDS.get(value_type),
+                        parse_characteristic_value(value_type, value["value"]),
+                    )
+                except ValidationError as exc:
+                    value_errors[position] = {"value": exc.messages}
+            characteristic_ids.add(characteristic_id)
+        if value_errors:
+            row_errors["characteristic_values"] = value_errors
+
+        if row_errors:
+            errors[index] = row_errors
+        else:
+            valid.append((index, data))
+
+    while True:
+        numbers = {data["inventory_number"] for _, data in valid}
+        orphans = {
+            index for index, data in valid
+            if data.get("parent_inventory_number")
+            and data["parent_inventory_number"] not in numbers
+            and data["parent_inventory_number"] not in existing
+        }
+        for index in orphans:
+            errors[index] = {"parent_inventory_number": ["Parent row was rejected."]}
+        cycles = _cycle_rows([row for row in valid if row[0] not in orphans], existing)
+        for index, data in valid:
+            if index in cycles:
+                field = "parent_inventory_number" if data.get("parent_inventory_number") else "parent"
+                errors[index] = {field: ["The new parent would make this equipment its own ancestor."]}
+        if not orphans and not cycles:
+            return valid, existing
+        valid = [(index, data) for index, data in valid if index not in orphans and index not in cycles]
+
+
+def bulk_upsert_equipment(items, batch_size=None, dry_run=False):
+    """
+    Create or update equipment keyed by ``inventory_number`` together with
+    its characteristic values.
+
+    Invalid rows are reported in ``errors`` and skipped; the remaining rows are
+    written with batched ``INSERT ... ON CONFLICT`` statements in one transaction,
+    together with their change history. Rows that change ``equipment_type``
+    lose the values of the previous type's characteristics.
+    """
+    batch_size = batch_size or settings.CATALOG_BULK_BATCH_SIZE
+    rows, errors = _validate_items(items)
+    rows, existing = _check_references(rows, errors)
+
+    with capture_history("bulk"):
+        previous_values = existing_values(
+            existing[data["inventory_number"]]["id"] for _, data in rows if data["inventory_number"] in existing
+        )
+        objects = [
+            Equipment(
+                inventory_number=data["inventory_number"],
+                name=data["name"],
+                equipment_type_id=data["equipment_type"],
+                workshop_id=data["workshop"],
+                parent_id=(
+                    data.get("parent") if _supplies_parent(data)
+                    else existing.get(data["inventory_number"], {}).get("parent_id")
+                ),
+            )
+            for _, data in rows
+        ]
+        # Rows without a parent must not overwrite the stored one, so they update fewer columns.
+        for supplies_parent in (True, False):
+            Equipment.objects.bulk_create(
+                [obj for obj, (_, data) in zip(objects, rows) if _supplies_parent(data) == supplies_parent],
+                batch_size=batch_size,
+                update_conflicts=True,
+                unique_fields=["inventory_number"],
+                update_fields=["name", "equipment_type", "workshop", *(["parent"] if supplies_parent else []),
+                               "updated_at"],
+            )
+
+        _delete_stale_values(objects, existing)
+
+        ids = {number: row["id"] for number, row in existing.items()}
+        ids.update((obj.inventory_number, obj.pk) for obj in objects)
+        reparented = []
+        for obj, (_, data) in zip(objects, rows):
+            if data.get("parent_inventory_number"):
+                obj.parent_id = ids[data["parent_inventory_number"]]
+                reparented.append(obj)
+        Equipment.objects.bulk_update(reparented, ["parent"], batch_size=batch_size)
+
+        deltas = Counter()
+        for _, data in rows:
+            deltas[(data["workshop"], data["equipment_type"])] += 1
+            previous = existing.get(data["inventory_number"])
+            if previous:
+                deltas[(previous["workshop_id"], previous["equipment_type_id"])] -= 1
+        adjust_counters(deltas)
+        record_changes("equipment", [obj.pk for obj in objects])
+        _record_history(objects, rows, existing, previous_values)
+
+        values = []
+        for obj, (_, data) in zip(objects, rows):
+            for value in data["characteristic_values"]:
+                column, typed_value = value["typed"]
+                instance = EquipmentCharacteristicValue(
+                    equipment_id=obj.pk,
+                    characteristic_id=value["characteristic"],
+                    value=value["value"],
+                )
+                if column:
+                    setattr(instance, column, typed_value)
+                values.append(instance)
+        EquipmentCharacteristicValue.objects.bulk_create(
+            values,
+            batch_size=batch_size,
+            update_conflicts=True,
+            unique_fields=["equipment", "characteristic"],
+            update_fields=["value", *EquipmentCharacteristicValue.TYPED_FIELDS],
+        )
+        if dry_run:
+            transaction.set_rollback(True)
+
+    created = sum(1 for _, data in rows if data["inventory_number"] not in existing)
+    return {
+        "created": created,
+        "updated": len(rows) - created,
+        "errors": [
+            {
+                "index": index,
+                "inventory_number": items[index].get("inventory_number") if isinstance(items[index], dict) else None,
+                "errors": row_errors,
+            }
+            for index, row_errors in sorted(errors.items())
+        ],
+    }
+
+
+def _below_listed(rows, ids):
+    """Listed ids with another listed item among their ancestors in ``rows``."""
+    inner = set()
+    for item_id in ids:
+        parent_id = rows[item_id]["parent_id"]
+        seen = set()
+        while parent_id in rows and parent_id not in seen:
+            if parent_id in ids:
+                inner.add(item_id)
+                break
+            seen.add(parent_id)
+            parent_id = rows[parent_id]["parent_id"]
+    return inner
+
+
+def bulk_move_equipment(ids, workshop=None, parent=None, with_descendants=False, move_parent=False):
+    """
+    Move the equipment ``ids`` to ``workshop`` and/or under ``parent`` (with
+    ``move_parent``; ``None`` makes them roots) with one ``UPDATE`` per
+    changed column and chunk of ids, keeping counters, the sync feed and the
+    change history up to date.
+
+    With ``with_descendants`` the workshop change covers whole subtrees and
+    only the topmost listed items are re-parented, so listed items below
+    other listed items keep their place. Unknown ids or targets and a parent
+    inside a moved subtree raise ``ValidationError`` before anything is written.
+    The checks run after locking the moved rows and the new parent's path,
+    so concurrent moves cannot invalidate them.
+    """
+    ids = set(ids)
+    with capture_history("bulk"):
+        rows = {}
+        # With descendants every id is bound twice, plus the depth limit.
+        for chunk in in_chunks(ids, params_per_value=3 if with_descendants else 1):
+            scope = Q(id__in=chunk)
+            if with_descendants:
+                if exceeds_max_depth(chunk):
+                    raise ValidationError({"ids": [
+                        f"Subtrees more than {settings.CATALOG_TREE_MAX_DEPTH} levels deep cannot be moved whole."
+                    ]})
+                scope |= Q(id__in=descendants(chunk))
+            rows.update(
+                (row["id"], row)
+                for row in Equipment.objects.select_for_update().filter(scope).values(
+                    "id", "workshop_id", "equipment_type_id", "parent_id"
+                )
+            )
+        errors = {}
+        missing = ids - rows.keys()
+        if missing:
+            errors["ids"] = [f"Unknown ids: {sorted(missing)}."]
+        if workshop is not None and not Workshop.objects.select_for_update().filter(pk=workshop).exists():
+            errors["workshop"] = [f"Invalid pk \"{workshop}\" - object does not exist."]
+        if move_parent and parent is not None:
+            # Locked like the moved rows, so no concurrent move can put the new parent below one of them.
+            path = dict(
+                Equipment.objects.select_for_update().filter(id__in=path_to(parent)).values_list("id", "parent_id")
+            )
+            if parent not in path:
+                errors["parent"] = [f"Invalid pk \"{parent}\" - object does not exist."]
+            elif any(parent_id is not None and parent_id not in path for parent_id in path.values()):
+                # Part of the path is missing, so a cycle could not be ruled out.
+                errors["parent"] = [f"{parent} is more than {settings.CATALOG_TREE_MAX_DEPTH} levels deep."]
+            elif path.keys() & ids:
+                # The new parent is one of the moved items or below one of them.
+                errors["parent"] = [f"Moving {sorted(path.keys() & ids)} under {parent} would create a cycle."]
+        if errors:
+            raise ValidationError(errors)
+
+        changes = {item_id: {} for item_id in rows}
+        if workshop is not None:
+            for item_id, row in rows.items():
+                if row["workshop_id"] != workshop:
+                    changes[item_id]["workshop"] = [row["workshop_id"], workshop]
+        if move_parent:
+            inner = _below_listed(rows, ids) if with_descendants else set()
+            for item_id in ids - inner:
+                if rows[item_id]["parent_id"] != parent:
+                    changes[item_id]["parent"] = [rows[item_id]["parent_id"], parent]
+
+        now = timezone.now()
+        for field, value in (("workshop", workshop), ("parent", parent)):
+            changed = [item_id for item_id, item_changes in changes.items() if field in item_changes]
+            for chunk in in_chunks(changed):
+                Equipment.objects.filter(id__in=chunk).update(**{f"{field}_id": value, "updated_at": now})
+
+        deltas = Counter()
+        for item_id, item_changes in changes.items():
+            if "workshop" in item_changes:
+                row = rows[item_id]
+                deltas[(workshop, row["equipment_type_id"])] += 1
+                deltas[(row["workshop_id"], row["equipment_type_id"])] -= 1
+        adjust_counters(deltas)
+        moved = [item_id for item_id, item_changes in changes.items() if item_changes]
+        record_changes("equipment", moved)
+        for item_id in moved:
+            record_change(item_id, EquipmentHistory.ACTION_UPDATE, changes[item_id])
+
+    return {
+        "items": len(ids),
+        "descendants": len(rows) - len(ids),
+        "moved": len(moved),
+        "workshop_changed": sum("workshop" in item_changes for item_changes in changes.values()),
+        "reparented": sum("parent" in item_changes for item_changes in changes.values()),
+        "unchanged": len(rows) - len(moved),
+    }
@@ -0,0 +1,132 @@
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.http import HttpResponse
+
+REFERENCE_NAMESPACES = {
+    "site": ("sites", "workshops"),
+    "workshop": ("workshops",),
+    "equipmenttype": ("equipment-types",),
+    "characteristic": ("equipment-types",),
+}
+
+
+def cache_is_shared():
+    """Whether the default cache is seen by every worker process, unlike a local memory cache."""
+    return not isinstance(caches["default"], LocMemCache)
+
+
+def _version_key(namespace):
+    return f"catalog:refcache:{namespace}:version"
+
+
+def get_version(namespace):
+    key = _version_key(namespace)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(namespace):
+    """Retire every cached response of ``namespace`` by moving to a new version."""
+    try:
+        cache.incr(_version_key(namespace))
+    except ValueError:
+        cache.add(_version_key(namespace), time.time_ns(), None)
+
+
+def invalidate_reference(model_name):
+    namespaces = REFERENCE_NAMESPACES.get(model_name, ())
+
+    def bump():
+        for namespace in namespaces:
+            bump_version(namespace)
+
+    transaction.on_commit(bump)
+
+
+class CachedReferenceMixin:
+    """
+    Serves ``list``/``retrieve`` of a reference viewset from pre-rendered JSON
+    bytes in the default cache.
+
+    Entries are stamped with a per-namespace version that signals bump after
+    commit, so every worker sharing the cache backend stops using old entries
+    at once. The version and the entry are read with one ``get_many()``, a
+    single query with the database cache. Permissions and throttling run
+    before the cache is consulted. With a local memory cache responses are
+    not cached, since other workers would not see the version bumps.
+    """
+    cache_namespace = None
+
+    def _lookup(self, request):
+        """The current version, the entry's key and the cached ``(content, content_type)`` or ``None``."""
+        version_key = _version_key(self.cache_namespace)
+        key = f"catalog:refcache:{self.cache_namespace}:{request.build_absolute_uri()}"
+        found = cache.get_many([version_key, key])
+        version = found.get(version_key)
+        if version is None:
+            return get_version(self.cache_namespace), key, None
+        entry = found.get(key)
+        if entry is None or entry[0] != version:
+            return version, key, None
+        return version, key, entry[1:]
+
+    def _store(self, request, version, key, response):
+        response.accepted_renderer = request.accepted_renderer
+        response.accepted_media_type = request.accepted_media_type
+        response.renderer_context = self.get_renderer_context()
+        response.render()
+        cache.set(
+            key, (version, response.content, response["Content-Type"]), settings.CATALOG_REFERENCE_CACHE_TIMEOUT
+        )
+
+    def _cached_response(self, request, render):
+        if request.accepted_renderer.format != "json" or not cache_is_shared():
+            return render()
+        version, key, hit = self._lookup(request)
+        if hit is not None:
+            content, content_type = hit
+            return HttpResponse(content, content_type=content_type)
+
+        response = render()
+        if response.status_code == 200:
+            self._store(request, version, key, response)
+        return response
+
+    async def _acached_response(self, request, render):
+        if request.accepted_renderer.format != "json" or not cache_is_shared():
+            return await render()
+        version, key, hit = await sync_to_async(self._lookup)(request)
+        if hit is not None:
+            content, content_type = hit
+            return HttpResponse(content, content_type=content_type)
+
+        response = await render()
+        if response.status_code == 200:
+            await sync_to_async(self._store)(request, version, key, response)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self._cached_response(request, lambda: super(CachedReferenceMixin, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._cached_response(
+            request, lambda: super(CachedReferenceMixin, self).retrieve(request, *args, **kwargs)
+        )
+
+    async def alist(self, request, *args, **kwargs):
+        return await self._acached_response(
+            request, lambda: super(CachedReferenceMixin, self).alist(request, *args, **kwargs)
+        )
+
+    async def aretrieve(self, request, *args, **kwargs):
+        return await self._acached_response(
+            request, lambda: super(CachedReferenceMixin, self).aretrieve(request, *args, **kwargs)
+        )
@@ -0,0 +1,161 @@
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.functional import SimpleLazyObject
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+PIN_COOKIE = "catalog_primary_until"
+
+_route = ContextVar("catalog_read_route", default=None)
+
+
+def _user_pin_key(user_id):
+    return f"catalog:primary-pin:{user_id}"
+
+
+def _loaded_user(request):
+    # Only a user that is already loaded: resolving it here would query through the router again.
+    user = request.__dict__.get("user")
+    if isinstance(user, SimpleLazyObject):
+        return getattr(request, "_cached_user", None)
+    return user
+
+
+class ReadRoute:
+    """
+    Decides whether the reads of one request (or ``read_from_replica()`` block)
+    may go to a replica. Only ``enabled`` routes do, and a request is pinned to
+    the primary for ``CATALOG_REPLICA_PIN_SECONDS`` after its client or user wrote.
+    """
+
+    def __init__(self, request=None, enabled=True):
+        self.request = request
+        self.enabled = enabled
+        self.pinned = None
+        self.atomic_depth = len(connections[DEFAULT_DB_ALIAS].atomic_blocks)
+
+    def use_replica(self):
+        if self.request is None:
+            return True
+        if self.pinned is None:
+            self.pinned = self._pinned()
+        return not self.pinned
+
+    def _pinned(self):
+        try:
+            if float(self.request.COOKIES.get(PIN_COOKIE, 0)) > time.time():
+                return True
+        except ValueError:
+            pass
+        user = _loaded_user(self.request)
+        if user is None:
+            # Authentication has not run yet: decide again on the next query.
+            return None
+        return bool(user.is_authenticated and cache.get(_user_pin_key(user.pk)))
+
+
+class ReplicaRouter:
+    """
+    Sends reads to a random ``CATALOG_READ_REPLICAS`` alias while a replica
+    route is active, unless a transaction was opened on the primary since;
+    everything else, including the database cache, uses the primary. Migrations only run on the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        route = _route.get()
+        replicas = settings.CATALOG_READ_REPLICAS
+        if route is None or not route.enabled or not replicas:
+            return DEFAULT_DB_ALIAS
+        if model._meta.app_label == "django_cache":
+            # The database cache holds invalidation state and the pins decided here: always current.
+            return DEFAULT_DB_ALIAS
+        if len(connections[DEFAULT_DB_ALIAS].atomic_blocks) > route.atomic_depth:
+            return DEFAULT_DB_ALIAS
+        if not route.use_replica():
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def read_from_replica():
+    """Route the reads of the block to a replica, e.g. in an export command."""
+    token = _route.set(ReadRoute())
+    try:
+        yield
+    finally:
+        _route.reset(token)
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Opens a replica route for GET/HEAD/OPTIONS requests and for viewset actions
+    listed in the viewset's ``read_only_actions``. A successful write pins its
+    client (cookie) and user (cache) to the primary for
+    ``CATALOG_REPLICA_PIN_SECONDS`` so they read their own writes.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        token = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            if token is not None:
+                _route.reset(token)
+        return self.finish(request, response)
+
+    async def __acall__(self, request):
+        token = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            if token is not None:
+                _route.reset(token)
+        return self.finish(request, response)
+
+    def start(self, request):
+        if not settings.CATALOG_READ_REPLICAS:
+            return None
+        request.catalog_read_route = ReadRoute(request, enabled=request.method in SAFE_METHODS)
+        return _route.set(request.catalog_read_route)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        route = getattr(request, "catalog_read_route", None)
+        action = (getattr(view_func, "actions", None) or {}).get(request.method.lower())
+        if route is not None and action in getattr(getattr(view_func, "cls", None), "read_only_actions", ()):
+            route.enabled = True
+
+    def finish(self, request, response):
+        route = getattr(request, "catalog_read_route", None)
+        if route is None or route.enabled or response.status_code >= 400:
+            return response
+        seconds = settings.CATALOG_REPLICA_PIN_SECONDS
+        response.set_cookie(PIN_COOKIE, str(time.time() + seconds), max_age=seconds, httponly=True, samesite="Lax")
+        user = _loaded_user(request)
+        if user is not None and user.is_authenticated:
+            cache.set(_user_pin_key(user.pk), 1, seconds)
+        return response
@@ -0,0 +1,147 @@
+import csv
+from datetime import datetime
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from django.db.models import Prefetch
+from django.utils import timezone
+
+from .models import Characteristic, EquipmentCharacteristicValue
+
+BASE_COLUMNS = [
+    "id", "inventory_number", "name", "site", "workshop", "equipment_type",
+    "parent_inventory_number", "created_at", "updated_at",
+]
+
+
+def characteristic_label(characteristic):
+    return f"{characteristic.equipment_type.name}: {characteristic.name}"
+
+
+def characteristic_columns(queryset):
+    """Characteristics of every equipment type present in ``queryset``, in column order."""
+    return list(
+        Characteristic.objects
+        .filter(equipment_type__in=queryset.order_by().values("equipment_type_id"))
+        .select_related("equipment_type")
+        .order_by("equipment_type__name", "name")
+    )
+
+
+def export_header(columns):
+    return BASE_COLUMNS + [characteristic_label(characteristic) for characteristic in columns]
+
+
+def filtered_equipment(params):
+    """Equipment matching the query parameters ``params`` (a ``QueryDict``) of ``/api/equipment/``."""
+    from django.http import HttpRequest
+    from rest_framework.request import Request
+
+    from .views import EquipmentViewSet
+
+    http_request = HttpRequest()
+    http_request.GET = params
+    view = EquipmentViewSet(request=Request(http_request), action="list", format_kwarg=None, args=(), kwargs={})
+    return view.filter_queryset(view.get_queryset())
+
+
+def iter_export_rows(queryset, columns, chunk_size=None, progress=None):
+    """
+    Yield one list per equipment with characteristic values pivoted into
+    ``columns``. Rows are read through a server-side cursor ``chunk_size`` at
+    a time, so memory does not grow with the size of the export.
+    ``progress`` is called with the number of rows done after every chunk.
+    """
+    positions = {characteristic.id: index for index, characteristic in enumerate(columns)}
+    queryset = queryset.select_related("equipment_type", "workshop__site", "parent").prefetch_related(None)
+    queryset = queryset.prefetch_related(Prefetch(
+        "characteristic_values",
+        queryset=EquipmentCharacteristicValue.objects.only("equipment_id", "characteristic_id", "value"),
+    ))
+    chunk_size = chunk_size or settings.CATALOG_EXPORT_CHUNK_SIZE
+    for done, equipment in enumerate(queryset.iterator(chunk_size=chunk_size), 1):
+        if progress and done % chunk_size == 0:
+            progress(done)
+        values = [""] * len(columns)
+        for value in equipment.characteristic_values.all():
+            # Values of characteristics outside the equipment's type have no column.
+            position = positions.get(value.characteristic_id)
+            if position is not None:
+                values[position] = value.value
+        yield [
+            equipment.id,
+            equipment.inventory_number,
+            equipment.name,
+            equipment.workshop.site.name,
+            equipment.workshop.name,
+            equipment.equipment_type.name,
+            equipment.parent.inventory_number if equipment.parent_id else "",
+            equipment.created_at,
+            equipment.updated_at,
+            *values,
+        ]
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def _csv_value(value):
+    return timezone.localtime(value).isoformat() if isinstance(value, datetime) else value
+
+
+def iter_csv(queryset, chunk_size=None, progress=None):
+    columns = characteristic_columns(queryset)
+    writer = csv.writer(_Echo())
+    yield "\ufeff" + writer.writerow(export_header(columns))
+    for row in iter_export_rows(queryset, columns, chunk_size, progress):
+        yield writer.writerow([_csv_value(value) for value in row])
+
+
+def write_xlsx(queryset, fileobj, chunk_size=None, progress=None):
+    from openpyxl import Workbook
+
+    columns = characteristic_columns(queryset)
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("equipment")
+    sheet.append(export_header(columns))
+    for row in iter_export_rows(queryset, columns, chunk_size, progress):
+        sheet.append([
+            timezone.make_naive(value) if isinstance(value, datetime) else value
+            for value in row
+        ])
+    workbook.save(fileobj)
+
+
+async def aiter_chunks(chunks, batch_size=None):
+    """
+    Async iterator over the sync iterator ``chunks``, advanced in worker
+    thread calls of ``batch_size`` chunks. Each call runs in the request's
+    thread, so a server-side cursor behind ``chunks`` stays on its connection.
+    """
+    batch_size = batch_size or settings.CATALOG_EXPORT_CHUNK_SIZE
+    take = sync_to_async(lambda: "".join(islice(chunks, batch_size)))
+    try:
+        while data := await take():
+            yield data
+    finally:
+        if hasattr(chunks, "close"):
+            await sync_to_async(chunks.close)()
+
+
+def csv_response(queryset, request, filename="equipment.csv"):
+    """
+    Streaming CSV export of ``queryset``. Under ASGI the body gets an async
+    iterator: Django would otherwise collect a sync iterator into a list,
+    building the whole file in memory before sending the first byte.
+    """
+    chunks = iter_csv(queryset)
+    if isinstance(request, ASGIRequest):
+        chunks = aiter_chunks(chunks)
+    response = StreamingHttpResponse(chunks, content_type="text/csv; charset=utf-8")
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
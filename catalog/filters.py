@@ -1,5 +1,72 @@
 import django_filters
-from .models import Equipment
+from django import forms
+from django.core.exceptions import ValidationError
+from django.db import connections
+from django.db.models import Case, Exists, FloatField, OuterRef, Q, Value, When
+from django_filters.widgets import QueryArrayWidget
+from rest_framework.filters import SearchFilter
+
+from .models import Characteristic, Equipment, EquipmentCharacteristicValue, parse_characteristic_value
+
+SEARCH_FIELDS = ("name", "inventory_number")
+
+CHARACTERISTIC_LOOKUPS = {"eq": "exact", "gt": "gt", "gte": "gte", "lt": "lt", "lte": "lte", "contains": "icontains"}
+CHARACTERISTIC_TYPE_LOOKUPS = {
+    Characteristic.VALUE_TYPE_STRING: {"eq", "contains"},
+    Characteristic.VALUE_TYPE_NUMBER: {"eq", "gt", "gte", "lt", "lte"},
+    Characteristic.VALUE_TYPE_DATE: {"eq", "gt", "gte", "lt", "lte"},
+    Characteristic.VALUE_TYPE_BOOLEAN: {"eq"},
+}
+
+
+class CharacteristicConditionField(forms.Field):
+    """
+    Parses ``<characteristic_id>:<op>:<value>`` conditions into
+    ``(characteristic_id, column, lookup, typed_value)`` tuples.
+    """
+    widget = QueryArrayWidget
+
+    def clean(self, value):
+        if not value:
+            return []
+        conditions = []
+        for item in value:
+            characteristic_id, _, rest = item.partition(":")
+            op, _, raw = rest.partition(":")
+            if not characteristic_id.isdigit() or op not in CHARACTERISTIC_LOOKUPS or not raw:
+                raise ValidationError(f"Invalid condition \"{item}\", expected <id>:<op>:<value>.")
+            conditions.append((int(characteristic_id), op, raw))
+
+        value_types = dict(
+            Characteristic.objects
+            .filter(id__in={condition[0] for condition in conditions})
+            .values_list("id", "value_type")
+        )
+        cleaned = []
+        for characteristic_id, op, raw in conditions:
+            value_type = value_types.get(characteristic_id)
+            if value_type is None:
+                raise ValidationError(f"Unknown characteristic {characteristic_id}.")
+            if op not in CHARACTERISTIC_TYPE_LOOKUPS[value_type]:
+                raise ValidationError(f"Operator \"{op}\" is not supported for {value_type} values.")
+            column = Characteristic.TYPED_VALUE_FIELDS.get(value_type, "value")
+            cleaned.append(
+                (characteristic_id, column, CHARACTERISTIC_LOOKUPS[op], parse_characteristic_value(value_type, raw))
+            )
+        return cleaned
+
+
+class CharacteristicValueFilter(django_filters.Filter):
+    field_class = CharacteristicConditionField
+
+    def filter(self, qs, value):
+        for characteristic_id, column, lookup, typed_value in value or []:
+            qs = qs.filter(Exists(EquipmentCharacteristicValue.objects.filter(
+                equipment=OuterRef("pk"),
+                characteristic_id=characteristic_id,
+                **{f"{column}__{lookup}": typed_value},
+            )))
+        return qs
 
 
 class EquipmentFilter(django_filters.FilterSet):
@@ -8,7 +75,62 @@ class EquipmentFilter(django_filters.FilterSet):
     equipment_type = django_filters.NumberFilter(field_name="equipment_type_id")
     name = django_filters.CharFilter(lookup_expr="icontains")
     inventory_number = django_filters.CharFilter(lookup_expr="icontains")
+    characteristic = CharacteristicValueFilter(
+        help_text="Repeatable <characteristic_id>:<eq|gt|gte|lt|lte|contains>:<value>, e.g. 5:gt:15",
+    )
 
     class Meta:
         model = Equipment
-        fields = ["workshop", "site", "equipment_type", "name", "inventory_number"]
\ No newline at end of file
+        fields = ["workshop", "site", "equipment_type", "name", "inventory_number", "characteristic"]
+
+
+def match_equipment(queryset, terms):
+    """
+    Keep equipment whose name or inventory number contains every term.
+
+    ``icontains`` compiles to ``UPPER(col::text) LIKE UPPER(%term%)`` on
+    PostgreSQL, which the ``gin_trgm_ops`` expression indexes from migration
+    0006 serve.
+    """
+    for term in terms:
+        condition = Q()
+        for field in SEARCH_FIELDS:
+            condition |= Q(**{f"{field}__icontains": term})
+        queryset = queryset.filter(condition)
+    return queryset
+
+
+def search_equipment(queryset, terms):
+    """
+    Match every term with ``match_equipment()`` and order by relevance.
+
+    Relevance on PostgreSQL adds trigram similarity; on other backends
+    (SQLite test runs) only exact and prefix matches are ranked.
+    """
+    queryset = match_equipment(queryset, terms)
+
+    phrase = " ".join(terms)
+    rank = Case(
+        When(inventory_number__iexact=phrase, then=Value(4.0)),
+        When(name__iexact=phrase, then=Value(3.0)),
+        When(inventory_number__istartswith=phrase, then=Value(2.0)),
+        When(name__istartswith=phrase, then=Value(1.0)),
+        default=Value(0.0),
+        output_field=FloatField(),
+    )
+    if connections[queryset.db].vendor == "postgresql":
+        from django.contrib.postgres.search import TrigramSimilarity
+
+        for field in SEARCH_FIELDS:
+            rank += TrigramSimilarity(field, phrase)
+    return queryset.annotate(search_rank=rank).order_by("-search_rank", *queryset.model._meta.ordering)
+
+
+class EquipmentSearchFilter(SearchFilter):
+    """``?search=`` backed by the trigram indexes, ordered by relevance unless ``?ordering=`` is given."""
+
+    def filter_queryset(self, request, queryset, view):
+        terms = self.get_search_terms(request)
+        if not terms:
+            return queryset
+        return search_equipment(queryset, terms)
@@ -0,0 +1,171 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.utils import timezone
+
+from .models import EquipmentHistory
+
+TABLE = EquipmentHistory._meta.db_table
+
+_capture = ContextVar("catalog_history_capture", default=None)
+
+
+def characteristic_key(characteristic_id):
+    return f"characteristic:{characteristic_id}"
+
+
+class HistoryCapture:
+    """
+    Change history collected inside one ``capture_history()`` block: one entry
+    per equipment item, merging the ``[old, new]`` pairs of repeated changes.
+    """
+
+    def __init__(self, source, user=None):
+        self.source = source
+        self.user = user
+        self.entries = {}
+
+    def add(self, equipment_id, action, changes):
+        entry = self.entries.get(equipment_id)
+        if entry is None:
+            self.entries[equipment_id] = {"action": action, "changes": dict(changes)}
+            return
+        if action == EquipmentHistory.ACTION_DELETE:
+            entry["action"] = action
+        for field, (old, new) in changes.items():
+            if field in entry["changes"]:
+                old = entry["changes"][field][0]
+            entry["changes"][field] = [old, new]
+
+    def objects(self):
+        user = self.user if self.user is not None and self.user.is_authenticated else None
+        changed_at = timezone.now()
+        objects = []
+        for equipment_id, entry in self.entries.items():
+            changes = {field: pair for field, pair in entry["changes"].items() if pair[0] != pair[1]}
+            if not changes and entry["action"] == EquipmentHistory.ACTION_UPDATE:
+                continue
+            objects.append(EquipmentHistory(
+                equipment_id=equipment_id,
+                changed_at=changed_at,
+                action=entry["action"],
+                source=self.source,
+                user_id=user.pk if user else None,
+                username=user.get_username() if user else "",
+                changes=changes,
+            ))
+        return objects
+
+    def write(self):
+        objects = self.objects()
+        self.entries = {}
+        EquipmentHistory.objects.bulk_create(objects, batch_size=settings.CATALOG_BULK_BATCH_SIZE)
+
+
+@contextmanager
+def capture_history(source, user=None):
+    """
+    Run the block in a transaction and write the equipment changes it made with
+    one bulk insert at its end, still inside that transaction, so history is
+    rolled back together with the changes. Nested blocks join the outer one.
+    """
+    outer = _capture.get()
+    if outer is not None:
+        if outer.user is None:
+            outer.user = user
+        yield outer
+        return
+    capture = HistoryCapture(source, user)
+    token = _capture.set(capture)
+    try:
+        with transaction.atomic():
+            yield capture
+            capture.write()
+    finally:
+        _capture.reset(token)
+
+
+def record_change(equipment_id, action, changes):
+    """
+    Add ``changes`` (field to ``[old, new]``) of one equipment item to the
+    current capture. Outside of one the entry is written right away, within
+    the caller's transaction.
+    """
+    capture = _capture.get()
+    if capture is not None:
+        capture.add(equipment_id, action, changes)
+        return
+    single = HistoryCapture("system")
+    single.add(equipment_id, action, changes)
+    single.write()
+
+
+def history_page(equipment_id, before=None, limit=50):
+    """Entries of one equipment item newest first, older than entry id ``before``; plus the next ``before``."""
+    queryset = EquipmentHistory.objects.filter(equipment_id=equipment_id).order_by("-id")
+    if before is not None:
+        queryset = queryset.filter(id__lt=before)
+    entries = list(queryset[:limit + 1])
+    if len(entries) > limit:
+        return entries[:limit], entries[limit - 1].id
+    return entries, None
+
+
+def _next_month(day):
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def create_partitions(connection=None, months=None):
+    """
+    Create the monthly partitions of the history table from the current month
+    up to ``months`` ahead (``CATALOG_HISTORY_PARTITION_MONTHS``). PostgreSQL
+    only; run it regularly so rows never land in the default partition.
+    """
+    connection = connection or connections[DEFAULT_DB_ALIAS]
+    if connection.vendor != "postgresql":
+        return []
+    months = settings.CATALOG_HISTORY_PARTITION_MONTHS if months is None else months
+    start = timezone.now().date().replace(day=1)
+    created = []
+    with connection.cursor() as cursor:
+        for _ in range(months + 1):
+            end = _next_month(start)
+            name = f"{TABLE}_{start:%Y_%m}"
+            cursor.execute("SELECT to_regclass(%s)", [name])
+            if cursor.fetchone()[0] is None:
+                cursor.execute(
+                    f"CREATE TABLE {name} PARTITION OF {TABLE} "
+                    f"FOR VALUES FROM ('{start.isoformat()} 00:00+00') TO ('{end.isoformat()} 00:00+00')"
+                )
+                created.append(name)
+            start = end
+    return created
+
+
+class ChangeHistoryMixin:
+    """
+    Runs the writes of a viewset (``perform_create``/``update``/``destroy``
+    and actions using ``capture_history_for()``) in ``capture_history()``, so
+    their equipment changes are written in one batch attributed to the user.
+    Only the write itself is in the transaction: authentication, throttling
+    and body parsing happen before it, without holding row locks.
+    """
+    history_source = "api"
+
+    def capture_history_for(self, source=None):
+        return capture_history(source or self.history_source, self.request.user)
+
+    def perform_create(self, serializer):
+        with self.capture_history_for():
+            super().perform_create(serializer)
+
+    def perform_update(self, serializer):
+        with self.capture_history_for():
+            super().perform_update(serializer)
+
+    def perform_destroy(self, instance):
+        with self.capture_history_for():
+            super().perform_destroy(instance)
@@ -0,0 +1,348 @@
+import csv
+import hashlib
+import json
+import logging
+import os
+from datetime import date, datetime
+from itertools import islice
+
+from .bulk import bulk_upsert_equipment, existing_equipment
+from .models import Characteristic, EquipmentType, Site, Workshop
+
+REQUIRED_COLUMNS = ["inventory_number", "name", "site", "workshop", "equipment_type"]
+OPTIONAL_COLUMNS = ["parent_inventory_number"]
+IGNORED_COLUMNS = {"id", "created_at", "updated_at"}
+
+logger = logging.getLogger("catalog.importer")
+
+
+def cell_text(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, datetime) and not (value.hour or value.minute or value.second or value.microsecond):
+        return value.date().isoformat()
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+def read_rows(path):
+    """Yield ``(row_number, values)`` of a CSV (UTF-8, optional BOM) or XLSX file, header included."""
+    if path.lower().endswith(".xlsx"):
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            for number, row in enumerate(workbook.active.iter_rows(values_only=True), start=1):
+                yield number, [cell_text(value) for value in row]
+        finally:
+            workbook.close()
+        return
+    with open(path, encoding="utf-8-sig", newline="") as source:
+        yield from enumerate(csv.reader(source), start=1)
+
+
+class ReferenceMaps:
+    """
+    Name to id maps of sites, workshops, equipment types and characteristics,
+    loaded with one query each. With ``create_missing`` unknown names are
+    created on first use (characteristics as strings).
+    """
+
+    def __init__(self, create_missing=False):
+        self.create_missing = create_missing
+        self.sites = dict(Site.objects.values_list("name", "id"))
+        self.workshops = {
+            (site_name, name): pk for pk, name, site_name in Workshop.objects.values_list("id", "name", "site__name")
+        }
+        self.types = dict(EquipmentType.objects.values_list("name", "id"))
+        self.characteristics = {
+            (type_name, name): pk
+            for pk, name, type_name in Characteristic.objects.values_list("id", "name", "equipment_type__name")
+        }
+
+    def site(self, name):
+        if name not in self.sites and self.create_missing:
+            self.sites[name] = Site.objects.create(name=name).pk
+        return self.sites.get(name)
+
+    def workshop(self, site_name, name):
+        key = (site_name, name)
+        if key not in self.workshops and self.create_missing and self.site(site_name):
+            self.workshops[key] = Workshop.objects.create(name=name, site_id=self.sites[site_name]).pk
+        return self.workshops.get(key)
+
+    def equipment_type(self, name):
+        if name not in self.types and self.create_missing:
+            self.types[name] = EquipmentType.objects.create(name=name).pk
+        return self.types.get(name)
+
+    def characteristic(self, type_name, name):
+        key = (type_name, name)
+        if key not in self.characteristics and self.create_missing and self.equipment_type(type_name):
+            self.characteristics[key] = Characteristic.objects.create(
+                name=name, equipment_type_id=self.types[type_name], value_type=Characteristic.VALUE_TYPE_STRING
+            ).pk
+        return self.characteristics.get(key)
+
+
+class ImportSource:
+    """
+    Streams an export-shaped file (see ``catalog.export``) as import entries:
+    ``{"row", "site", "item", "raw"}`` for rows that resolved, where ``item``
+    is the input of ``bulk_upsert_equipment``, or ``{"row", "raw", "errors"}``.
+    """
+
+    def __init__(self, path, references):
+        self.references = references
+        self.rows = read_rows(path)
+        try:
+            _, header = next(self.rows)
+        except StopIteration:
+            raise ValueError("The file is empty")
+        self.header = [column.strip() for column in header]
+        self.positions = {column: index for index, column in enumerate(self.header)}
+        missing = [column for column in REQUIRED_COLUMNS if column not in self.positions]
+        if missing:
+            raise ValueError(f"Missing columns: {', '.join(missing)}")
+
+        self.characteristics = []
+        unknown = []
+        for index, column in enumerate(self.header):
+            if column in self.positions and self.positions[column] != index:
+                raise ValueError(f"Duplicate column {column!r}")
+            if column in REQUIRED_COLUMNS or column in OPTIONAL_COLUMNS or column in IGNORED_COLUMNS or not column:
+                continue
+            type_name, sep, name = column.partition(":")
+            characteristic_id = references.characteristic(type_name.strip(), name.strip()) if sep else None
+            if characteristic_id is None:
+                unknown.append(column)
+            self.characteristics.append((index, characteristic_id))
+        if unknown:
+            raise ValueError(f"Unknown characteristic columns: {', '.join(unknown)}")
+
+    def __iter__(self):
+        for number, values in self.rows:
+            if not any(value.strip() for value in values):
+                continue
+            yield self.convert(number, values)
+
+    def convert(self, number, values):
+        values = list(values) + [""] * (len(self.header) - len(values))
+        raw = dict(zip(self.header, values))
+
+        def get(column):
+            return values[self.positions[column]].strip() if column in self.positions else ""
+
+        errors = {}
+        for column in REQUIRED_COLUMNS:
+            if not get(column):
+                errors[column] = ["This field is required."]
+        site_name, workshop_name, type_name = get("site"), get("workshop"), get("equipment_type")
+        workshop_id = type_id = None
+        if site_name and workshop_name:
+            workshop_id = self.references.workshop(site_name, workshop_name)
+            if workshop_id is None:
+                errors["workshop"] = [f"Unknown workshop \"{workshop_name}\" at site \"{site_name}\"."]
+        if type_name:
+            type_id = self.references.equipment_type(type_name)
+            if type_id is None:
+                errors["equipment_type"] = [f"Unknown equipment type \"{type_name}\"."]
+        if errors:
+            return {"row": number, "raw": raw, "errors": errors}
+
+        return {
+            "row": number,
+            "site": site_name,
+            "raw": raw,
+            "item": {
+                "inventory_number": get("inventory_number"),
+                "name": get("name"),
+                "equipment_type": type_id,
+                "workshop": workshop_id,
+                "parent_inventory_number": get("parent_inventory_number") or None,
+                "characteristic_values": [
+                    {"characteristic": characteristic_id, "value": values[index].strip()}
+                    for index, characteristic_id in self.characteristics
+                    if values[index].strip()
+                ],
+            },
+        }
+
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{int(stat.st_mtime)}"
+
+
+class Checkpoint:
+    """
+    Progress of one partition: rows up to ``done`` are committed except the
+    ``pending`` ones, which waited for a parent. Stored as a small JSON file
+    and replaced atomically after every batch.
+    """
+
+    def __init__(self, directory, partition, fingerprint):
+        self.path = None
+        self.done = 0
+        self.pending = set()
+        if directory is None:
+            return
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, hashlib.sha1(partition.encode()).hexdigest()[:16] + ".json")
+        self.fingerprint = fingerprint
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as stored:
+                state = json.load(stored)
+            if state.get("fingerprint") == fingerprint:
+                self.done, self.pending = state["done"], set(state["pending"])
+
+    def skip(self, entry):
+        return entry["row"] <= self.done and entry["row"] not in self.pending
+
+    def save(self, done, pending):
+        if self.path is None:
+            return
+        self.done, self.pending = done, set(pending)
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as stored:
+            json.dump({"fingerprint": self.fingerprint, "done": done, "pending": sorted(pending)}, stored)
+        os.replace(temporary, self.path)
+
+    def clear(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _split_ready(batch, seen):
+    """Rows whose parent is known, in this batch, or already imported; the rest wait."""
+    wanted = {
+        entry["item"]["parent_inventory_number"] for entry in batch
+        if entry["item"]["parent_inventory_number"]
+    } - seen
+    found = set(existing_equipment(wanted - {entry["item"]["inventory_number"] for entry in batch}))
+    ready = batch
+    while True:
+        available = seen | found | {entry["item"]["inventory_number"] for entry in ready}
+        waiting = [
+            entry for entry in ready
+            if entry["item"]["parent_inventory_number"]
+            and entry["item"]["parent_inventory_number"] not in available
+        ]
+        if not waiting:
+            ready_rows = {entry["row"] for entry in ready}
+            return ready, [entry for entry in batch if entry["row"] not in ready_rows]
+        waiting_rows = {entry["row"] for entry in waiting}
+        ready = [entry for entry in ready if entry["row"] not in waiting_rows]
+
+
+def _reject(entry, errors):
+    return {"row": entry["row"], "raw": entry["raw"], "errors": errors}
+
+
+class RejectFile:
+    """
+    CSV of rejected rows with their errors, written as rejects come in rather
+    than collected first. Without a path rejects are only counted.
+    """
+
+    def __init__(self, path, header):
+        self.header = header
+        self.count = 0
+        self.output = self.writer = None
+        if path:
+            self.output = open(path, "w", encoding="utf-8-sig", newline="")
+            self.writer = csv.writer(self.output)
+            self.writer.writerow(["row", *header, "errors"])
+
+    def __call__(self, reject):
+        self.count += 1
+        if self.writer is not None:
+            self.writer.writerow([
+                reject["row"],
+                *(reject["raw"].get(column, "") for column in self.header),
+                json.dumps(reject["errors"], ensure_ascii=False),
+            ])
+
+    def close(self):
+        if self.output is not None:
+            self.output.close()
+
+
+def import_entries(entries, batch_size, checkpoint=None, progress=None, label="import", on_reject=None):
+    """
+    Upsert converted ``entries`` in batches of ``batch_size`` rows, one
+    transaction per batch. Rows whose parent has not been imported yet are
+    held back and retried until no more of them can be placed. Rejected rows
+    are passed to ``on_reject`` and only counted in the result.
+    """
+    checkpoint = checkpoint or Checkpoint(None, label, None)
+    on_reject = on_reject or (lambda reject: None)
+    result = {"created": 0, "updated": 0, "rejected": 0, "deferred": []}
+    seen = set()
+    deferred = []
+    processed = 0
+    entries = (entry for entry in entries if not checkpoint.skip(entry))
+
+    def upsert(batch):
+        ready, waiting = _split_ready(batch, seen)
+        outcome = bulk_upsert_equipment([entry["item"] for entry in ready], batch_size=batch_size)
+        rejected = {error["index"] for error in outcome["errors"]}
+        for error in outcome["errors"]:
+            on_reject(_reject(ready[error["index"]], error["errors"]))
+        result["rejected"] += len(outcome["errors"])
+        seen.update(entry["item"]["inventory_number"] for index, entry in enumerate(ready) if index not in rejected)
+        result["created"] += outcome["created"]
+        result["updated"] += outcome["updated"]
+        return waiting
+
+    while True:
+        batch = list(islice(entries, batch_size))
+        if not batch:
+            break
+        deferred.extend(upsert(batch))
+        processed += len(batch)
+        checkpoint.save(max(checkpoint.done, batch[-1]["row"]), [entry["row"] for entry in deferred])
+        if progress:
+            progress(f"{label}: {processed} rows, {result['created']} created, {result['updated']} updated, "
+                     f"{result['rejected']} rejected, {len(deferred)} waiting for a parent")
+
+    while deferred:
+        waiting = []
+        for start in range(0, len(deferred), batch_size):
+            waiting.extend(upsert(deferred[start:start + batch_size]))
+        if len(waiting) == len(deferred):
+            break
+        deferred = waiting
+        checkpoint.save(checkpoint.done, [entry["row"] for entry in deferred])
+    result["deferred"] = deferred
+    return result
+
+
+def import_partition(path, partition, batch_size, checkpoint_dir, fingerprint, rejects_path):
+    """
+    Process pool task: import one site partition written as JSON lines by the
+    parent process. Rejects are appended as JSON lines to ``rejects_path``.
+    """
+    def entries():
+        with open(path, encoding="utf-8") as source:
+            for line in source:
+                yield json.loads(line)
+
+    checkpoint = Checkpoint(checkpoint_dir, partition, fingerprint)
+    with open(rejects_path, "w", encoding="utf-8") as rejects:
+        return import_entries(
+            entries(), batch_size, checkpoint, logger.info, label=partition,
+            on_reject=lambda reject: rejects.write(json.dumps(reject, ensure_ascii=False) + "\n"),
+        )
+
+
+def parent_rejects(entries):
+    for entry in entries:
+        yield _reject(entry, {"parent_inventory_number": [
+            f"Unknown inventory number \"{entry['item']['parent_inventory_number']}\"."
+        ]})
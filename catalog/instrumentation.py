@@ -0,0 +1,242 @@
+import heapq
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+logger = logging.getLogger("catalog.timing")
+
+_current = ContextVar("catalog_request_profile", default=None)
+
+
+class RequestProfile:
+    """Query count, DB time, slowest statements and phase durations of one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.queries = 0
+        self.db_ms = 0.0
+        self.slowest = []
+
+    def add_phase(self, name, elapsed_ms):
+        self.phases[name] = self.phases.get(name, 0.0) + elapsed_ms
+
+    def add_query(self, sql, elapsed_ms):
+        self.queries += 1
+        self.db_ms += elapsed_ms
+        entry = (elapsed_ms, self.queries, sql[:500])
+        if len(self.slowest) < settings.CATALOG_TIMING_SLOW_QUERIES:
+            heapq.heappush(self.slowest, entry)
+        elif entry > self.slowest[0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    @property
+    def total_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self, total_ms):
+        metrics = [f"total;dur={total_ms:.2f}", f'db;dur={self.db_ms:.2f};desc="{self.queries} queries"']
+        metrics += [f"{name};dur={elapsed:.2f}" for name, elapsed in self.phases.items()]
+        return ", ".join(metrics)
+
+    def as_record(self, request, response, total_ms):
+        match = request.resolver_match
+        return {
+            "endpoint": f"{request.method} {match.view_name}",
+            "path": request.path,
+            "status": response.status_code,
+            "total_ms": round(total_ms, 3),
+            "db_ms": round(self.db_ms, 3),
+            "queries": self.queries,
+            "phases": {name: round(elapsed, 3) for name, elapsed in self.phases.items()},
+            "slowest": [
+                {"ms": round(elapsed, 3), "sql": sql} for elapsed, _, sql in sorted(self.slowest, reverse=True)
+            ],
+        }
+
+
+def current_profile():
+    return _current.get()
+
+
+@contextmanager
+def phase(name):
+    """Add the time spent in the block to phase ``name`` of the sampled request, if any."""
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_phase(name, (time.perf_counter() - started) * 1000)
+
+
+def _time_query(execute, sql, params, many, context):
+    profile = _current.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.add_query(sql, (time.perf_counter() - started) * 1000)
+
+
+@receiver(connection_created)
+def install_query_timer(sender, connection, **kwargs):
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
+
+
+def _is_catalog_view(request):
+    match = request.resolver_match
+    if match is None:
+        return False
+    view = getattr(match.func, "cls", None) or getattr(match.func, "view_class", match.func)
+    return view.__module__.startswith("catalog.")
+
+
+class ServerTimingMiddleware:
+    """
+    Profiles a sample of requests (``CATALOG_TIMING_SAMPLE_RATE``) and, for
+    views of the catalog app, adds a ``Server-Timing`` header and writes one
+    JSON line to the ``catalog.timing`` logger. Unsampled requests only pay
+    for one random number.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        profile = self.start()
+        if profile is None:
+            return self.get_response(request)
+        token = _current.set(profile)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, profile)
+
+    async def __acall__(self, request):
+        profile = self.start()
+        if profile is None:
+            return await self.get_response(request)
+        token = _current.set(profile)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, profile)
+
+    def start(self):
+        if random.random() >= settings.CATALOG_TIMING_SAMPLE_RATE:
+            return None
+        for connection in connections.all(initialized_only=True):
+            install_query_timer(None, connection)
+        return RequestProfile()
+
+    def finish(self, request, response, profile):
+        if not _is_catalog_view(request):
+            return response
+        total_ms = profile.total_ms
+        response["Server-Timing"] = profile.server_timing(total_ms)
+        logger.info(json.dumps(profile.as_record(request, response, total_ms), ensure_ascii=False))
+        return response
+
+
+class PhaseTimingMixin:
+    """Times the stages of a DRF view as phases of the sampled request."""
+
+    def perform_authentication(self, request):
+        with phase("auth"):
+            super().perform_authentication(request)
+
+    def check_permissions(self, request):
+        with phase("permissions"):
+            super().check_permissions(request)
+
+    def check_throttles(self, request):
+        with phase("throttle"):
+            super().check_throttles(request)
+
+    def filter_queryset(self, queryset):
+        with phase("filter"):
+            return super().filter_queryset(queryset)
+
+    def paginate_queryset(self, queryset):
+        with phase("query"):
+            return super().paginate_queryset(queryset)
+
+    async def apaginate_queryset(self, queryset):
+        with phase("query"):
+            return await super().apaginate_queryset(queryset)
+
+    def serialize_list(self, rows):
+        with phase("serialize"):
+            return super().serialize_list(rows)
+
+    async def aserialize_list(self, rows):
+        with phase("serialize"):
+            return await super().aserialize_list(rows)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        profile = _current.get()
+        if profile is not None and hasattr(response, "add_post_render_callback"):
+            started = time.perf_counter()
+            response.add_post_render_callback(
+                lambda rendered: profile.add_phase("render", (time.perf_counter() - started) * 1000)
+            )
+        return response
+
+
+def _percentile(values, share):
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def summarize(records):
+    """Aggregate timing log records per endpoint, slowest total time first."""
+    endpoints = {}
+    for record in records:
+        endpoints.setdefault(record["endpoint"], []).append(record)
+
+    summary = []
+    for endpoint, rows in endpoints.items():
+        totals = sorted(row["total_ms"] for row in rows)
+        phases = {}
+        for row in rows:
+            for name, elapsed in row["phases"].items():
+                phases[name] = phases.get(name, 0.0) + elapsed
+        slowest = max((query for row in rows for query in row["slowest"]), key=lambda query: query["ms"], default=None)
+        summary.append({
+            "endpoint": endpoint,
+            "requests": len(rows),
+            "p50_ms": round(_percentile(totals, 0.5), 3),
+            "p95_ms": round(_percentile(totals, 0.95), 3),
+            "max_ms": round(totals[-1], 3),
+            "sum_ms": round(sum(totals), 3),
+            "avg_queries": round(sum(row["queries"] for row in rows) / len(rows), 2),
+            "avg_db_ms": round(sum(row["db_ms"] for row in rows) / len(rows), 3),
+            "avg_phases_ms": {name: round(elapsed / len(rows), 3) for name, elapsed in phases.items()},
+            "slowest_query": slowest,
+        })
+    return sorted(summary, key=lambda item: item["sum_ms"], reverse=True)
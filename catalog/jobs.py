@@ -0,0 +1,391 @@
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connection, transaction
+from django.db.models import F
+from django.http import QueryDict
+from django.utils import timezone
+
+from .db_router import read_from_replica
+from .export import filtered_equipment, iter_csv, write_xlsx
+from .models import Equipment, Job
+from .previews import MISSING, can_preview, generate_preview, preview_state
+from .roles import ROLE_ADMIN, ROLE_MANAGER, ROLE_VIEWER
+from .stats import rebuild_counters
+from .storage import job_storage
+
+logger = logging.getLogger("catalog.jobs")
+
+JOB_FILES_PREFIX = "jobs"
+
+# Job kind to its handler, see job_kind().
+JOB_KINDS = {}
+
+
+class JobError(Exception):
+    """Raised by a handler for failures a retry cannot fix, such as invalid parameters."""
+
+
+def job_kind(name, roles=(ROLE_ADMIN, ROLE_MANAGER), max_attempts=None):
+    """
+    Register the decorated ``handler(job, progress)`` for jobs of kind
+    ``name``, submittable through the API by users with one of ``roles``.
+    Its return value becomes the job's ``result``; it must be safe to run again
+    after a failed attempt.
+    """
+    def register(handler):
+        handler.roles = frozenset(roles)
+        handler.max_attempts = max_attempts
+        JOB_KINDS[name] = handler
+        return handler
+    return register
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def job_file(job, filename):
+    """Storage name of a file produced or consumed by ``job``."""
+    return f"{JOB_FILES_PREFIX}/{job.pk}/{filename}"
+
+
+def enqueue(kind, params=None, user=None, max_attempts=None):
+    if kind not in JOB_KINDS:
+        raise JobError(f"Unknown job kind {kind!r}")
+    handler = JOB_KINDS[kind]
+    return Job.objects.create(
+        kind=kind,
+        params=params or {},
+        created_by=user if user is not None and user.is_authenticated else None,
+        max_attempts=max_attempts or handler.max_attempts or settings.CATALOG_JOB_MAX_ATTEMPTS,
+    )
+
+
+class Progress:
+    """
+    Progress reporter handed to a handler. Writes at most once per
+    ``CATALOG_JOB_PROGRESS_SECONDS`` and refreshes the job's heartbeat, so a job
+    that keeps reporting is never taken for one whose worker died.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.written = 0.0
+
+    def __call__(self, done=None, total=None, message=None, force=False):
+        if done is not None:
+            self.job.progress_done = done
+        if total is not None:
+            self.job.progress_total = total
+        if message is not None:
+            self.job.progress_message = message[:255]
+        now = time.monotonic()
+        if not force and now - self.written < settings.CATALOG_JOB_PROGRESS_SECONDS:
+            return
+        self.written = now
+        Job.objects.filter(pk=self.job.pk, status=Job.STATUS_RUNNING, worker=self.job.worker).update(
+            progress_done=self.job.progress_done,
+            progress_total=self.job.progress_total,
+            progress_message=self.job.progress_message,
+            heartbeat_at=timezone.now(),
+        )
+
+
+@contextmanager
+def heartbeat(job):
+    """
+    Refresh the heartbeat of a running ``job`` from a background thread every
+    ``CATALOG_JOB_HEARTBEAT_SECONDS`` while the block runs, so a long step that
+    reports no progress is not taken for a job whose worker died.
+    """
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(settings.CATALOG_JOB_HEARTBEAT_SECONDS):
+                try:
+                    Job.objects.filter(pk=job.pk, status=Job.STATUS_RUNNING, worker=job.worker).update(
+                        heartbeat_at=timezone.now()
+                    )
+                except DatabaseError:
+                    logger.warning("Cannot refresh the heartbeat of job %s", job.pk, exc_info=True)
+        finally:
+            # The thread's own connection.
+            connection.close()
+
+    thread = threading.Thread(target=beat, name=f"job-{job.pk}-heartbeat", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def claim_job(worker):
+    """
+    Take the oldest due queued job and mark it running for ``worker``. Rows
+    locked by other workers are skipped instead of waited for, so any number
+    of workers poll the same table without blocking each other.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        job = (
+            Job.objects.select_for_update(skip_locked=True)
+            .filter(status=Job.STATUS_QUEUED, run_after__lte=now)
+            .order_by("run_after", "id")
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = Job.STATUS_RUNNING
+        job.attempts += 1
+        job.worker = worker
+        job.started_at = job.heartbeat_at = now
+        job.save(update_fields=["status", "attempts", "worker", "started_at", "heartbeat_at"])
+    return job
+
+
+def _retry_at(job):
+    return timezone.now() + timedelta(seconds=settings.CATALOG_JOB_RETRY_SECONDS * 2 ** (job.attempts - 1))
+
+
+def run_job(job):
+    """Run a claimed job: store its result, or queue it again after a delay until its attempts run out."""
+    handler = JOB_KINDS.get(job.kind)
+    progress = Progress(job)
+    try:
+        if handler is None:
+            raise JobError(f"Unknown job kind {job.kind!r}")
+        with heartbeat(job):
+            result = handler(job, progress)
+    except Exception as exc:
+        logger.warning("Job %s (%s) failed, attempt %s of %s", job.pk, job.kind, job.attempts, job.max_attempts,
+                       exc_info=True)
+        retry = not isinstance(exc, JobError) and job.attempts < job.max_attempts
+        job.status = Job.STATUS_QUEUED if retry else Job.STATUS_FAILED
+        job.error = str(exc) if isinstance(exc, JobError) else traceback.format_exc()
+        job.run_after = _retry_at(job) if retry else job.run_after
+        job.finished_at = None if retry else timezone.now()
+    else:
+        job.status = Job.STATUS_SUCCEEDED
+        job.result = result
+        job.error = ""
+        job.finished_at = timezone.now()
+    # The worker check leaves alone a job that was declared lost and claimed by another worker meanwhile.
+    Job.objects.filter(pk=job.pk, status=Job.STATUS_RUNNING, worker=job.worker).update(
+        status=job.status,
+        result=job.result,
+        error=job.error,
+        run_after=job.run_after,
+        finished_at=job.finished_at,
+        progress_done=job.progress_done,
+        progress_total=job.progress_total,
+        progress_message=job.progress_message,
+    )
+    return job
+
+
+def requeue_lost_jobs():
+    """
+    Jobs running without a heartbeat for ``CATALOG_JOB_STALE_SECONDS`` lost
+    their worker: queue them again, or fail them when out of attempts.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.CATALOG_JOB_STALE_SECONDS)
+    lost = Job.objects.filter(status=Job.STATUS_RUNNING, heartbeat_at__lt=cutoff)
+    error = "The worker stopped responding."
+    requeued = lost.filter(attempts__lt=F("max_attempts")).update(
+        status=Job.STATUS_QUEUED, run_after=timezone.now(), error=error
+    )
+    failed = lost.update(status=Job.STATUS_FAILED, finished_at=timezone.now(), error=error)
+    return requeued, failed
+
+
+def prune_jobs(days):
+    """
+    Delete jobs finished more than ``days`` ago with their files, and the
+    files left by jobs deleted otherwise. Returns the number of jobs deleted.
+    """
+    cutoff = timezone.now() - timedelta(days=days)
+    finished = Job.objects.filter(status__in=[Job.STATUS_SUCCEEDED, Job.STATUS_FAILED], finished_at__lt=cutoff)
+    pruned = {str(pk) for pk in finished.values_list("pk", flat=True)}
+    finished.filter(pk__in=pruned).delete()
+    root = job_storage().path(JOB_FILES_PREFIX)
+    if not os.path.isdir(root):
+        return len(pruned)
+    jobs = {str(pk) for pk in Job.objects.values_list("pk", flat=True)}
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        # A recent directory may belong to a job whose transaction has not committed yet.
+        if name in pruned or (name not in jobs and os.path.getmtime(path) < cutoff.timestamp()):
+            shutil.rmtree(path, ignore_errors=True)
+    return len(pruned)
+
+
+def work(worker=None, stop=None, poll_seconds=None, burst=False):
+    """
+    Worker loop: run due jobs one at a time until ``stop`` (an event) is set,
+    or, with ``burst``, until the queue is empty. Returns the number of jobs run.
+    """
+    worker = worker or worker_name()
+    poll_seconds = settings.CATALOG_JOB_POLL_SECONDS if poll_seconds is None else poll_seconds
+    processed = 0
+    while stop is None or not stop.is_set():
+        # Like a request would: drop connections that broke or outlived CONN_MAX_AGE.
+        close_old_connections()
+        try:
+            job = claim_job(worker)
+            if job is None:
+                requeue_lost_jobs()
+                if burst:
+                    break
+        except DatabaseError:
+            logger.exception("Cannot poll the job queue")
+            job = None
+        if job is None:
+            if stop is None:
+                time.sleep(poll_seconds)
+            else:
+                stop.wait(poll_seconds)
+            continue
+        run_job(job)
+        processed += 1
+    return processed
+
+
+@job_kind("export", roles=(ROLE_ADMIN, ROLE_MANAGER, ROLE_VIEWER))
+def export_job(job, progress):
+    """``params``: ``format`` (csv or xlsx) and ``filters``, the query parameters of ``/api/equipment/``."""
+    export_format = job.params.get("format", "csv")
+    if export_format not in ("csv", "xlsx"):
+        raise JobError("Expected format csv or xlsx.")
+    params = QueryDict(mutable=True)
+    for key, value in (job.params.get("filters") or {}).items():
+        params.setlist(key, [str(item) for item in value] if isinstance(value, list) else [str(value)])
+    name = job_file(job, f"equipment.{export_format}")
+    path = job_storage().path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with read_from_replica():
+        queryset = filtered_equipment(params)
+        progress(0, queryset.count(), "Exporting", force=True)
+        if export_format == "xlsx":
+            with open(path, "wb") as fileobj:
+                write_xlsx(queryset, fileobj, progress=progress)
+        else:
+            with open(path, "w", encoding="utf-8", newline="") as fileobj:
+                for chunk in iter_csv(queryset, progress=progress):
+                    fileobj.write(chunk)
+    progress(job.progress_total, message="Done")
+    return {"file": name}
+
+
+@job_kind("import")
+def import_job(job, progress):
+    """
+    ``params``: ``file`` (storage name of a CSV or XLSX file shaped like the
+    export) and ``create_missing``. Progress is checkpointed per batch, so a
+    retry resumes where the failed attempt stopped.
+    """
+    # Imported here: the importer depends on the serializers, which depend on this module.
+    from .importer import Checkpoint, ImportSource, ReferenceMaps, file_fingerprint, import_entries, parent_rejects
+
+    storage = job_storage()
+    name = job.params.get("file")
+    if not name or not storage.exists(name):
+        raise JobError("The file to import does not exist.")
+    path = storage.path(name)
+    try:
+        source = ImportSource(path, ReferenceMaps(bool(job.params.get("create_missing"))))
+    except ValueError as exc:
+        raise JobError(str(exc))
+    rejects = []
+    rejected = 0
+
+    def reject(entry):
+        # Only the first rejects are kept for the result; the rest are counted.
+        nonlocal rejected
+        rejected += 1
+        if len(rejects) < settings.CATALOG_JOB_MAX_REJECTS:
+            rejects.append({"row": entry["row"], "errors": entry["errors"]})
+
+    def entries():
+        for entry in source:
+            if "errors" in entry:
+                reject(entry)
+                continue
+            yield entry
+
+    checkpoint = Checkpoint(storage.path(job_file(job, "checkpoint")), "all", file_fingerprint(path))
+    result = import_entries(
+        entries(), settings.CATALOG_BULK_BATCH_SIZE, checkpoint, progress=lambda message: progress(message=message),
+        on_reject=reject,
+    )
+    for entry in parent_rejects(result["deferred"]):
+        reject(entry)
+    checkpoint.clear()
+    return {
+        "created": result["created"],
+        "updated": result["updated"],
+        "rejected": rejected,
+        "rejects": sorted(rejects, key=lambda entry: entry["row"]),
+    }
+
+
+@job_kind("rebuild_stats", roles=(ROLE_ADMIN,))
+def rebuild_stats_job(job, progress):
+    return {"groups": rebuild_counters()}
+
+
+def schedule_preview(name):
+    """
+    Queue the preview of the scan ``name`` unless it is queued or being
+    generated already. Rendering runs in the job workers, not in the
+    processes serving requests.
+    """
+    if not can_preview(name):
+        return None
+    pending = Job.objects.filter(
+        kind="passport_previews", params__scan=name, status__in=[Job.STATUS_QUEUED, Job.STATUS_RUNNING]
+    )
+    if pending.exists():
+        return None
+    return enqueue("passport_previews", {"scan": name})
+
+
+@job_kind("passport_previews")
+def passport_previews_job(job, progress):
+    """
+    ``params``: ``scan`` to preview one scan; without it every scan whose
+    preview is missing or outdated. A single scan is retried after errors
+    like a timeout, a batch counts it as failed and moves on.
+    """
+    if job.params.get("scan"):
+        name = job.params["scan"]
+        return {"generated": can_preview(name) and preview_state(name) == MISSING and generate_preview(name)}
+
+    scans = Equipment.objects.exclude(passport_scan="").exclude(passport_scan__isnull=True)
+    names = sorted(set(scans.values_list("passport_scan", flat=True)))
+    generated = failed = 0
+    progress(0, len(names), force=True)
+    for done, name in enumerate(names, 1):
+        if can_preview(name) and preview_state(name) == MISSING:
+            try:
+                ok = generate_preview(name)
+            except Exception:
+                logger.warning("Cannot build a preview of %s", name, exc_info=True)
+                ok = False
+            if ok:
+                generated += 1
+            else:
+                failed += 1
+        progress(done)
+    return {"scans": len(names), "generated": generated, "failed": failed}
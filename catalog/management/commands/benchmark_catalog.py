@@ -0,0 +1,50 @@
+import json
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from catalog.benchmark import compare, run
+
+
+class Command(BaseCommand):
+    help = "Measure EquipmentViewSet latency and query counts and compare them with a baseline"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scale", default="default", help="Label stored with the results, e.g. small/medium")
+        parser.add_argument("--iterations", type=int, default=20)
+        parser.add_argument("--scenario", action="append", help="Run only these scenarios")
+        parser.add_argument("--output-dir", default=str(Path(settings.BASE_DIR) / "benchmarks"))
+        parser.add_argument("--baseline", help="Results file to compare against")
+        parser.add_argument("--threshold", type=float, default=0.2, help="Allowed relative latency increase")
+        parser.add_argument("--fail-on-regression", action="store_true")
+
+    def handle(self, *args, **options):
+        results = run(options["iterations"], options["scenario"])
+        if not results["scenarios"]:
+            raise CommandError("The catalog is empty, run generate_catalog first")
+        results["scale"] = options["scale"]
+        results["timestamp"] = timezone.now().isoformat()
+
+        for name, result in results["scenarios"].items():
+            self.stdout.write(
+                f"{name:<16} median {result['median_ms']:>9.2f}ms  p95 {result['p95_ms']:>9.2f}ms  "
+                f"queries {result['queries']:>3}  status {result['status']}"
+            )
+
+        output_dir = Path(options["output_dir"])
+        output_dir.mkdir(parents=True, exist_ok=True)
+        output = output_dir / f"{options['scale']}-{timezone.now():%Y%m%d-%H%M%S}.json"
+        output.write_text(json.dumps(results, indent=2, ensure_ascii=False))
+        self.stdout.write(f"Results written to {output}")
+
+        if options["baseline"]:
+            baseline = json.loads(Path(options["baseline"]).read_text())
+            regressions = compare(results, baseline, options["threshold"])
+            for regression in regressions:
+                self.stdout.write(self.style.ERROR(f"REGRESSION {regression}"))
+            if regressions and options["fail_on_regression"]:
+                raise CommandError(f"{len(regressions)} regression(s) against {options['baseline']}")
+            if not regressions:
+                self.stdout.write(self.style.SUCCESS("No regressions against baseline"))
@@ -0,0 +1,105 @@
+import os
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from catalog.bulk import in_chunks
+from catalog.models import Equipment, PassportUpload
+from catalog.previews import FAILED_SUFFIX, PREVIEW_SUFFIX
+from catalog.storage import BLOB_PREFIX, TMP_PREFIX
+
+
+class Command(BaseCommand):
+    help = "Delete passport blobs no equipment refers to and expired upload sessions"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--grace-hours", type=float, default=24, help="Keep files younger than this")
+        parser.add_argument("--upload-ttl-hours", type=float, default=48, help="Expire unfinished uploads")
+        parser.add_argument("--adopt-legacy", action="store_true",
+                            help="Move scans stored under random-suffix names into the blob store first")
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, **options):
+        self.storage = Equipment._meta.get_field("passport_scan").storage
+        self.dry_run = options["dry_run"]
+        cutoff = time.time() - options["grace_hours"] * 3600
+
+        if options["adopt_legacy"]:
+            self.adopt_legacy()
+        expired = self.expire_uploads(timezone.now() - timedelta(hours=options["upload_ttl_hours"]))
+        orphans = self.remove_orphans(cutoff)
+        action = "Would remove" if self.dry_run else "Removed"
+        self.stdout.write(self.style.SUCCESS(f"{action} {orphans} orphaned blob(s) and {expired} expired upload(s)"))
+
+    def adopt_legacy(self):
+        legacy = Equipment.objects.exclude(passport_scan="").exclude(passport_scan__isnull=True).exclude(
+            passport_scan__startswith=BLOB_PREFIX
+        )
+        for equipment in legacy.only("id", "passport_scan").iterator(chunk_size=1000):
+            path = self.storage.path(equipment.passport_scan.name)
+            if not os.path.exists(path):
+                continue
+            self.stdout.write(f"Adopting {equipment.passport_scan.name}")
+            if self.dry_run:
+                continue
+            with open(path, "rb") as source:
+                name = self.storage.save(equipment.passport_scan.name, source)
+            Equipment.objects.filter(pk=equipment.pk).update(passport_scan=name)
+            os.remove(path)
+
+    def expire_uploads(self, cutoff):
+        """Upload sessions idle since ``cutoff``; completed ones have already handed their blob over."""
+        expired = PassportUpload.objects.filter(updated_at__lt=cutoff)
+        count = expired.count()
+        if not self.dry_run:
+            expired.delete()
+        return count
+
+    def remove_orphans(self, cutoff):
+        blobs, parts, previews = [], [], []
+        for prefix in (BLOB_PREFIX, TMP_PREFIX):
+            for directory, _, files in os.walk(self.storage.path(prefix)):
+                for filename in files:
+                    path = os.path.join(directory, filename)
+                    if os.path.getmtime(path) >= cutoff:
+                        continue
+                    name = os.path.relpath(path, self.storage.location).replace(os.sep, "/")
+                    if prefix == BLOB_PREFIX and filename.endswith((PREVIEW_SUFFIX, FAILED_SUFFIX)):
+                        previews.append(name)
+                    elif prefix == BLOB_PREFIX:
+                        blobs.append(name)
+                    elif filename.endswith(".part"):
+                        parts.append((filename[:-len(".part")], name))
+                    else:
+                        # Leftover of an interrupted ContentAddressedStorage._save().
+                        self.delete(name)
+
+        removed = set()
+        for chunk in in_chunks(blobs):
+            referenced = set(Equipment.objects.filter(passport_scan__in=chunk).values_list("passport_scan", flat=True))
+            referenced.update(PassportUpload.objects.filter(blob__in=chunk).values_list("blob", flat=True))
+            for name in chunk:
+                if name not in referenced:
+                    removed.add(name)
+                    self.delete(name)
+
+        # Previews sit next to their blob and go with it.
+        for name in previews:
+            source = name.removesuffix(PREVIEW_SUFFIX).removesuffix(FAILED_SUFFIX)
+            if source in removed or not self.storage.exists(source):
+                self.delete(name)
+
+        sessions = {str(upload_id) for upload_id in PassportUpload.objects.filter(
+            completed_at__isnull=True
+        ).values_list("id", flat=True)}
+        for upload_id, name in parts:
+            if upload_id not in sessions:
+                self.delete(name)
+        return len(removed)
+
+    def delete(self, name):
+        self.stdout.write(f"Orphan {name}")
+        if not self.dry_run:
+            self.storage.delete(name)
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from catalog.history import create_partitions
+
+
+class Command(BaseCommand):
+    help = "Create the monthly PostgreSQL partitions of the equipment history ahead of time (run monthly)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--months", type=int, default=None,
+                            help="Months ahead, CATALOG_HISTORY_PARTITION_MONTHS by default")
+
+    def handle(self, *args, **options):
+        created = create_partitions(months=options["months"])
+        for name in created:
+            self.stdout.write(f"Created {name}")
+        self.stdout.write(self.style.SUCCESS(f"Created {len(created)} partition(s)"))
@@ -0,0 +1,46 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.http import QueryDict
+
+from catalog.db_router import read_from_replica
+from catalog.export import filtered_equipment, iter_csv, write_xlsx
+
+
+class Command(BaseCommand):
+    help = "Export the equipment catalog with the same filters as /api/equipment/"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--format", choices=["csv", "xlsx"], default="csv")
+        parser.add_argument("--output", help="Output file, stdout for CSV if omitted")
+        parser.add_argument("--chunk-size", type=int)
+        parser.add_argument(
+            "--filter", action="append", default=[], metavar="KEY=VALUE",
+            help="API query parameter, e.g. --filter site=1 --filter search=Станок",
+        )
+
+    def handle(self, *args, **options):
+        params = QueryDict(mutable=True)
+        for item in options["filter"]:
+            key, sep, value = item.partition("=")
+            if not sep:
+                raise CommandError(f"Invalid filter {item!r}, expected KEY=VALUE")
+            params.appendlist(key, value)
+        if options["format"] == "xlsx" and not options["output"]:
+            raise CommandError("--output is required for xlsx")
+        with read_from_replica():
+            self.export(filtered_equipment(params), options)
+
+    def export(self, queryset, options):
+        if options["format"] == "xlsx":
+            with open(options["output"], "wb") as fileobj:
+                write_xlsx(queryset, fileobj, options["chunk_size"])
+            return
+
+        stream = open(options["output"], "w", encoding="utf-8", newline="") if options["output"] else sys.stdout
+        try:
+            for chunk in iter_csv(queryset, options["chunk_size"]):
+                stream.write(chunk)
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
@@ -0,0 +1,125 @@
+import random
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from catalog.models import Characteristic, Equipment, EquipmentCharacteristicValue, EquipmentType, Site, Workshop
+from catalog.stats import rebuild_counters
+
+SCALES = {
+    "small": {"sites": 2, "workshops": 3, "types": 5, "characteristics": 4, "equipment": 1_000},
+    "medium": {"sites": 5, "workshops": 10, "types": 30, "characteristics": 8, "equipment": 100_000},
+    "large": {"sites": 20, "workshops": 25, "types": 200, "characteristics": 12, "equipment": 1_000_000},
+}
+EQUIPMENT_NAMES = ["Станок", "Пресс", "Насос", "Компрессор", "Конвейер", "Робот", "Печь", "Кран", "Двигатель", "Узел"]
+VALUE_TYPES = [choice for choice, _ in Characteristic.VALUE_TYPE_CHOICES]
+
+
+class Command(BaseCommand):
+    help = "Generate a synthetic equipment catalog for benchmarks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+        parser.add_argument("--sites", type=int)
+        parser.add_argument("--workshops-per-site", type=int, dest="workshops")
+        parser.add_argument("--types", type=int)
+        parser.add_argument("--characteristics-per-type", type=int, dest="characteristics")
+        parser.add_argument("--equipment", type=int)
+        parser.add_argument("--tree-depth", type=int, default=4)
+        parser.add_argument("--branching", type=int, default=4)
+        parser.add_argument("--prefix", default="GEN", help="Prefix for generated names and inventory numbers")
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        config = {**SCALES[options["scale"]], **{k: options[k] for k in SCALES["small"] if options[k] is not None}}
+        self.rng = random.Random(options["seed"])
+        self.prefix = options["prefix"]
+        self.batch_size = options["batch_size"]
+
+        with transaction.atomic():
+            workshops = self.create_references(config)
+        characteristics = {}
+        for characteristic in Characteristic.objects.filter(equipment_type__name__startswith=self.prefix):
+            characteristics.setdefault(characteristic.equipment_type_id, []).append(characteristic)
+
+        created, values = self.create_equipment(
+            config["equipment"], options["tree_depth"], options["branching"], workshops, characteristics
+        )
+        rebuild_counters()
+        self.stdout.write(self.style.SUCCESS(f"Created {created} equipment and {values} characteristic values"))
+
+    def create_references(self, config):
+        sites = Site.objects.bulk_create(
+            [Site(name=f"{self.prefix} Площадка {i:03d}") for i in range(config["sites"])]
+        )
+        workshops = Workshop.objects.bulk_create([
+            Workshop(name=f"{self.prefix} Цех {i:03d}", site=site)
+            for site in sites for i in range(config["workshops"])
+        ])
+        types = EquipmentType.objects.bulk_create(
+            [EquipmentType(name=f"{self.prefix} Тип {i:04d}") for i in range(config["types"])]
+        )
+        Characteristic.objects.bulk_create([
+            Characteristic(name=f"Параметр {i:02d}", equipment_type=equipment_type, value_type=VALUE_TYPES[i % 4])
+            for equipment_type in types for i in range(config["characteristics"])
+        ])
+        self.type_ids = [equipment_type.id for equipment_type in types]
+        return [workshop.id for workshop in workshops]
+
+    def level_sizes(self, total, depth, branching):
+        weights = [branching ** level for level in range(depth)]
+        sizes = [max(1, total * weight // sum(weights)) for weight in weights]
+        sizes[-1] += total - sum(sizes)
+        return sizes
+
+    def random_value(self, value_type):
+        if value_type == Characteristic.VALUE_TYPE_NUMBER:
+            number = Decimal(self.rng.randint(1, 100_000)) / 100
+            return str(number), "value_number", number
+        if value_type == Characteristic.VALUE_TYPE_DATE:
+            day = date(2015, 1, 1) + timedelta(days=self.rng.randint(0, 4000))
+            return day.isoformat(), "value_date", day
+        if value_type == Characteristic.VALUE_TYPE_BOOLEAN:
+            flag = self.rng.random() < 0.5
+            return str(flag).lower(), "value_boolean", flag
+        return f"Значение {self.rng.randint(1, 999)}", None, None
+
+    def create_equipment(self, total, depth, branching, workshops, characteristics):
+        created = values = 0
+        parents = []
+        for level, size in enumerate(self.level_sizes(total, depth, branching)):
+            current = []
+            for start in range(0, size, self.batch_size):
+                batch = []
+                for i in range(start, min(size, start + self.batch_size)):
+                    parent_id, workshop_id = self.rng.choice(parents) if parents else (None, self.rng.choice(workshops))
+                    batch.append(Equipment(
+                        name=f"{self.rng.choice(EQUIPMENT_NAMES)} {self.prefix}-{level}-{i}",
+                        inventory_number=f"{self.prefix}-{level}-{i:07d}",
+                        equipment_type_id=self.rng.choice(self.type_ids),
+                        workshop_id=workshop_id,
+                        parent_id=parent_id,
+                    ))
+                with transaction.atomic():
+                    Equipment.objects.bulk_create(batch, batch_size=self.batch_size)
+                    values += self.create_values(batch, characteristics)
+                current.extend((equipment.id, equipment.workshop_id) for equipment in batch)
+                created += len(batch)
+                self.stdout.write(f"level {level}: {created}/{total} equipment")
+            parents = current
+        return created, values
+
+    def create_values(self, batch, characteristics):
+        rows = []
+        for equipment in batch:
+            for characteristic in characteristics.get(equipment.equipment_type_id, []):
+                text, column, typed = self.random_value(characteristic.value_type)
+                row = EquipmentCharacteristicValue(equipment=equipment, characteristic=characteristic, value=text)
+                if column:
+                    setattr(row, column, typed)
+                rows.append(row)
+        EquipmentCharacteristicValue.objects.bulk_create(rows, batch_size=self.batch_size)
+        return len(rows)
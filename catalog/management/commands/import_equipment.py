@@ -0,0 +1,137 @@
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from catalog.importer import (
+    Checkpoint, ImportSource, RejectFile, ReferenceMaps, file_fingerprint, import_entries, import_partition,
+    parent_rejects,
+)
+
+
+def _setup_worker():
+    django.setup()
+
+
+class Command(BaseCommand):
+    help = (
+        "Import equipment from a CSV or XLSX file shaped like export_equipment output, "
+        "upserting by inventory_number"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV or XLSX file")
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--workers", type=int, default=1, help="Import sites in parallel processes")
+        parser.add_argument("--create-missing", action="store_true",
+                            help="Create unknown sites, workshops, types and (string) characteristics")
+        parser.add_argument("--rejects", help="Write rejected rows with their errors to this CSV file")
+        parser.add_argument("--checkpoint", help="Directory for progress files; a rerun resumes from them")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Import in one process inside a transaction that is rolled back")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        if not os.path.exists(path):
+            raise CommandError(f"{path} does not exist")
+        self.fingerprint = file_fingerprint(path)
+        self.partitions = ["all"]
+
+        if options["dry_run"]:
+            with transaction.atomic():
+                result = self.run(path, options, self.run_sequential)
+                transaction.set_rollback(True)
+        else:
+            result = self.run(path, options, self.run_parallel if options["workers"] > 1 else self.run_sequential)
+        if not options["dry_run"]:
+            for partition in self.partitions:
+                Checkpoint(options["checkpoint"], partition, self.fingerprint).clear()
+
+        prefix = "Dry run, nothing saved:" if options["dry_run"] else "Done:"
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix} created {result['created']}, updated {result['updated']}, rejected {self.rejects.count}"
+        ))
+
+    def run(self, path, options, method):
+        source = self.open_source(path, options)
+        # Rejected rows go to the file as they are found, so they never pile up in memory.
+        self.rejects = RejectFile(options["rejects"], source.header)
+        try:
+            result = method(source, options)
+            for reject in parent_rejects(result["deferred"]):
+                self.rejects(reject)
+        finally:
+            self.rejects.close()
+        if options["rejects"]:
+            self.stdout.write(f"{self.rejects.count} rejected row(s) written to {options['rejects']}")
+        return result
+
+    def open_source(self, path, options):
+        try:
+            return ImportSource(path, ReferenceMaps(options["create_missing"]))
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+    def entries(self, source):
+        for entry in source:
+            if "errors" in entry:
+                self.rejects(entry)
+                continue
+            yield entry
+
+    def run_sequential(self, source, options):
+        checkpoint = Checkpoint(None if options["dry_run"] else options["checkpoint"], "all", self.fingerprint)
+        return import_entries(
+            self.entries(source), options["batch_size"], checkpoint, progress=self.stdout.write, label="all",
+            on_reject=self.rejects,
+        )
+
+    def run_parallel(self, source, options):
+        result = {"created": 0, "updated": 0, "deferred": []}
+        with tempfile.TemporaryDirectory() as directory:
+            partitions = {}
+            files = {}
+            try:
+                for entry in self.entries(source):
+                    site = entry["site"]
+                    if site not in files:
+                        partitions[site] = os.path.join(directory, f"{len(files)}.jsonl")
+                        files[site] = open(partitions[site], "w", encoding="utf-8")
+                    files[site].write(json.dumps(entry, ensure_ascii=False) + "\n")
+            finally:
+                for partition in files.values():
+                    partition.close()
+            self.partitions = list(partitions)
+            self.stdout.write(f"Split into {len(partitions)} site partition(s)")
+
+            # Children must open their own connections instead of sharing the parent's sockets.
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=options["workers"], initializer=_setup_worker) as pool:
+                futures = {
+                    pool.submit(
+                        import_partition, partition_path, site, options["batch_size"], options["checkpoint"],
+                        self.fingerprint, f"{partition_path}.rejects",
+                    ): site
+                    for site, partition_path in partitions.items()
+                }
+                for future in as_completed(futures):
+                    partial = future.result()
+                    for key in ("created", "updated"):
+                        result[key] += partial[key]
+                    result["deferred"].extend(partial["deferred"])
+                    with open(f"{partitions[futures[future]]}.rejects", encoding="utf-8") as rejects:
+                        for line in rejects:
+                            self.rejects(json.loads(line))
+                    self.stdout.write(f"{futures[future]}: finished")
+
+        if result["deferred"]:
+            # Parents at another site exist now that every partition is in.
+            retry = import_entries(result["deferred"], options["batch_size"], label="parents", on_reject=self.rejects)
+            for key in ("created", "updated"):
+                result[key] += retry[key]
+            result["deferred"] = retry["deferred"]
+        return result
@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from catalog.jobs import prune_jobs
+
+
+class Command(BaseCommand):
+    help = "Delete finished background jobs and their files older than the retention period"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=None,
+                            help="Retention in days, CATALOG_JOB_RETENTION_DAYS by default")
+
+    def handle(self, *args, **options):
+        days = settings.CATALOG_JOB_RETENTION_DAYS if options["days"] is None else options["days"]
+        deleted = prune_jobs(days)
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} job(s)"))
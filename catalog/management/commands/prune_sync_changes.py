@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from catalog.sync import prune_changes
+
+
+class Command(BaseCommand):
+    help = "Delete sync feed entries (including tombstones) older than the retention period"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=None,
+                            help="Retention in days, CATALOG_SYNC_RETENTION_DAYS by default")
+
+    def handle(self, *args, **options):
+        days = settings.CATALOG_SYNC_RETENTION_DAYS if options["days"] is None else options["days"]
+        deleted = prune_changes(days)
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} sync entr{'y' if deleted == 1 else 'ies'}"))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from catalog.throttling import prune_buckets
+
+
+class Command(BaseCommand):
+    help = "Delete rate limit buckets of clients that have been idle long enough to be full again"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--idle-hours", type=float, default=24,
+                            help="Should be at least the longest throttle period")
+
+    def handle(self, *args, **options):
+        deleted = prune_buckets(options["idle_hours"] * 3600)
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} idle bucket(s)"))
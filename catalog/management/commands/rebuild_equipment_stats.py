@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from catalog.models import EquipmentCounter
+from catalog.stats import count_groups, rebuild_counters
+
+
+class Command(BaseCommand):
+    help = "Recompute the equipment counters behind /api/equipment/stats/ from the equipment table"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--check", action="store_true", help="Only report groups whose counter has drifted")
+
+    def handle(self, *args, **options):
+        if not options["check"]:
+            groups = rebuild_counters()
+            self.stdout.write(self.style.SUCCESS(f"Rebuilt {groups} counter(s)"))
+            return
+
+        actual = count_groups()
+        stored = {
+            (workshop_id, equipment_type_id): count
+            for workshop_id, equipment_type_id, count in EquipmentCounter.objects.filter(count__gt=0).values_list(
+                "workshop_id", "equipment_type_id", "count"
+            )
+        }
+        drifted = sorted(key for key in actual.keys() | stored.keys() if actual.get(key, 0) != stored.get(key, 0))
+        for workshop_id, equipment_type_id in drifted:
+            self.stdout.write(
+                f"workshop {workshop_id}, type {equipment_type_id}: "
+                f"counter {stored.get((workshop_id, equipment_type_id), 0)}, "
+                f"actual {actual.get((workshop_id, equipment_type_id), 0)}"
+            )
+        self.stdout.write(self.style.SUCCESS(f"{len(drifted)} drifted counter(s)"))
@@ -0,0 +1,73 @@
+import multiprocessing
+import signal
+import time
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+
+def _run_worker(index, stop, poll_seconds, burst):
+    """Entry point of a worker process; stops after its current job once ``stop`` is set."""
+    django.setup()
+    from catalog.jobs import work, worker_name
+
+    # Ctrl+C and service managers signal the whole process group: only the parent
+    # reacts, by setting ``stop``, so running jobs are finished rather than lost.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    try:
+        work(f"{worker_name()}/{index}", stop, poll_seconds, burst)
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = "Run background job workers that claim queued jobs with SELECT ... FOR UPDATE SKIP LOCKED"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, help="Worker processes, CATALOG_JOB_WORKERS by default; "
+                                                          "0 runs jobs in this process")
+        parser.add_argument("--poll", type=float, help="Seconds between polls of an empty queue")
+        parser.add_argument("--burst", action="store_true", help="Exit once the queue is empty")
+
+    def handle(self, *args, **options):
+        processes = settings.CATALOG_JOB_WORKERS if options["processes"] is None else options["processes"]
+        poll_seconds = settings.CATALOG_JOB_POLL_SECONDS if options["poll"] is None else options["poll"]
+        if processes <= 0:
+            from catalog.jobs import work
+
+            processed = work(poll_seconds=poll_seconds, burst=options["burst"])
+            self.stdout.write(self.style.SUCCESS(f"Ran {processed} job(s)"))
+            return
+
+        context = multiprocessing.get_context()
+        stop = context.Event()
+        signals = []
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: signals.append(signum))
+
+        def start(index):
+            process = context.Process(target=_run_worker, args=(index, stop, poll_seconds, options["burst"]))
+            process.start()
+            return process
+
+        # Children must open their own connections instead of sharing the parent's sockets.
+        connections.close_all()
+        workers = {index: start(index) for index in range(processes)}
+        self.stdout.write(f"Started {processes} worker(s)")
+        while workers:
+            time.sleep(0.5)
+            if signals and not stop.is_set():
+                self.stdout.write("Stopping after the running jobs")
+                stop.set()
+            for index, process in list(workers.items()):
+                if process.is_alive():
+                    continue
+                if options["burst"] or stop.is_set():
+                    del workers[index]
+                    continue
+                self.stderr.write(f"Worker {index} exited with code {process.exitcode}, restarting")
+                workers[index] = start(index)
+        self.stdout.write(self.style.SUCCESS("Workers stopped"))
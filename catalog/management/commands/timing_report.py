@@ -0,0 +1,48 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from catalog.instrumentation import summarize
+
+
+class Command(BaseCommand):
+    help = "Aggregate catalog.timing request logs into per-endpoint latency, query and phase figures"
+
+    def add_arguments(self, parser):
+        parser.add_argument("logs", nargs="*", help="Timing log files, defaults to CATALOG_TIMING_LOG")
+        parser.add_argument("--top", type=int, default=20, help="Show this many endpoints")
+        parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+
+    def handle(self, *args, **options):
+        paths = options["logs"] or ([settings.CATALOG_TIMING_LOG] if settings.CATALOG_TIMING_LOG else [])
+        if not paths:
+            raise CommandError("No log files given and CATALOG_TIMING_LOG is not set")
+
+        records = []
+        for path in paths:
+            with open(path, encoding="utf-8") as log:
+                for line in log:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(record, dict) and "endpoint" in record:
+                        records.append(record)
+
+        summary = summarize(records)[:options["top"]]
+        if options["json"]:
+            self.stdout.write(json.dumps(summary, indent=2, ensure_ascii=False))
+            return
+
+        for item in summary:
+            phases = "  ".join(f"{name} {elapsed:.1f}" for name, elapsed in item["avg_phases_ms"].items())
+            self.stdout.write(
+                f"{item['endpoint']:<40} n={item['requests']:<6} p50 {item['p50_ms']:>8.1f}ms  "
+                f"p95 {item['p95_ms']:>8.1f}ms  queries {item['avg_queries']:>6.1f}  db {item['avg_db_ms']:>7.1f}ms"
+            )
+            if phases:
+                self.stdout.write(f"    {phases}")
+            if item["slowest_query"]:
+                self.stdout.write(f"    slowest {item['slowest_query']['ms']:.1f}ms: {item['slowest_query']['sql'][:160]}")
+        self.stdout.write(self.style.SUCCESS(f"{len(records)} request(s) in {len(paths)} file(s)"))
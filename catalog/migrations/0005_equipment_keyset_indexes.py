@@ -0,0 +1,21 @@
+# Generated by Django 6.0.2 on 2026-10-18 12:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0004_alter_workshop_name'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='equipment',
+            index=models.Index(fields=['name', 'id'], name='equipment_name_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='equipment',
+            index=models.Index(fields=['created_at', 'id'], name='equipment_created_id_idx'),
+        ),
+    ]
@@ -0,0 +1,87 @@
+# Generated by Django 6.0.2 on 2026-10-18 13:02
+
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.db import migrations, models
+from django.utils.dateparse import parse_date
+
+TYPED_VALUE_FIELDS = {"number": "value_number", "date": "value_date", "boolean": "value_boolean"}
+BOOLEANS = {"true": True, "1": True, "yes": True, "да": True,
+            "false": False, "0": False, "no": False, "нет": False}
+
+
+def parse_value(value_type, raw):
+    """The parsing rules of the model at this point in history; ``ValueError`` if the text doesn't fit."""
+    raw = raw.strip()
+    if value_type == "number":
+        try:
+            number = Decimal(raw.replace(" ", "").replace(",", "."))
+        except InvalidOperation:
+            raise ValueError(raw)
+        if not number.is_finite() or number.adjusted() >= 18:
+            raise ValueError(raw)
+        return number
+    if value_type == "date":
+        return parse_date(raw) or datetime.strptime(raw, "%d.%m.%Y").date()
+    return BOOLEANS[raw.lower()]
+
+
+def backfill_typed_values(apps, schema_editor):
+    EquipmentCharacteristicValue = apps.get_model("catalog", "EquipmentCharacteristicValue")
+    values = (
+        EquipmentCharacteristicValue.objects
+        .filter(characteristic__value_type__in=TYPED_VALUE_FIELDS)
+        .select_related("characteristic")
+        .only("id", "value", "characteristic__value_type")
+    )
+    batch = []
+    for value in values.iterator(chunk_size=2000):
+        value_type = value.characteristic.value_type
+        try:
+            setattr(value, TYPED_VALUE_FIELDS[value_type], parse_value(value_type, value.value))
+        except (KeyError, ValueError):
+            continue
+        batch.append(value)
+        if len(batch) >= 2000:
+            EquipmentCharacteristicValue.objects.bulk_update(batch, list(TYPED_VALUE_FIELDS.values()))
+            batch = []
+    EquipmentCharacteristicValue.objects.bulk_update(batch, list(TYPED_VALUE_FIELDS.values()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0006_equipment_trigram_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='equipmentcharacteristicvalue',
+            name='value_boolean',
+            field=models.BooleanField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='equipmentcharacteristicvalue',
+            name='value_date',
+            field=models.DateField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='equipmentcharacteristicvalue',
+            name='value_number',
+            field=models.DecimalField(blank=True, decimal_places=6, editable=False, max_digits=24, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='equipmentcharacteristicvalue',
+            index=models.Index(fields=['characteristic', 'value_number'], name='char_value_number_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='equipmentcharacteristicvalue',
+            index=models.Index(fields=['characteristic', 'value_date'], name='char_value_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='equipmentcharacteristicvalue',
+            index=models.Index(fields=['characteristic', 'value_boolean'], name='char_value_boolean_idx'),
+        ),
+        migrations.RunPython(backfill_typed_values, migrations.RunPython.noop),
+    ]
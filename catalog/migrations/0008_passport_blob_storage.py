@@ -0,0 +1,43 @@
+# Generated by Django 6.0.2 on 2026-10-18 13:05
+
+import catalog.storage
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0007_characteristic_typed_values'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='equipment',
+            name='passport_scan',
+            field=models.FileField(blank=True, null=True, storage=catalog.storage.passport_storage, upload_to='passports/'),
+        ),
+        migrations.CreateModel(
+            name='PassportUpload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('filename', models.CharField(max_length=255)),
+                ('size', models.BigIntegerField()),
+                ('offset', models.BigIntegerField(default=0)),
+                ('sha256', models.CharField(blank=True, max_length=64)),
+                ('blob', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True, db_index=True)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+                ('equipment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='passport_uploads', to='catalog.equipment')),
+            ],
+            options={
+                'verbose_name': 'Загрузка паспорта',
+                'verbose_name_plural': 'Загрузки паспортов',
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 6.0.2 on 2026-10-18 13:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def populate_counters(apps, schema_editor):
+    Equipment = apps.get_model("catalog", "Equipment")
+    EquipmentCounter = apps.get_model("catalog", "EquipmentCounter")
+    groups = Equipment.objects.order_by().values("workshop_id", "equipment_type_id").annotate(count=Count("id"))
+    EquipmentCounter.objects.bulk_create([EquipmentCounter(**group) for group in groups], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0008_passport_blob_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EquipmentCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.BigIntegerField(default=0)),
+                ('equipment_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='equipment_counters', to='catalog.equipmenttype')),
+                ('workshop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='equipment_counters', to='catalog.workshop')),
+            ],
+            options={
+                'verbose_name': 'Счётчик оборудования',
+                'verbose_name_plural': 'Счётчики оборудования',
+                'unique_together': {('workshop', 'equipment_type')},
+            },
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 6.0.2 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0009_equipment_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThrottleBucket',
+            fields=[
+                ('key', models.CharField(max_length=150, primary_key=True, serialize=False)),
+                ('tokens', models.FloatField()),
+                ('updated_at', models.FloatField(db_index=True)),
+                ('allowed', models.BooleanField(default=True)),
+            ],
+            options={
+                'verbose_name': 'Лимит запросов',
+                'verbose_name_plural': 'Лимиты запросов',
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 6.0.2 on 2026-10-18 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0010_throttle_buckets'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=32)),
+                ('object_id', models.BigIntegerField()),
+                ('changed_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'verbose_name': 'Изменение для синхронизации',
+                'verbose_name_plural': 'Изменения для синхронизации',
+            },
+        ),
+    ]
@@ -0,0 +1,82 @@
+# Generated by Django 6.0.2 on 2026-10-18 15:50
+
+from datetime import timedelta
+
+import django.core.serializers.json
+import django.utils.timezone
+from django.db import migrations, models
+
+# Partitions created with the table; later ones come from create_history_partitions.
+PARTITION_MONTHS = 3
+
+
+def create_history_table(apps, schema_editor):
+    model = apps.get_model("catalog", "EquipmentHistory")
+    if schema_editor.connection.vendor != "postgresql":
+        schema_editor.create_model(model)
+        return
+    # Range partitions need the partition key in the primary key.
+    schema_editor.execute(
+        "CREATE TABLE catalog_equipmenthistory ("
+        "id bigint GENERATED BY DEFAULT AS IDENTITY, "
+        "equipment_id bigint NOT NULL, "
+        "changed_at timestamp with time zone NOT NULL, "
+        "action varchar(10) NOT NULL, "
+        "source varchar(20) NOT NULL, "
+        "user_id bigint NULL, "
+        "username varchar(150) NOT NULL, "
+        "changes jsonb NOT NULL, "
+        "PRIMARY KEY (id, changed_at)"
+        ") PARTITION BY RANGE (changed_at)"
+    )
+    schema_editor.execute(
+        "CREATE INDEX equipment_history_idx ON catalog_equipmenthistory (equipment_id, id)"
+    )
+    schema_editor.execute(
+        "CREATE TABLE catalog_equipmenthistory_default PARTITION OF catalog_equipmenthistory DEFAULT"
+    )
+    start = django.utils.timezone.now().date().replace(day=1)
+    for _ in range(PARTITION_MONTHS + 1):
+        end = (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+        schema_editor.execute(
+            f"CREATE TABLE catalog_equipmenthistory_{start:%Y_%m} PARTITION OF catalog_equipmenthistory "
+            f"FOR VALUES FROM ('{start.isoformat()} 00:00+00') TO ('{end.isoformat()} 00:00+00')"
+        )
+        start = end
+
+
+def drop_history_table(apps, schema_editor):
+    schema_editor.delete_model(apps.get_model("catalog", "EquipmentHistory"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0011_sync_changes'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='EquipmentHistory',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('equipment_id', models.BigIntegerField()),
+                        ('changed_at', models.DateTimeField(default=django.utils.timezone.now)),
+                        ('action', models.CharField(choices=[('create', 'Создание'), ('update', 'Изменение'), ('delete', 'Удаление')], max_length=10)),
+                        ('source', models.CharField(max_length=20)),
+                        ('user_id', models.BigIntegerField(blank=True, null=True)),
+                        ('username', models.CharField(blank=True, max_length=150)),
+                        ('changes', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                    ],
+                    options={
+                        'verbose_name': 'Запись истории оборудования',
+                        'verbose_name_plural': 'История оборудования',
+                        'indexes': [models.Index(fields=['equipment_id', 'id'], name='equipment_history_idx')],
+                    },
+                ),
+            ],
+        ),
+        migrations.RunPython(create_history_table, drop_history_table),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 6.0.2 on 2026-10-18 16:40
+
+from django.db import migrations, models
+
+
+def set_txid_default(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    # Every entry records the transaction that wrote it; the feed only serves
+    # entries of transactions older than the oldest one still running.
+    schema_editor.execute(
+        "ALTER TABLE catalog_syncchange ALTER COLUMN txid SET DEFAULT pg_current_xact_id()::text::bigint"
+    )
+
+
+def reset_txid_default(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute("ALTER TABLE catalog_syncchange ALTER COLUMN txid SET DEFAULT 0")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0013_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncchange',
+            name='txid',
+            field=models.BigIntegerField(db_default=0),
+        ),
+        migrations.AddIndex(
+            model_name='syncchange',
+            index=models.Index(fields=['txid', 'id'], name='sync_change_position_idx'),
+        ),
+        migrations.RunPython(set_txid_default, reset_txid_default),
+    ]
@@ -1,4 +1,44 @@
+import uuid
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .storage import passport_storage
+
+BOOLEAN_TRUE = {"true", "1", "yes", "да"}
+BOOLEAN_FALSE = {"false", "0", "no", "нет"}
+
+
+def parse_characteristic_value(value_type, raw):
+    """Convert the text form of a characteristic value to its declared type."""
+    raw = raw.strip()
+    if value_type == Characteristic.VALUE_TYPE_NUMBER:
+        try:
+            number = Decimal(raw.replace(" ", "").replace(",", "."))
+        except InvalidOperation:
+            number = None
+        if number is None or not number.is_finite() or number.adjusted() >= 18:
+            raise ValidationError(f"\"{raw}\" is not a number.")
+        return number
+    if value_type == Characteristic.VALUE_TYPE_DATE:
+        try:
+            parsed = parse_date(raw) or datetime.strptime(raw, "%d.%m.%Y").date()
+        except ValueError:
+            raise ValidationError(f"\"{raw}\" is not a date, expected YYYY-MM-DD or DD.MM.YYYY.")
+        return parsed
+    if value_type == Characteristic.VALUE_TYPE_BOOLEAN:
+        if raw.lower() in BOOLEAN_TRUE:
+            return True
+        if raw.lower() in BOOLEAN_FALSE:
+            return False
+        raise ValidationError(f"\"{raw}\" is not a boolean.")
+    return raw
 
 
 class Site(models.Model):
@@ -49,6 +89,11 @@ class Characteristic(models.Model):
         (VALUE_TYPE_DATE, "Дата"),
         (VALUE_TYPE_BOOLEAN, "Логическое"),
     ]
+    TYPED_VALUE_FIELDS = {
+        VALUE_TYPE_NUMBER: "value_number",
+        VALUE_TYPE_DATE: "value_date",
+        VALUE_TYPE_BOOLEAN: "value_boolean",
+    }
 
     name = models.CharField(max_length=255)
     equipment_type = models.ForeignKey(EquipmentType, on_delete=models.CASCADE, related_name="characteristics")
@@ -61,6 +106,25 @@ class Characteristic(models.Model):
     def __str__(self):
         return f"{self.name} ({self.equipment_type.name})"
 
+    def save(self, *args, **kwargs):
+        previous = None
+        if self.pk:
+            previous = Characteristic.objects.filter(pk=self.pk).values_list("value_type", flat=True).first()
+        super().save(*args, **kwargs)
+        if previous is not None and previous != self.value_type:
+            self.retype_values()
+
+    def retype_values(self, batch_size=1000):
+        """Re-derive the typed columns of all values, e.g. after ``value_type`` changed."""
+        batch = []
+        for value in self.values.only("id", "value").iterator(chunk_size=batch_size):
+            value.assign_typed_value(self.value_type, strict=False)
+            batch.append(value)
+            if len(batch) >= batch_size:
+                EquipmentCharacteristicValue.objects.bulk_update(batch, EquipmentCharacteristicValue.TYPED_FIELDS)
+                batch = []
+        EquipmentCharacteristicValue.objects.bulk_update(batch, EquipmentCharacteristicValue.TYPED_FIELDS)
+
 
 class Equipment(models.Model):
     name = models.CharField(max_length=255, db_index=True)
@@ -68,26 +132,249 @@ class Equipment(models.Model):
     equipment_type = models.ForeignKey(EquipmentType, on_delete=models.PROTECT, related_name="equipments")
     workshop = models.ForeignKey(Workshop, on_delete=models.PROTECT, related_name="equipments")
     parent = models.ForeignKey("self", on_delete=models.CASCADE, null=True, blank=True, related_name="children")
-    passport_scan = models.FileField(upload_to="passports/", null=True, blank=True)
+    passport_scan = models.FileField(upload_to="passports/", storage=passport_storage, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ["name"]
+        indexes = [
+            models.Index(fields=["name", "id"], name="equipment_name_id_idx"),
+            models.Index(fields=["created_at", "id"], name="equipment_created_id_idx"),
+        ]
 
     def __str__(self):
         return f"{self.name} ({self.inventory_number})"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Column values as loaded, so signal handlers can tell what a save changed.
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+
+class EquipmentCounter(models.Model):
+    """Number of equipment items per workshop and type, maintained by ``catalog.stats``."""
+    workshop = models.ForeignKey(Workshop, on_delete=models.CASCADE, related_name="equipment_counters")
+    equipment_type = models.ForeignKey(EquipmentType, on_delete=models.CASCADE, related_name="equipment_counters")
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ("workshop", "equipment_type")
+        verbose_name = "Счётчик оборудования"
+        verbose_name_plural = "Счётчики оборудования"
+
+    def __str__(self):
+        return f"{self.workshop} / {self.equipment_type}: {self.count}"
+
 
 class EquipmentCharacteristicValue(models.Model):
     equipment = models.ForeignKey(Equipment, on_delete=models.CASCADE, related_name="characteristic_values")
     characteristic = models.ForeignKey(Characteristic, on_delete=models.CASCADE, related_name="values")
     value = models.TextField()
+    value_number = models.DecimalField(max_digits=24, decimal_places=6, null=True, blank=True, editable=False)
+    value_date = models.DateField(null=True, blank=True, editable=False)
+    value_boolean = models.BooleanField(null=True, blank=True, editable=False)
+
+    TYPED_FIELDS = ["value_number", "value_date", "value_boolean"]
 
     class Meta:
         unique_together = ("equipment", "characteristic")
         verbose_name = "Значение характеристики"
         verbose_name_plural = "Значения характеристик"
+        indexes = [
+            models.Index(fields=["characteristic", "value_number"], name="char_value_number_idx"),
+            models.Index(fields=["characteristic", "value_date"], name="char_value_date_idx"),
+            models.Index(fields=["characteristic", "value_boolean"], name="char_value_boolean_idx"),
+        ]
 
     def __str__(self):
         return f"{self.equipment.name} - {self.characteristic.name}: {self.value}"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def assign_typed_value(self, value_type=None, strict=True):
+        """Fill the typed column matching ``value_type`` from ``value``; the others are cleared."""
+        value_type = value_type or self.characteristic.value_type
+        for field in self.TYPED_FIELDS:
+            setattr(self, field, None)
+        field = Characteristic.TYPED_VALUE_FIELDS.get(value_type)
+        if field is None:
+            return
+        try:
+            setattr(self, field, parse_characteristic_value(value_type, self.value))
+        except ValidationError:
+            if strict:
+                raise
+
+    def clean(self):
+        if self.characteristic_id is None:
+            return
+        try:
+            self.assign_typed_value()
+        except ValidationError as exc:
+            raise ValidationError({"value": exc.messages})
+
+    def save(self, *args, **kwargs):
+        self.assign_typed_value()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "value" in update_fields:
+            kwargs["update_fields"] = {*update_fields, *self.TYPED_FIELDS}
+        super().save(*args, **kwargs)
+
+
+class PassportUpload(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    sha256 = models.CharField(max_length=64, blank=True)
+    equipment = models.ForeignKey(
+        Equipment, on_delete=models.CASCADE, null=True, blank=True, related_name="passport_uploads"
+    )
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
+    blob = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Загрузка паспорта"
+        verbose_name_plural = "Загрузки паспортов"
+
+    def __str__(self):
+        return f"{self.filename} ({self.offset}/{self.size})"
+
+    @property
+    def part_name(self):
+        return f"{self.id}.part"
+
+
+class ThrottleBucket(models.Model):
+    """Token bucket of one API client, updated in place by ``catalog.throttling``."""
+    key = models.CharField(max_length=150, primary_key=True)
+    tokens = models.FloatField()
+    updated_at = models.FloatField(db_index=True)
+    allowed = models.BooleanField(default=True)
+
+    class Meta:
+        verbose_name = "Лимит запросов"
+        verbose_name_plural = "Лимиты запросов"
+
+    def __str__(self):
+        return f"{self.key}: {self.tokens:.2f}"
+
+
+class SyncChange(models.Model):
+    """
+    One entry of the sync feed: object ``object_id`` of ``kind`` changed or was
+    deleted. ``(txid, id)`` is the entry's position in the feed and makes up
+    the sync token; the current state (or absence) of the object is resolved
+    when the feed is read.
+    """
+    kind = models.CharField(max_length=32)
+    object_id = models.BigIntegerField()
+    # Id of the writing transaction: a PostgreSQL column default (migration 0014), 0 elsewhere.
+    txid = models.BigIntegerField(db_default=0)
+    changed_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name = "Изменение для синхронизации"
+        verbose_name_plural = "Изменения для синхронизации"
+        indexes = [
+            models.Index(fields=["txid", "id"], name="sync_change_position_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.id}: {self.kind} {self.object_id}"
+
+
+class EquipmentHistory(models.Model):
+    """
+    Append-only change log of one equipment item: ``changes`` maps field names
+    (``characteristic:<id>`` for characteristic values) to ``[old, new]``.
+    Written in batches by ``catalog.history``; on PostgreSQL the table is
+    partitioned by month of ``changed_at``.
+    """
+    ACTION_CREATE = "create"
+    ACTION_UPDATE = "update"
+    ACTION_DELETE = "delete"
+    ACTION_CHOICES = [
+        (ACTION_CREATE, "Создание"),
+        (ACTION_UPDATE, "Изменение"),
+        (ACTION_DELETE, "Удаление"),
+    ]
+
+    # No foreign keys: entries outlive their equipment and user, and partitioned tables stay simple.
+    equipment_id = models.BigIntegerField()
+    changed_at = models.DateTimeField(default=timezone.now)
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    source = models.CharField(max_length=20)
+    user_id = models.BigIntegerField(null=True, blank=True)
+    username = models.CharField(max_length=150, blank=True)
+    changes = models.JSONField(encoder=DjangoJSONEncoder)
+
+    class Meta:
+        verbose_name = "Запись истории оборудования"
+        verbose_name_plural = "История оборудования"
+        indexes = [
+            models.Index(fields=["equipment_id", "id"], name="equipment_history_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.equipment_id} {self.action} {self.changed_at:%Y-%m-%d %H:%M}"
+
+
+class Job(models.Model):
+    """
+    One background operation of ``kind`` (see ``catalog.jobs``) with its
+    parameters, progress and outcome. Workers of ``manage.py run_workers``
+    claim queued jobs with ``SELECT ... FOR UPDATE SKIP LOCKED``.
+    """
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_SUCCEEDED = "succeeded"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, "В очереди"),
+        (STATUS_RUNNING, "Выполняется"),
+        (STATUS_SUCCEEDED, "Выполнено"),
+        (STATUS_FAILED, "Ошибка"),
+    ]
+
+    kind = models.CharField(max_length=50)
+    params = models.JSONField(default=dict, blank=True, encoder=DjangoJSONEncoder)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=1)
+    run_after = models.DateTimeField(default=timezone.now)
+    progress_done = models.BigIntegerField(default=0)
+    progress_total = models.BigIntegerField(null=True, blank=True)
+    progress_message = models.CharField(max_length=255, blank=True)
+    result = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=100, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Фоновая задача"
+        verbose_name_plural = "Фоновые задачи"
+        indexes = [
+            # Workers only look at queued jobs: the index stays as small as the queue.
+            models.Index(
+                fields=["run_after", "id"], name="job_queue_idx", condition=models.Q(status="queued")
+            ),
+            models.Index(fields=["status", "heartbeat_at"], name="job_status_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.id}: {self.kind} ({self.status})"
@@ -0,0 +1,289 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import date, datetime
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.paginator import InvalidPage
+from django.db import connections
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+def positive_int(value, cutoff=None):
+    """Parse a positive integer query parameter, capped at ``cutoff``; ``ValueError`` otherwise."""
+    value = int(value)
+    if value <= 0:
+        raise ValueError(value)
+    return min(value, cutoff) if cutoff else value
+
+
+def estimate_count(queryset):
+    """Row estimate from the PostgreSQL planner, ``None`` on other backends."""
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return None
+    sql, params = queryset.order_by().query.get_compiler(using=queryset.db).as_sql()
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def _invert(field):
+    return field[1:] if field.startswith("-") else f"-{field}"
+
+
+def _position_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset pagination over the view ordering with an ``id`` tie-breaker.
+
+    Pages are fetched with ``WHERE (field, id) > (last_field, last_id)``-style
+    predicates, so neither ``COUNT(*)`` nor ``OFFSET`` is executed. The total is
+    only returned on request, as a planner estimate.
+    """
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    total_query_param = "include_total"
+    ordering = ("name",)
+    tie_breaker = "id"
+    invalid_cursor_message = "Invalid cursor"
+
+    def get_page_size(self, request):
+        try:
+            return positive_int(request.query_params[self.page_size_query_param], settings.CATALOG_MAX_PAGE_SIZE)
+        except (KeyError, ValueError):
+            return api_settings.PAGE_SIZE
+
+    def get_ordering(self, request, queryset, view):
+        ordering = None
+        for backend in getattr(view, "filter_backends", []):
+            if hasattr(backend, "get_ordering"):
+                ordering = backend().get_ordering(request, queryset, view)
+                break
+        ordering = [
+            field.replace("pk", self.tie_breaker) if field.lstrip("-") == "pk" else field
+            for field in ordering or self.ordering
+        ]
+        if ordering[-1].lstrip("-") != self.tie_breaker:
+            descending = ordering[-1].startswith("-")
+            ordering.append(f"-{self.tie_breaker}" if descending else self.tie_breaker)
+        return ordering
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return False, None
+        try:
+            tokens = json.loads(urlsafe_b64decode(encoded.encode("ascii")))
+            position = tokens["p"]
+            if not isinstance(position, list) or len(position) != len(self.order):
+                raise ValueError
+            return bool(tokens.get("r")), position
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def clean_position(self, queryset, position):
+        """Cursor values converted for their model fields; a tampered value is an invalid cursor, not a 500."""
+        cleaned = []
+        for field, value in zip(self.order, position):
+            try:
+                model_field = queryset.model._meta.get_field(field.lstrip("-"))
+            except FieldDoesNotExist:
+                cleaned.append(value)
+                continue
+            try:
+                if value is None or isinstance(value, (list, dict)):
+                    raise TypeError(value)
+                cleaned.append(model_field.get_prep_value(model_field.to_python(value)))
+            except (ValidationError, TypeError, ValueError):
+                raise NotFound(self.invalid_cursor_message)
+        return cleaned
+
+    def encode_cursor(self, row, reverse):
+        position = [_position_value(self._get_value(row, field.lstrip("-"))) for field in self.order]
+        tokens = {"p": position}
+        if reverse:
+            tokens["r"] = 1
+        encoded = urlsafe_b64encode(json.dumps(tokens).encode("ascii")).decode("ascii")
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def _get_value(self, row, field):
+        return row[field] if isinstance(row, dict) else getattr(row, field)
+
+    def _after(self, ordering, position):
+        first = ordering[0]
+        bound = Q(**{f"{first.lstrip('-')}__{'lte' if first.startswith('-') else 'gte'}": position[0]})
+        condition = Q()
+        for index, field in enumerate(ordering):
+            lookup = "lt" if field.startswith("-") else "gt"
+            term = Q(**{f"{field.lstrip('-')}__{lookup}": position[index]})
+            for previous, value in zip(ordering[:index], position):
+                term &= Q(**{previous.lstrip("-"): value})
+            condition |= term
+        return bound & condition
+
+    def _page_queryset(self, queryset, request, view):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.order = self.get_ordering(request, queryset, view)
+        self.reverse, self.position = self.decode_cursor(request)
+
+        ordering = [_invert(field) for field in self.order] if self.reverse else self.order
+        page_queryset = queryset.order_by(*ordering)
+        if self.position is not None:
+            position = self.clean_position(queryset, self.position)
+            try:
+                page_queryset = page_queryset.filter(self._after(ordering, position))
+            except (TypeError, ValueError):
+                raise NotFound(self.invalid_cursor_message)
+        return page_queryset[:self.page_size + 1]
+
+    def _wants_total(self, request):
+        return request.query_params.get(self.total_query_param) in ("1", "true")
+
+    def _set_page(self, rows):
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if self.reverse:
+            rows.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.position is not None
+        self.page = rows
+        return rows
+
+    def paginate_queryset(self, queryset, request, view=None):
+        rows = list(self._page_queryset(queryset, request, view))
+        self.approximate_count = estimate_count(queryset) if self._wants_total(request) else None
+        return self._set_page(rows)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        rows = [row async for row in self._page_queryset(queryset, request, view)]
+        self.approximate_count = None
+        if self._wants_total(request):
+            self.approximate_count = await sync_to_async(estimate_count)(queryset)
+        return self._set_page(rows)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        payload = {
+            "next": self.get_next_link(),
+            "previous": self.get_previous_link(),
+            "results": data,
+        }
+        if self._wants_total(self.request):
+            payload["approximate_count"] = self.approximate_count
+        return Response(payload)
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                "name": self.cursor_query_param,
+                "required": False,
+                "in": "query",
+                "description": "Keyset cursor from the next/previous links.",
+                "schema": {"type": "string"},
+            },
+            {
+                "name": self.page_size_query_param,
+                "required": False,
+                "in": "query",
+                "description": "Number of results to return per page.",
+                "schema": {"type": "integer"},
+            },
+            {
+                "name": self.total_query_param,
+                "required": False,
+                "in": "query",
+                "description": "Return approximate_count estimated by the database planner.",
+                "schema": {"type": "boolean"},
+            },
+        ]
+
+
+class AsyncPageNumberPagination(PageNumberPagination):
+    """``PageNumberPagination`` that can also count and fetch the page with the async ORM."""
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+
+        paginator = self.django_paginator_class(queryset, page_size)
+        paginator.count = await queryset.acount()
+        page_number = self.get_page_number(request, paginator)
+        try:
+            self.page = paginator.page(page_number)
+        except InvalidPage as exc:
+            raise NotFound(self.invalid_page_message.format(page_number=page_number, message=str(exc)))
+        self.page.object_list = [row async for row in self.page.object_list]
+        if paginator.num_pages > 1 and self.template is not None:
+            self.display_page_controls = True
+        return list(self.page)
+
+
+class EquipmentPagination(AsyncPageNumberPagination):
+    """Page numbers by default, keyset pages with ``?pagination=cursor`` or ``?cursor=``."""
+    mode_query_param = "pagination"
+    keyset_class = KeysetPagination
+
+    def _use_keyset(self, request):
+        params = request.query_params
+        self.keyset = None
+        if params.get(self.mode_query_param) == "cursor" or self.keyset_class.cursor_query_param in params:
+            self.keyset = self.keyset_class()
+        return self.keyset is not None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self._use_keyset(request):
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        if self._use_keyset(request):
+            return await self.keyset.apaginate_queryset(queryset, request, view)
+        return await super().apaginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+    def get_schema_operation_parameters(self, view):
+        mode = {
+            "name": self.mode_query_param,
+            "required": False,
+            "in": "query",
+            "description": "Set to 'cursor' for keyset pagination without COUNT(*).",
+            "schema": {"type": "string", "enum": ["page", "cursor"]},
+        }
+        return [
+            *super().get_schema_operation_parameters(view),
+            mode,
+            *self.keyset_class().get_schema_operation_parameters(view),
+        ]
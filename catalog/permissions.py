@@ -1,16 +1,28 @@
 from rest_framework.permissions import BasePermission
 
+from .roles import ROLE_ADMIN, ROLE_MANAGER, ROLE_VIEWER, get_user_roles
+
 
 class RolesPermissions(BasePermission):
     def has_permission(self, request, view):
         if not request.user.is_authenticated:
             return False
-        if request.user.groups.filter(name="Admin").exists():
+        roles = get_user_roles(request.user)
+        if ROLE_ADMIN in roles:
             return True
-        if request.user.groups.filter(name="Manager").exists():
+        if ROLE_MANAGER in roles:
             if request.method == "DELETE":
                 return False
             return True
-        if request.user.groups.filter(name="Viewer").exists():
-            return request.method in ["GET"]
+        if ROLE_VIEWER in roles:
+            return request.method in ["GET"] or getattr(view, "action", None) in getattr(view, "read_only_actions", ())
         return False
+
+
+class JobPermissions(RolesPermissions):
+    """Any catalog role may submit jobs; which kinds it may submit is checked by ``JobSerializer``."""
+
+    def has_permission(self, request, view):
+        if request.method == "POST" and getattr(view, "action", None) == "create":
+            return bool(get_user_roles(request.user))
+        return super().has_permission(request, view)
@@ -0,0 +1,131 @@
+import hashlib
+import logging
+import os
+import subprocess
+import tempfile
+
+from django.conf import settings
+from django.urls import reverse
+
+from .models import Equipment
+
+logger = logging.getLogger("catalog.previews")
+
+PREVIEW_SUFFIX = ".preview.jpg"
+FAILED_SUFFIX = ".preview.failed"
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tif", ".tiff", ".webp"}
+PDF_EXTENSIONS = {".pdf"}
+
+READY = "ready"
+FAILED = "failed"
+MISSING = "missing"
+
+
+class PreviewError(Exception):
+    """The scan cannot be previewed, however often it is tried."""
+
+
+def _storage():
+    return Equipment._meta.get_field("passport_scan").storage
+
+
+def preview_name(name):
+    """Previews are cached next to their scan: ``<scan name>.preview.jpg``."""
+    return f"{name}{PREVIEW_SUFFIX}"
+
+
+def can_preview(name):
+    extension = os.path.splitext(name or "")[1].lower()
+    return extension in IMAGE_EXTENSIONS or extension in PDF_EXTENSIONS
+
+
+def preview_url(equipment_id, name, request=None):
+    """URL of the preview endpoint; the scan name is part of it so a new scan gets a new URL."""
+    if not can_preview(name):
+        return None
+    version = hashlib.sha1(name.encode()).hexdigest()[:12]
+    url = f"{reverse('equipment-passport-preview', kwargs={'pk': equipment_id})}?v={version}"
+    return request.build_absolute_uri(url) if request is not None else url
+
+
+def preview_state(name):
+    """``READY``, ``FAILED`` or ``MISSING``: a preview or failure marker only counts if not older than the scan."""
+    storage = _storage()
+    try:
+        source_mtime = os.path.getmtime(storage.path(name))
+    except OSError:
+        return FAILED
+    for suffix, state in ((PREVIEW_SUFFIX, READY), (FAILED_SUFFIX, FAILED)):
+        try:
+            if os.path.getmtime(storage.path(f"{name}{suffix}")) >= source_mtime:
+                return state
+        except OSError:
+            pass
+    return MISSING
+
+
+def _open_scan(path):
+    from PIL import Image, ImageOps
+
+    if os.path.getsize(path) > settings.CATALOG_PREVIEW_MAX_SIZE:
+        raise PreviewError(f"The scan is larger than {settings.CATALOG_PREVIEW_MAX_SIZE} bytes.")
+    size = settings.CATALOG_PREVIEW_SIZE
+    if os.path.splitext(path)[1].lower() in PDF_EXTENSIONS:
+        # Pillow cannot render PDF pages; poppler's pdftoppm rasterizes the first one.
+        with tempfile.TemporaryDirectory() as directory:
+            prefix = os.path.join(directory, "page")
+            subprocess.run(
+                ["pdftoppm", "-f", "1", "-l", "1", "-singlefile", "-jpeg", "-scale-to", str(size * 2), path, prefix],
+                check=True, capture_output=True, timeout=settings.CATALOG_PREVIEW_TIMEOUT,
+            )
+            with Image.open(f"{prefix}.jpg") as page:
+                page.load()
+                return page.copy()
+    # Opening only reads the header: refuse decompression bombs before any pixel is decoded.
+    image = Image.open(path)
+    if image.width * image.height > settings.CATALOG_PREVIEW_MAX_PIXELS:
+        image.close()
+        raise PreviewError(f"The scan has more than {settings.CATALOG_PREVIEW_MAX_PIXELS} pixels.")
+    # JPEG decoders can downscale while decoding, far cheaper than resizing the full image.
+    image.draft("RGB", (size, size))
+    return ImageOps.exif_transpose(image)
+
+
+def _is_permanent(exc):
+    """Whether trying the same scan again would fail the same way, unlike e.g. a pdftoppm timeout."""
+    from PIL import Image, UnidentifiedImageError
+
+    if isinstance(exc, (PreviewError, UnidentifiedImageError, Image.DecompressionBombError, SyntaxError)):
+        return True
+    if isinstance(exc, subprocess.CalledProcessError):
+        # pdftoppm rejected the file.
+        return True
+    # Pillow reports undecodable data as OSError without an errno; real I/O errors carry one.
+    return isinstance(exc, OSError) and exc.errno is None
+
+
+def generate_preview(name):
+    """
+    Write the JPEG preview of the scan ``name`` (first page of a PDF,
+    downscaled image) next to it. When the scan itself cannot be previewed a
+    marker file is left instead, so it is not retried until it changes;
+    other errors, such as a timeout, are raised for the caller to retry.
+    """
+    storage = _storage()
+    target = storage.path(preview_name(name))
+    temporary = f"{target}.{os.getpid()}.tmp"
+    try:
+        image = _open_scan(storage.path(name))
+        size = settings.CATALOG_PREVIEW_SIZE
+        image.thumbnail((size, size))
+        image.convert("RGB").save(temporary, "JPEG", quality=80, optimize=True)
+        os.replace(temporary, target)
+    except Exception as exc:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        if not _is_permanent(exc):
+            raise
+        logger.warning("Cannot build a preview of %s", name, exc_info=True)
+        open(storage.path(f"{name}{FAILED_SUFFIX}"), "w").close()
+        return False
+    return True
@@ -0,0 +1,18 @@
+ROLE_ADMIN = "Admin"
+ROLE_MANAGER = "Manager"
+ROLE_VIEWER = "Viewer"
+ROLES = (ROLE_ADMIN, ROLE_MANAGER, ROLE_VIEWER)
+
+
+def get_user_roles(user):
+    """
+    Role group names of ``user``, resolved with one query and reused from the
+    user instance for the rest of the request.
+    """
+    if not user.is_authenticated:
+        return frozenset()
+    roles = getattr(user, "_catalog_roles", None)
+    if roles is None:
+        roles = frozenset(user.groups.filter(name__in=ROLES).values_list("name", flat=True))
+        user._catalog_roles = roles
+    return roles
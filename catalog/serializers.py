@@ -1,5 +1,22 @@
+import json
+import os
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Prefetch
+from django.urls import reverse
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import extend_schema_field
 from rest_framework import serializers
-from .models import Site, Workshop, EquipmentType, Equipment
+from rest_framework.exceptions import PermissionDenied
+from .jobs import JOB_KINDS, enqueue, job_file
+from .models import (
+    Site, Workshop, EquipmentType, Characteristic, Equipment, EquipmentCharacteristicValue, EquipmentHistory,
+    Job, PassportUpload,
+)
+from .previews import preview_url
+from .roles import get_user_roles
+from .storage import job_storage
 
 
 class SiteSerializer(serializers.ModelSerializer):
@@ -24,17 +41,346 @@ class EquipmentTypeSerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'characteristics']
 
 
+class CharacteristicSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Characteristic
+        fields = ['id', 'name', 'equipment_type', 'value_type']
+
+
+class EquipmentSummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Equipment
+        fields = ['id', 'name', 'inventory_number']
+
+
+class EquipmentCharacteristicReadSerializer(serializers.ModelSerializer):
+    name = serializers.CharField(source='characteristic.name', read_only=True)
+    value_type = serializers.CharField(source='characteristic.value_type', read_only=True)
+
+    class Meta:
+        model = EquipmentCharacteristicValue
+        fields = ['characteristic', 'name', 'value_type', 'value']
+
+
 class EquipmentSerializer(serializers.ModelSerializer):
+    """
+    Takes the ``fields`` to render and the relations to ``expand`` (see
+    ``EquipmentFieldSelection``); an expanded ``parent`` replaces the id with
+    a summary, ``characteristics`` and ``children`` are appended.
+    """
     equipment_type = serializers.PrimaryKeyRelatedField(queryset=EquipmentType.objects.all())
     workshop = serializers.PrimaryKeyRelatedField(queryset=Workshop.objects.all())
     parent = serializers.PrimaryKeyRelatedField(queryset=Equipment.objects.all(), allow_null=True, required=False)
     equipment_type_name = serializers.CharField(source='equipment_type.name', read_only=True)
     workshop_name = serializers.CharField(source='workshop.name', read_only=True)
     site_name = serializers.CharField(source='workshop.site.name', read_only=True)
+    passport_preview = serializers.SerializerMethodField()
 
     class Meta:
         model = Equipment
         fields = [
             'id', 'name', 'inventory_number', 'equipment_type', 'equipment_type_name',
-            'workshop', 'workshop_name', 'site_name', 'parent', 'created_at'
+            'workshop', 'workshop_name', 'site_name', 'parent', 'created_at', 'passport_preview'
         ]
+
+    def __init__(self, *args, fields=None, expand=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+        if 'characteristics' in expand:
+            self.fields['characteristics'] = EquipmentCharacteristicReadSerializer(
+                source='characteristic_values', many=True, read_only=True
+            )
+        if 'parent' in expand:
+            self.fields['parent'] = EquipmentSummarySerializer(read_only=True)
+        if 'children' in expand:
+            self.fields['children'] = EquipmentSummarySerializer(many=True, read_only=True)
+
+    @extend_schema_field(OpenApiTypes.URI)
+    def get_passport_preview(self, obj):
+        return preview_url(obj.pk, obj.passport_scan.name, self.context.get('request'))
+
+
+class EquipmentFieldSelection:
+    """
+    The output of an equipment read: ``?fields=`` picks serializer fields,
+    ``?expand=`` adds related data. ``apply()`` joins and prefetches only
+    what those render.
+    """
+    expansions = ('characteristics', 'parent', 'children')
+    joins = {
+        'equipment_type_name': 'equipment_type',
+        'workshop_name': 'workshop',
+        'site_name': 'workshop__site',
+    }
+
+    def __init__(self, fields=None, expand=()):
+        self.fields = [name for name in EquipmentSerializer.Meta.fields if fields is None or name in fields]
+        self.expand = [name for name in self.expansions if name in expand]
+
+    @classmethod
+    def from_params(cls, params):
+        def names(key, allowed):
+            requested = [name.strip() for name in params.get(key, '').split(',') if name.strip()]
+            unknown = [name for name in requested if name not in allowed]
+            if unknown:
+                raise serializers.ValidationError(
+                    {key: [f"Unknown: {', '.join(unknown)}. Expected some of: {', '.join(allowed)}."]}
+                )
+            return requested
+
+        return cls(names('fields', EquipmentSerializer.Meta.fields) or None, names('expand', cls.expansions))
+
+    def serializer_kwargs(self):
+        return {'fields': self.fields, 'expand': self.expand}
+
+    def apply(self, queryset):
+        related = [path for name, path in self.joins.items() if name in self.fields]
+        if 'parent' in self.expand:
+            related.append('parent')
+        if related:
+            queryset = queryset.select_related(*related)
+        prefetches = []
+        if 'characteristics' in self.expand:
+            prefetches.append(Prefetch(
+                'characteristic_values',
+                queryset=EquipmentCharacteristicValue.objects.select_related('characteristic')
+                .order_by('characteristic__name', 'id'),
+            ))
+        if 'children' in self.expand:
+            prefetches.append(Prefetch(
+                'children',
+                queryset=Equipment.objects.only('id', 'name', 'inventory_number', 'parent_id').order_by('name', 'id'),
+            ))
+        return queryset.prefetch_related(*prefetches) if prefetches else queryset
+
+
+class EquipmentListReader:
+    """
+    Renders list pages in exactly the shape of ``EquipmentSerializer`` from
+    ``values()`` rows, without building model instances or field objects per
+    row. Only ``created_at`` needs formatting, done by the serializer's own
+    field so the output stays byte-for-byte identical, and ``passport_preview``
+    is built by the same ``preview_url()`` as the serializer's. Expanded
+    characteristics and children take one more ``values()`` query each.
+    """
+    columns = {
+        'id': 'id',
+        'name': 'name',
+        'inventory_number': 'inventory_number',
+        'equipment_type': 'equipment_type_id',
+        'equipment_type_name': 'equipment_type__name',
+        'workshop': 'workshop_id',
+        'workshop_name': 'workshop__name',
+        'site_name': 'workshop__site__name',
+        'parent': 'parent_id',
+        'created_at': 'created_at',
+        'passport_preview': 'passport_scan',
+    }
+    # Always selected: the pagination reads the id and ordering columns from the rows.
+    key_columns = ('id', 'name', 'created_at')
+
+    def __init__(self, selection=None, request=None):
+        self.selection = selection or EquipmentFieldSelection()
+        self.request = request
+        self.created_at = EquipmentSerializer().fields['created_at'].to_representation
+
+    def get_queryset(self, queryset):
+        columns = {self.columns[name] for name in self.selection.fields} | set(self.key_columns)
+        if 'parent' in self.selection.expand:
+            columns |= {'parent_id', 'parent__name', 'parent__inventory_number'}
+        return queryset.prefetch_related(None).values(*columns)
+
+    def related_querysets(self, rows):
+        ids = [row['id'] for row in rows]
+        related = {}
+        if 'characteristics' in self.selection.expand:
+            related['characteristics'] = EquipmentCharacteristicValue.objects.filter(equipment_id__in=ids).order_by(
+                'characteristic__name', 'id'
+            ).values('equipment_id', 'characteristic_id', 'characteristic__name', 'characteristic__value_type', 'value')
+        if 'children' in self.selection.expand:
+            related['children'] = Equipment.objects.filter(parent_id__in=ids).order_by('name', 'id').values(
+                'parent_id', 'id', 'name', 'inventory_number'
+            )
+        return related
+
+    def to_representation(self, rows):
+        rows = list(rows)
+        related = {name: list(queryset) for name, queryset in self.related_querysets(rows).items()}
+        return self.build(rows, related)
+
+    async def ato_representation(self, rows):
+        rows = list(rows)
+        related = {name: [row async for row in queryset] for name, queryset in self.related_querysets(rows).items()}
+        return self.build(rows, related)
+
+    def build(self, rows, related):
+        columns = [(name, self.columns[name]) for name in self.selection.fields]
+        expand = self.selection.expand
+        characteristics, children = {}, {}
+        for value in related.get('characteristics', ()):
+            characteristics.setdefault(value['equipment_id'], []).append({
+                'characteristic': value['characteristic_id'],
+                'name': value['characteristic__name'],
+                'value_type': value['characteristic__value_type'],
+                'value': value['value'],
+            })
+        for child in related.get('children', ()):
+            children.setdefault(child['parent_id'], []).append(
+                {'id': child['id'], 'name': child['name'], 'inventory_number': child['inventory_number']}
+            )
+
+        created_at = self.created_at
+        data = []
+        for row in rows:
+            item = {name: row[column] for name, column in columns}
+            if 'created_at' in item:
+                item['created_at'] = created_at(item['created_at'])
+            if 'passport_preview' in item:
+                item['passport_preview'] = preview_url(row['id'], item['passport_preview'], self.request)
+            if expand:
+                if 'characteristics' in expand:
+                    item['characteristics'] = characteristics.get(row['id'], [])
+                if 'parent' in expand:
+                    item['parent'] = None if row['parent_id'] is None else {
+                        'id': row['parent_id'],
+                        'name': row['parent__name'],
+                        'inventory_number': row['parent__inventory_number'],
+                    }
+                if 'children' in expand:
+                    item['children'] = children.get(row['id'], [])
+            data.append(item)
+        return data
+
+
+class EquipmentLookupSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), required=False, default=list)
+    inventory_numbers = serializers.ListField(
+        child=serializers.CharField(max_length=100), required=False, default=list
+    )
+
+    def validate(self, attrs):
+        count = len(attrs['ids']) + len(attrs['inventory_numbers'])
+        if not count:
+            raise serializers.ValidationError('Expected ids or inventory_numbers.')
+        if count > settings.CATALOG_LOOKUP_MAX_ITEMS:
+            raise serializers.ValidationError(f'At most {settings.CATALOG_LOOKUP_MAX_ITEMS} keys per request.')
+        return attrs
+
+
+class EquipmentMoveSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False)
+    workshop = serializers.IntegerField(required=False)
+    parent = serializers.IntegerField(allow_null=True, required=False, help_text="null makes the items roots")
+    with_descendants = serializers.BooleanField(default=False)
+
+    def validate(self, attrs):
+        if 'workshop' not in attrs and 'parent' not in attrs:
+            raise serializers.ValidationError('Expected workshop and/or parent.')
+        if len(attrs['ids']) > settings.CATALOG_BULK_MAX_ITEMS:
+            raise serializers.ValidationError(f'At most {settings.CATALOG_BULK_MAX_ITEMS} ids per request.')
+        return attrs
+
+
+class EquipmentBulkValueSerializer(serializers.Serializer):
+    characteristic = serializers.IntegerField()
+    value = serializers.CharField(allow_blank=True)
+
+
+class EquipmentBulkItemSerializer(serializers.Serializer):
+    inventory_number = serializers.CharField(max_length=100)
+    name = serializers.CharField(max_length=255)
+    equipment_type = serializers.IntegerField()
+    workshop = serializers.IntegerField()
+    parent = serializers.IntegerField(allow_null=True, required=False)
+    parent_inventory_number = serializers.CharField(max_length=100, allow_null=True, required=False)
+    characteristic_values = EquipmentBulkValueSerializer(many=True, default=list)
+
+    def validate(self, attrs):
+        if attrs.get("parent") and attrs.get("parent_inventory_number"):
+            raise serializers.ValidationError("Use either parent or parent_inventory_number.")
+        return attrs
+
+
+class PassportUploadSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PassportUpload
+        fields = ['id', 'filename', 'size', 'offset', 'sha256', 'equipment', 'blob', 'created_at', 'completed_at']
+        read_only_fields = ['offset', 'blob', 'created_at', 'completed_at']
+
+    def validate_size(self, value):
+        if not 0 < value <= settings.CATALOG_UPLOAD_MAX_SIZE:
+            raise serializers.ValidationError(f"Size must be between 1 and {settings.CATALOG_UPLOAD_MAX_SIZE} bytes.")
+        return value
+
+
+class EquipmentHistorySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = EquipmentHistory
+        fields = ['id', 'changed_at', 'action', 'source', 'user_id', 'username', 'changes']
+
+
+class JobSerializer(serializers.ModelSerializer):
+    file = serializers.FileField(write_only=True, required=False, help_text="Input file of an import job")
+    download = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Job
+        fields = [
+            'id', 'kind', 'params', 'file', 'status', 'attempts', 'max_attempts', 'progress_done', 'progress_total',
+            'progress_message', 'result', 'error', 'download', 'created_at', 'started_at', 'finished_at',
+        ]
+        read_only_fields = [
+            'status', 'attempts', 'max_attempts', 'progress_done', 'progress_total', 'progress_message', 'result',
+            'error', 'created_at', 'started_at', 'finished_at',
+        ]
+
+    def validate_kind(self, value):
+        handler = JOB_KINDS.get(value)
+        if handler is None:
+            raise serializers.ValidationError(f"Unknown job kind. Expected one of: {', '.join(sorted(JOB_KINDS))}.")
+        if not get_user_roles(self.context['request'].user) & handler.roles:
+            raise PermissionDenied(f"Your role cannot submit {value} jobs.")
+        return value
+
+    def validate_params(self, value):
+        if isinstance(value, str):
+            # Multipart submissions (import jobs) send the parameters as a JSON string.
+            try:
+                value = json.loads(value)
+            except ValueError:
+                raise serializers.ValidationError("Expected a JSON object.")
+        if not isinstance(value, dict):
+            raise serializers.ValidationError("Expected an object.")
+        return value
+
+    def validate_file(self, value):
+        if value.size > settings.CATALOG_JOB_UPLOAD_MAX_SIZE:
+            raise serializers.ValidationError(f"At most {settings.CATALOG_JOB_UPLOAD_MAX_SIZE} bytes.")
+        return value
+
+    def validate(self, attrs):
+        # Input files only come from an upload, never from a storage name chosen by the client.
+        attrs['params'] = {key: value for key, value in attrs.get('params', {}).items() if key != 'file'}
+        if (attrs['kind'] == 'import') != ('file' in attrs):
+            raise serializers.ValidationError({'file': ['Required by import jobs and only accepted by them.']})
+        return attrs
+
+    def create(self, validated_data):
+        upload = validated_data.pop('file', None)
+        with transaction.atomic():
+            job = enqueue(validated_data['kind'], validated_data['params'], self.context['request'].user)
+            if upload is not None:
+                # Workers cannot see the job before the transaction commits, i.e. before the file is stored.
+                job.params['file'] = job_storage().save(job_file(job, os.path.basename(upload.name)), upload)
+                job.save(update_fields=['params'])
+        return job
+
+    @extend_schema_field(OpenApiTypes.URI)
+    def get_download(self, obj):
+        if obj.status != Job.STATUS_SUCCEEDED or not (obj.result or {}).get('file'):
+            return None
+        url = reverse('job-download', kwargs={'pk': obj.pk})
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request is not None else url
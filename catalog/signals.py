@@ -0,0 +1,193 @@
+from collections import Counter
+
+from django.contrib.auth import get_user_model
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.db.models.fields.files import FieldFile
+from django.dispatch import receiver
+
+from .cache import invalidate_reference
+from .history import characteristic_key, record_change
+from .jobs import schedule_preview
+from .models import (
+    Characteristic, Equipment, EquipmentCharacteristicValue, EquipmentHistory, EquipmentType, Site, Workshop
+)
+from .stats import adjust_counters
+from .sync import record_changes
+
+User = get_user_model()
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def user_groups_changed(sender, instance, action, reverse, **kwargs):
+    # Roles are memoized on the user instance; changing its groups re-resolves them.
+    if not reverse and action in ("post_add", "post_remove", "post_clear"):
+        instance.__dict__.pop("_catalog_roles", None)
+
+
+@receiver(post_save, sender=Site)
+@receiver(post_delete, sender=Site)
+@receiver(post_save, sender=Workshop)
+@receiver(post_delete, sender=Workshop)
+@receiver(post_save, sender=EquipmentType)
+@receiver(post_delete, sender=EquipmentType)
+@receiver(post_save, sender=Characteristic)
+@receiver(post_delete, sender=Characteristic)
+def reference_changed(sender, instance, **kwargs):
+    invalidate_reference(sender._meta.model_name)
+    record_changes(SYNC_KINDS[sender], [instance.pk])
+
+
+SYNC_KINDS = {
+    Site: "site",
+    Workshop: "workshop",
+    EquipmentType: "equipment_type",
+    Characteristic: "characteristic",
+}
+
+
+VALUE_FIELDS = ("equipment_id", "characteristic_id", "value")
+
+
+@receiver(pre_save, sender=EquipmentCharacteristicValue)
+def characteristic_value_before_save(sender, instance, **kwargs):
+    instance._previous_value = None
+    if instance._state.adding:
+        return
+    loaded = getattr(instance, "_loaded_values", {})
+    if all(field in loaded for field in VALUE_FIELDS):
+        instance._previous_value = tuple(loaded[field] for field in VALUE_FIELDS)
+    else:
+        instance._previous_value = EquipmentCharacteristicValue.objects.filter(
+            pk=instance.pk
+        ).values_list(*VALUE_FIELDS).first()
+
+
+@receiver(post_save, sender=EquipmentCharacteristicValue)
+def characteristic_value_saved(sender, instance, update_fields=None, **kwargs):
+    # Values travel inside their equipment's sync record.
+    record_changes("equipment", [instance.equipment_id])
+
+    before = instance._previous_value
+    after = tuple(getattr(instance, field) for field in VALUE_FIELDS)
+    if update_fields is not None and "value" not in update_fields:
+        return
+    if before is not None and before[:2] != after[:2]:
+        equipment_id, characteristic_id, value = before
+        record_change(
+            equipment_id, EquipmentHistory.ACTION_UPDATE, {characteristic_key(characteristic_id): [value, None]}
+        )
+        before = None
+    record_change(
+        instance.equipment_id,
+        EquipmentHistory.ACTION_UPDATE,
+        {characteristic_key(instance.characteristic_id): [before[2] if before else None, instance.value]},
+    )
+    instance._loaded_values = {**getattr(instance, "_loaded_values", {}), **dict(zip(VALUE_FIELDS, after))}
+
+
+@receiver(post_delete, sender=EquipmentCharacteristicValue)
+def characteristic_value_deleted(sender, instance, **kwargs):
+    record_changes("equipment", [instance.equipment_id])
+    record_change(
+        instance.equipment_id,
+        EquipmentHistory.ACTION_UPDATE,
+        {characteristic_key(instance.characteristic_id): [instance.value, None]},
+    )
+
+
+COUNTER_FIELDS = ("workshop_id", "equipment_type_id")
+# Column to history field name.
+HISTORY_FIELDS = {
+    "name": "name",
+    "inventory_number": "inventory_number",
+    "equipment_type_id": "equipment_type",
+    "workshop_id": "workshop",
+    "parent_id": "parent",
+    "passport_scan": "passport_scan",
+}
+
+
+def _history_value(value):
+    if isinstance(value, FieldFile):
+        value = value.name
+    return None if value == "" else value
+
+
+def _saved_columns(instance, update_fields):
+    if update_fields is None:
+        return list(HISTORY_FIELDS)
+    names = {instance._meta.get_field(name).attname for name in update_fields}
+    return [column for column in HISTORY_FIELDS if column in names]
+
+
+@receiver(pre_save, sender=Equipment)
+def equipment_before_save(sender, instance, update_fields=None, **kwargs):
+    instance._counter_key = None
+    instance._previous_values = None
+    if instance._state.adding:
+        return
+    wanted = list(dict.fromkeys([*COUNTER_FIELDS, *_saved_columns(instance, update_fields)]))
+    loaded = getattr(instance, "_loaded_values", {})
+    if not all(field in loaded for field in wanted):
+        row = Equipment.objects.filter(pk=instance.pk).values(*wanted).first()
+        if row is None:
+            return
+        loaded = {**row, **loaded}
+    instance._counter_key = tuple(loaded[field] for field in COUNTER_FIELDS)
+    instance._previous_values = loaded
+
+
+@receiver(post_save, sender=Equipment)
+def equipment_saved(sender, instance, created, update_fields=None, **kwargs):
+    before = None if created else instance._counter_key
+    after = (instance.workshop_id, instance.equipment_type_id)
+    if update_fields is not None and before is not None:
+        after = tuple(
+            getattr(instance, field) if instance._meta.get_field(field).name in update_fields else previous
+            for field, previous in zip(COUNTER_FIELDS, before)
+        )
+    if after != before:
+        deltas = Counter({after: 1})
+        if before is not None:
+            deltas[before] -= 1
+        adjust_counters(deltas)
+
+    record_changes("equipment", [instance.pk])
+
+    previous = instance._previous_values or {}
+    record_change(
+        instance.pk,
+        EquipmentHistory.ACTION_CREATE if created else EquipmentHistory.ACTION_UPDATE,
+        {
+            HISTORY_FIELDS[column]: [_history_value(previous.get(column)), _history_value(getattr(instance, column))]
+            for column in _saved_columns(instance, update_fields)
+        },
+    )
+
+    if "passport_scan" in _saved_columns(instance, update_fields):
+        scan = _history_value(instance.passport_scan)
+        if scan is not None and scan != _history_value(previous.get("passport_scan")):
+            # Queued in the same transaction, so workers only see it once the scan is saved.
+            schedule_preview(scan)
+
+    saved = {field.attname for field in instance._meta.concrete_fields} - instance.get_deferred_fields()
+    if update_fields is not None:
+        saved = {instance._meta.get_field(name).attname for name in update_fields}
+    values = {attname: getattr(instance, attname) for attname in saved}
+    instance._loaded_values = {
+        **getattr(instance, "_loaded_values", {}),
+        # File fields are snapshotted by name: the FieldFile itself is changed in place.
+        **{attname: value.name if isinstance(value, FieldFile) else value for attname, value in values.items()},
+    }
+
+
+@receiver(post_delete, sender=Equipment)
+def equipment_deleted(sender, instance, **kwargs):
+    loaded = getattr(instance, "_loaded_values", {})
+    key = tuple(loaded.get(field, getattr(instance, field)) for field in COUNTER_FIELDS)
+    adjust_counters({key: -1})
+    record_changes("equipment", [instance.pk])
+    record_change(instance.pk, EquipmentHistory.ACTION_DELETE, {
+        field: [_history_value(loaded.get(column, getattr(instance, column))), None]
+        for column, field in HISTORY_FIELDS.items()
+    })
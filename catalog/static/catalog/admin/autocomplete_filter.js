@@ -0,0 +1,13 @@
+'use strict';
+{
+    // Reload the changelist with the value picked in an AutocompleteFilter box.
+    django.jQuery(document).on('change', '.catalog-autocomplete-filter select', function() {
+        const container = this.closest('.catalog-autocomplete-filter');
+        let search = container.dataset.queryString;
+        if (this.value) {
+            search += (search.length > 1 ? '&' : '') +
+                encodeURIComponent(container.dataset.parameter) + '=' + encodeURIComponent(this.value);
+        }
+        window.location.search = search;
+    });
+}
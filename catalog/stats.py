@@ -0,0 +1,89 @@
+from django.conf import settings
+from django.db import IntegrityError, connections, transaction
+from django.db.models import Count, F
+
+from .models import Equipment, EquipmentCounter
+
+
+def adjust_counters(deltas):
+    """
+    Apply ``{(workshop_id, equipment_type_id): delta}`` to the counters with
+    one ``UPDATE ... SET count = count + delta`` per group.
+
+    Groups are visited in key order so concurrent writers lock counter rows in
+    the same order. A missing row is only created for a positive delta; a
+    decrement of a group that no longer exists is dropped.
+    """
+    for (workshop_id, equipment_type_id), delta in sorted(deltas.items()):
+        if not delta:
+            continue
+        counters = EquipmentCounter.objects.filter(workshop_id=workshop_id, equipment_type_id=equipment_type_id)
+        if counters.update(count=F("count") + delta) or delta < 0:
+            continue
+        try:
+            with transaction.atomic():
+                EquipmentCounter.objects.create(workshop_id=workshop_id, equipment_type_id=equipment_type_id, count=delta)
+        except IntegrityError:
+            counters.update(count=F("count") + delta)
+
+
+def count_groups():
+    return {
+        (row["workshop_id"], row["equipment_type_id"]): row["count"]
+        for row in Equipment.objects.order_by().values("workshop_id", "equipment_type_id").annotate(count=Count("id"))
+    }
+
+
+def rebuild_counters(batch_size=None):
+    """Recompute every counter with one ``GROUP BY`` over the equipment table."""
+    connection = connections[EquipmentCounter.objects.db]
+    with transaction.atomic():
+        if connection.vendor == "postgresql":
+            # Writers wait for the rebuild instead of incrementing rows it is replacing.
+            with connection.cursor() as cursor:
+                cursor.execute(f"LOCK TABLE {EquipmentCounter._meta.db_table} IN EXCLUSIVE MODE")
+        EquipmentCounter.objects.all().delete()
+        counters = EquipmentCounter.objects.bulk_create(
+            [
+                EquipmentCounter(workshop_id=workshop_id, equipment_type_id=equipment_type_id, count=count)
+                for (workshop_id, equipment_type_id), count in count_groups().items()
+            ],
+            batch_size=batch_size or settings.CATALOG_BULK_BATCH_SIZE,
+        )
+    return len(counters)
+
+
+def equipment_stats():
+    """Equipment totals per site, workshop and type, read from the counters only."""
+    sites, workshops, types = {}, {}, {}
+    total = 0
+    rows = EquipmentCounter.objects.filter(count__gt=0).values(
+        "count", "workshop_id", "workshop__name", "workshop__site_id", "workshop__site__name",
+        "equipment_type_id", "equipment_type__name",
+    )
+    for row in rows:
+        total += row["count"]
+        site = sites.setdefault(
+            row["workshop__site_id"],
+            {"id": row["workshop__site_id"], "name": row["workshop__site__name"], "count": 0},
+        )
+        workshop = workshops.setdefault(
+            row["workshop_id"],
+            {"id": row["workshop_id"], "name": row["workshop__name"], "site": row["workshop__site_id"], "count": 0},
+        )
+        equipment_type = types.setdefault(
+            row["equipment_type_id"],
+            {"id": row["equipment_type_id"], "name": row["equipment_type__name"], "count": 0},
+        )
+        for group in (site, workshop, equipment_type):
+            group["count"] += row["count"]
+
+    def ordered(groups):
+        return sorted(groups.values(), key=lambda group: (group["name"], group["id"]))
+
+    return {
+        "total": total,
+        "sites": ordered(sites),
+        "workshops": ordered(workshops),
+        "equipment_types": ordered(types),
+    }
@@ -0,0 +1,77 @@
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+
+BLOB_PREFIX = "passports/blobs"
+TMP_PREFIX = "passports/tmp"
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File storage that names every file by the SHA-256 of its content, so each
+    distinct upload is stored once as ``passports/blobs/ab/<sha256><ext>``.
+
+    Uploads are hashed while they are streamed into a temporary file next to
+    the blobs and then renamed into place. Identical content maps to the
+    existing blob. Blobs are only removed by ``cleanup_passport_blobs``.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        return name
+
+    def blob_name(self, digest, extension=""):
+        return f"{BLOB_PREFIX}/{digest[:2]}/{digest}{extension.lower()}"
+
+    def temporary_path(self, name=None):
+        directory = self.path(TMP_PREFIX)
+        os.makedirs(directory, exist_ok=True)
+        if name:
+            return os.path.join(directory, name)
+        fd, path = tempfile.mkstemp(dir=directory)
+        os.close(fd)
+        return path
+
+    def _save(self, name, content):
+        digest = hashlib.sha256()
+        path = self.temporary_path()
+        with open(path, "wb") as destination:
+            for chunk in content.chunks():
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                digest.update(chunk)
+                destination.write(chunk)
+        return self.store_file(path, digest.hexdigest(), os.path.splitext(name)[1])
+
+    def store_file(self, path, digest, extension=""):
+        """Move the fully written file at ``path`` into the blob store and return its name."""
+        name = self.blob_name(digest, extension)
+        full_path = self.path(name)
+        if os.path.exists(full_path):
+            os.remove(path)
+            return name
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        file_move_safe(path, full_path, allow_overwrite=True)
+        if self.file_permissions_mode is not None:
+            os.chmod(full_path, self.file_permissions_mode)
+        return name
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for chunk in iter(lambda: source.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def passport_storage():
+    return ContentAddressedStorage()
+
+
+def job_storage():
+    """Private storage of job files, which are never served from MEDIA_URL."""
+    return FileSystemStorage(location=settings.CATALOG_JOB_FILES_ROOT, base_url=None)
@@ -0,0 +1,176 @@
+from datetime import timedelta
+from functools import partial
+
+from django.db import connections
+from django.db.models import Max, Q
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+
+from .models import Characteristic, Equipment, EquipmentType, Site, SyncChange, Workshop
+from .serializers import (CharacteristicSerializer, EquipmentFieldSelection, EquipmentSerializer,
+                          EquipmentTypeSerializer, SiteSerializer, WorkshopSerializer)
+
+KINDS = ("site", "workshop", "equipment_type", "characteristic", "equipment")
+
+
+class SyncTokenExpired(APIException):
+    status_code = status.HTTP_410_GONE
+    default_detail = "The sync token is older than the retained changes; start again without a token."
+    default_code = "sync_token_expired"
+
+
+def record_changes(kind, ids):
+    """
+    Note that objects of ``kind`` changed. The entries are inserted within the
+    caller's transaction, so they commit or roll back with the change itself.
+    On PostgreSQL each row also gets the id of its transaction (``txid``),
+    which the feed uses to hold back entries that may still be preceded by
+    uncommitted ones.
+    """
+    ids = list(dict.fromkeys(ids))
+    if ids:
+        SyncChange.objects.bulk_create([SyncChange(kind=kind, object_id=object_id) for object_id in ids])
+
+
+def _visible_before():
+    """
+    Transaction ids below this one belong to finished transactions only:
+    entries written by them are final. ``None`` where writers commit in id
+    order anyway (SQLite allows a single writer at a time).
+    """
+    connection = connections[SyncChange.objects.db]
+    if connection.vendor != "postgresql":
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint")
+        return cursor.fetchone()[0]
+
+
+def _position_after(txid, last_id):
+    return Q(txid__gt=txid) | Q(txid=txid, id__gt=last_id)
+
+
+def _current_position():
+    """Feed position that entries committed from now on come after."""
+    visible_before = _visible_before()
+    if visible_before is not None:
+        return visible_before, 0
+    return 0, SyncChange.objects.aggregate(last=Max("id"))["last"] or 0
+
+
+def _feeds():
+    """Kinds in snapshot order (references first) with the queryset and serializer of their records."""
+    equipment = EquipmentFieldSelection(expand=["characteristics"])
+    return {
+        "site": (Site.objects.all(), SiteSerializer),
+        "workshop": (Workshop.objects.select_related("site"), WorkshopSerializer),
+        "equipment_type": (EquipmentType.objects.prefetch_related("characteristics__equipment_type"),
+                           EquipmentTypeSerializer),
+        "characteristic": (Characteristic.objects.all(), CharacteristicSerializer),
+        "equipment": (equipment.apply(Equipment.objects.all()),
+                      partial(EquipmentSerializer, **equipment.serializer_kwargs())),
+    }
+
+
+def _parse_token(token):
+    try:
+        if token.startswith("s"):
+            txid, last_id, kind_index, last_object = (int(part) for part in token[1:].split("."))
+            if 0 <= kind_index < len(KINDS):
+                return ("snapshot", (txid, last_id), kind_index, last_object)
+        else:
+            # Tokens of plain ids predate per-transaction positions: their entries have txid 0.
+            txid, _, last_id = token.rpartition(".")
+            return ("changes", (int(txid or 0), int(last_id)))
+    except ValueError:
+        pass
+    raise ValidationError({"token": ["Invalid sync token."]})
+
+
+def _changes_token(position):
+    return "{}.{}".format(*position)
+
+
+def _snapshot_page(feeds, start, kind_index, last_id, limit):
+    kind = KINDS[kind_index]
+    queryset, serializer_class = feeds[kind]
+    objects = list(queryset.filter(id__gt=last_id).order_by("id")[:limit])
+    changes = [
+        {"type": kind, "id": data["id"], "deleted": False, "data": data}
+        for data in serializer_class(objects, many=True).data
+    ]
+    prefix = "s{}.{}".format(*start)
+    if len(objects) == limit:
+        next_token = f"{prefix}.{kind_index}.{objects[-1].id}"
+    elif kind_index + 1 < len(KINDS):
+        next_token = f"{prefix}.{kind_index + 1}.0"
+    else:
+        # Snapshot done: continue with everything that changed since it began.
+        next_token = _changes_token(start)
+    return {"changes": changes, "next_token": next_token, "has_more": True}
+
+
+def _changes_page(feeds, since, limit):
+    oldest = SyncChange.objects.order_by("txid", "id").values_list("txid", "id").first()
+    if oldest is not None and since < oldest:
+        raise SyncTokenExpired()
+    changes = SyncChange.objects.filter(_position_after(*since))
+    visible_before = _visible_before()
+    if visible_before is not None:
+        changes = changes.filter(txid__lt=visible_before)
+    rows = list(changes.order_by("txid", "id").values_list("txid", "id", "kind", "object_id")[:limit])
+
+    latest = {}
+    for _, _, kind, object_id in rows:
+        latest.pop((kind, object_id), None)
+        latest[(kind, object_id)] = None
+    records = {}
+    for kind in KINDS:
+        ids = [object_id for changed_kind, object_id in latest if changed_kind == kind]
+        if ids:
+            queryset, serializer_class = feeds[kind]
+            data = serializer_class(list(queryset.filter(id__in=ids)), many=True).data
+            records.update(((kind, item["id"]), item) for item in data)
+
+    changes = [
+        {"type": kind, "id": object_id, "deleted": (kind, object_id) not in records,
+         "data": records.get((kind, object_id))}
+        for kind, object_id in latest
+    ]
+    return {
+        "changes": changes,
+        "next_token": _changes_token(rows[-1][:2] if rows else since),
+        "has_more": len(rows) == limit,
+    }
+
+
+def read_feed(token, limit):
+    """
+    One page of the sync feed. Without a token the feed starts with a snapshot
+    of every record, kind by kind, and then continues with the change log from
+    the token current when the snapshot began. Deleted objects come through as
+    ``{"deleted": true, "data": null}`` tombstones.
+    """
+    feeds = _feeds()
+    if not token:
+        return _snapshot_page(feeds, _current_position(), 0, 0, limit)
+    parsed = _parse_token(token)
+    if parsed[0] == "snapshot":
+        return _snapshot_page(feeds, *parsed[1:], limit)
+    return _changes_page(feeds, parsed[1], limit)
+
+
+def prune_changes(days):
+    """
+    Drop change log entries older than ``days``. The newest of them is kept:
+    the oldest remaining position marks which tokens are still complete, and
+    older ones get ``SyncTokenExpired``.
+    """
+    cutoff = timezone.now() - timedelta(days=days)
+    newest = SyncChange.objects.filter(changed_at__lt=cutoff).order_by("-txid", "-id").values_list(
+        "txid", "id"
+    ).first()
+    if newest is None:
+        return 0
+    return SyncChange.objects.exclude(_position_after(*newest)).exclude(txid=newest[0], id=newest[1]).delete()[0]
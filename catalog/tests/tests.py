@@ -1,8 +1,55 @@
+import asyncio
+import csv
+import hashlib
+import io
+import json
+import os
+import subprocess
+from base64 import urlsafe_b64encode
+from datetime import timedelta
+from urllib.parse import parse_qs, urlparse
+
 import pytest
-from django.contrib.auth.models import User, Group
-from rest_framework.test import APIClient
+from PIL import Image
+from asgiref.sync import async_to_sync
 from django.conf import settings
-from catalog.models import Site, Workshop, EquipmentType, Equipment
+from django.contrib.auth.models import Group, User
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management import call_command
+from django.core.signals import request_finished, request_started
+from django.db import close_old_connections, connection, transaction
+from django.db.utils import ConnectionHandler
+from django.http import HttpResponse, QueryDict
+from django.test import AsyncClient
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from rest_framework_simplejwt.tokens import AccessToken
+
+from catalog import export
+from catalog.benchmark import compare
+from catalog.bulk import bulk_upsert_equipment
+from catalog.db_router import PIN_COOKIE, ReadRoute, ReplicaRouter, ReplicaRoutingMiddleware, _route, read_from_replica
+from catalog.filters import EquipmentFilter
+from catalog.history import capture_history
+from catalog.importer import Checkpoint, file_fingerprint
+from catalog.jobs import JOB_KINDS, enqueue, job_kind, requeue_lost_jobs, work
+from catalog.models import (
+    Characteristic, Equipment, EquipmentCharacteristicValue, EquipmentCounter, EquipmentHistory, EquipmentType,
+    Job, Site, SyncChange, ThrottleBucket, Workshop,
+)
+from catalog.pagination import EquipmentPagination
+from catalog.previews import FAILED, FAILED_SUFFIX, generate_preview, preview_name, preview_state
+from catalog.roles import get_user_roles
+from catalog.stats import count_groups, equipment_stats
+from catalog.throttling import RoleRateThrottle, take_token
+from catalog.views import EquipmentViewSet
+from config.settings import _database
 
 
 @pytest.fixture(scope="session", autouse=True)
@@ -211,3 +258,1158 @@ def test_throttling_limit(api_client, admin_user, equipment_data, settings):
     api_client.get("/api/equipment/")
     response = api_client.get("/api/equipment/")
     assert response.status_code == 429
+
+
+def _cursor_page(user, params):
+    http_request = APIRequestFactory().get("/api/equipment/", params)
+    force_authenticate(http_request, user)
+    view = EquipmentViewSet(request=Request(http_request), action="list", format_kwarg=None)
+    paginator = EquipmentPagination()
+    rows = paginator.paginate_queryset(view.filter_queryset(view.get_queryset()), view.request, view)
+    return rows, paginator.get_paginated_response([row.id for row in rows]).data
+
+
+@pytest.mark.django_db
+def test_cursor_pagination_tie_breaker(admin_user, equipment_data):
+    for i in range(4):
+        Equipment.objects.create(
+            name="Молоток1",
+            inventory_number=f"М1{i:02d}",
+            equipment_type=equipment_data.equipment_type,
+            workshop=equipment_data.workshop
+        )
+    seen = []
+    params = {"pagination": "cursor", "ordering": "-name"}
+    while True:
+        rows, data = _cursor_page(admin_user, params)
+        seen.extend(data["results"])
+        if not data["next"]:
+            break
+        params = {k: v[0] for k, v in parse_qs(urlparse(data["next"]).query).items()}
+    assert "count" not in data
+    assert seen == list(Equipment.objects.order_by("-name", "-id").values_list("id", flat=True))
+
+    previous = {k: v[0] for k, v in parse_qs(urlparse(data["previous"]).query).items()}
+    rows, data = _cursor_page(admin_user, previous)
+    assert data["results"] == seen[-3:-1]
+
+
+@pytest.mark.django_db
+def test_cursor_pagination_via_api(api_client, admin_user, equipment_data, monkeypatch):
+    monkeypatch.setattr(RoleRateThrottle, "THROTTLE_RATES", {"user": "100/min"})
+    api_client.force_authenticate(admin_user)
+    response = api_client.get("/api/equipment/?pagination=cursor&include_total=1&page_size=1")
+    assert response.status_code == 200
+    assert len(response.data["results"]) == 1
+    assert "approximate_count" in response.data
+    assert response.data["previous"] is None
+
+    def cursor(position):
+        return urlsafe_b64encode(json.dumps({"p": position}).encode()).decode()
+
+    for ordering, position in [("name", ["x", "abc"]), ("created_at", ["not-a-date", 1]), ("name", [["x"], 1])]:
+        response = api_client.get(f"/api/equipment/?ordering={ordering}&cursor={cursor(position)}")
+        assert response.status_code == 404
+        assert response.data["detail"] == "Invalid cursor"
+
+
+@pytest.mark.django_db
+def test_bulk_upsert_equipment(api_client, manager_user, equipment_data):
+    characteristic = Characteristic.objects.create(
+        name="Вес", equipment_type=equipment_data.equipment_type, value_type=Characteristic.VALUE_TYPE_NUMBER
+    )
+    api_client.force_authenticate(manager_user)
+    items = [
+        {
+            "inventory_number": "М001",
+            "name": "Молоток обновленный",
+            "equipment_type": equipment_data.equipment_type.id,
+            "workshop": equipment_data.workshop.id,
+            "characteristic_values": [{"characteristic": characteristic.id, "value": "1.5"}],
+        },
+        {
+            "inventory_number": "М002",
+            "name": "Рукоять",
+            "equipment_type": equipment_data.equipment_type.id,
+            "workshop": equipment_data.workshop.id,
+            "parent_inventory_number": "М001",
+        },
+        {
+            "inventory_number": "М003",
+            "name": "Без цеха",
+            "equipment_type": equipment_data.equipment_type.id,
+            "workshop": 999999,
+        },
+    ]
+    response = api_client.post("/api/equipment/bulk/", items, format="json")
+    assert response.status_code == 200
+    assert response.data["created"] == 1
+    assert response.data["updated"] == 1
+    assert [error["index"] for error in response.data["errors"]] == [2]
+    equipment_data.refresh_from_db()
+    assert equipment_data.name == "Молоток обновленный"
+    assert Equipment.objects.get(inventory_number="М002").parent_id == equipment_data.id
+    assert EquipmentCharacteristicValue.objects.get(equipment=equipment_data).value == "1.5"
+
+    power_tool = EquipmentType.objects.create(name="Электроинструмент")
+    power = Characteristic.objects.create(name="Мощность", equipment_type=power_tool)
+    response = api_client.post("/api/equipment/bulk/", [{
+        "inventory_number": "М001",
+        "name": "Перфоратор",
+        "equipment_type": power_tool.id,
+        "workshop": equipment_data.workshop.id,
+        "characteristic_values": [{"characteristic": power.id, "value": "800 Вт"}],
+    }], format="json")
+    assert response.data["updated"] == 1
+    assert list(EquipmentCharacteristicValue.objects.filter(equipment=equipment_data).values_list(
+        "characteristic_id", flat=True
+    )) == [power.id]
+    assert EquipmentHistory.objects.filter(
+        equipment_id=equipment_data.id, changes__has_key=f"characteristic:{characteristic.id}"
+    ).count() == 2
+
+
+@pytest.mark.django_db
+def test_export_csv_pivots_characteristics(api_client, viewer_user, equipment_data):
+    characteristic = Characteristic.objects.create(
+        name="Вес", equipment_type=equipment_data.equipment_type, value_type=Characteristic.VALUE_TYPE_NUMBER
+    )
+    EquipmentCharacteristicValue.objects.create(equipment=equipment_data, characteristic=characteristic, value="2")
+    # A value left over from another type has no column and must not break the stream.
+    other = Characteristic.objects.create(name="Мощность", equipment_type=EquipmentType.objects.create(name="Прочее"))
+    EquipmentCharacteristicValue.objects.create(equipment=equipment_data, characteristic=other, value="800")
+    api_client.force_authenticate(viewer_user)
+    response = api_client.get(f"/api/equipment/export/?workshop={equipment_data.workshop.id}")
+    assert response.status_code == 200
+    content = b"".join(response.streaming_content).decode("utf-8-sig")
+    header, row = list(csv.reader(io.StringIO(content)))
+    assert header[-1] == "Ручной инструмент: Вес"
+    assert "800" not in row
+    assert row[1] == "М001"
+    assert row[-1] == "2"
+
+
+@pytest.mark.django_db
+def test_export_command_applies_filters(equipment_data, tmp_path):
+    output = tmp_path / "equipment.csv"
+    call_command("export_equipment", "--output", str(output), "--filter", "search=нет-такого")
+    assert len(output.read_text(encoding="utf-8-sig").splitlines()) == 1
+
+
+@pytest.mark.django_db
+def test_search_ranks_exact_matches_first(api_client, viewer_user, equipment_data):
+    for name, number in [("Big hammer", "B001"), ("Hammer", "B002"), ("Hammer drill", "B003")]:
+        Equipment.objects.create(
+            name=name,
+            inventory_number=number,
+            equipment_type=equipment_data.equipment_type,
+            workshop=equipment_data.workshop
+        )
+    api_client.force_authenticate(viewer_user)
+    response = api_client.get("/api/equipment/?search=hammer")
+    assert [item["name"] for item in response.data["results"]] == ["Hammer", "Hammer drill"]
+    assert response.data["count"] == 3
+
+
+@pytest.fixture
+def equipment_tree(db, equipment_data, site):
+    other_workshop = Workshop.objects.create(name="Цех 2", site=site)
+    machine = Equipment.objects.create(
+        name="Станок", inventory_number="Л001-С", equipment_type=equipment_data.equipment_type,
+        workshop=equipment_data.workshop, parent=equipment_data
+    )
+    unit = Equipment.objects.create(
+        name="Узел", inventory_number="Л001-У", equipment_type=equipment_data.equipment_type,
+        workshop=other_workshop, parent=machine
+    )
+    component = Equipment.objects.create(
+        name="Деталь", inventory_number="Л001-Д", equipment_type=equipment_data.equipment_type,
+        workshop=other_workshop, parent=unit
+    )
+    return equipment_data, machine, unit, component
+
+
+@pytest.mark.django_db
+def test_bulk_upsert_rejects_cycles_and_keeps_omitted_parents(api_client, manager_user, equipment_tree):
+    root, machine, unit, component = equipment_tree
+    api_client.force_authenticate(manager_user)
+
+    def item(obj, **extra):
+        return {
+            "inventory_number": obj.inventory_number, "name": obj.name,
+            "equipment_type": obj.equipment_type_id, "workshop": obj.workshop_id, **extra,
+        }
+
+    def new(number, **extra):
+        return {
+            "inventory_number": number, "name": number,
+            "equipment_type": root.equipment_type_id, "workshop": root.workshop_id, **extra,
+        }
+
+    response = api_client.post("/api/equipment/bulk/", [
+        item(unit, parent=unit.id),
+        item(machine, parent=component.id),
+        new("Н1", parent_inventory_number="Н2"),
+        new("Н2", parent_inventory_number="Н1"),
+        new("Н3", parent_inventory_number=component.inventory_number),
+    ], format="json")
+    assert response.status_code == 200
+    errors = {error["index"]: error["errors"] for error in response.data["errors"]}
+    assert errors[0] == {"parent": ["Equipment cannot be its own parent."]}
+    assert set(errors) == {0, 1, 2, 3}
+    assert "ancestor" in str(errors[1]["parent"]) and "ancestor" in str(errors[2]["parent_inventory_number"])
+    assert Equipment.objects.get(inventory_number="Н3").parent_id == component.id
+    assert Equipment.objects.get(pk=machine.pk).parent_id == root.id
+
+    # A row without parent fields keeps its parent; an explicit null makes it a root.
+    response = api_client.post("/api/equipment/bulk/", [
+        item(unit, name="Узел 2"), item(component, parent=None),
+    ], format="json")
+    assert response.data["errors"] == []
+    unit.refresh_from_db()
+    component.refresh_from_db()
+    assert (unit.name, unit.parent_id, component.parent_id) == ("Узел 2", machine.id, None)
+
+
+@pytest.mark.django_db
+def test_descendants_with_depth_and_filter(
+    api_client, viewer_user, manager_user, equipment_tree, settings, monkeypatch
+):
+    monkeypatch.setattr(RoleRateThrottle, "THROTTLE_RATES", {"user": "100/min"})
+    root, machine, unit, component = equipment_tree
+    api_client.force_authenticate(viewer_user)
+    response = api_client.get(f"/api/equipment/{root.id}/descendants/?max_depth=2&page_size=10")
+    assert {item["id"] for item in response.data["results"]} == {machine.id, unit.id}
+    response = api_client.get(f"/api/equipment/{root.id}/descendants/?workshop={unit.workshop_id}")
+    assert {item["id"] for item in response.data["results"]} == {unit.id, component.id}
+    assert api_client.get("/api/equipment/abc/descendants/").status_code == 404
+
+    # Walks that would stop at the depth limit are refused instead of returning part of the tree.
+    settings.CATALOG_TREE_MAX_DEPTH = 2
+    assert api_client.get(f"/api/equipment/{root.id}/descendants/").status_code == 400
+    assert api_client.get(f"/api/equipment/{root.id}/descendants/?max_depth=3").status_code == 400
+    assert api_client.get(f"/api/equipment/{root.id}/descendants/?max_depth=2").status_code == 200
+    assert api_client.get(f"/api/equipment/{machine.id}/descendants/").status_code == 200
+    assert api_client.get(f"/api/equipment/{component.id}/ancestors/").status_code == 400
+    api_client.force_authenticate(manager_user)
+    response = api_client.post("/api/equipment/move/", {
+        "ids": [root.id], "workshop": unit.workshop_id, "with_descendants": True,
+    }, format="json")
+    assert response.status_code == 400
+    assert Equipment.objects.get(pk=root.pk).workshop_id != unit.workshop_id
+
+
+@pytest.mark.django_db
+def test_ancestors_follow_parent_changes(api_client, viewer_user, equipment_tree):
+    root, machine, unit, component = equipment_tree
+    api_client.force_authenticate(viewer_user)
+    response = api_client.get(f"/api/equipment/{component.id}/ancestors/")
+    assert [item["id"] for item in response.data] == [root.id, machine.id, unit.id]
+    unit.parent = None
+    unit.save()
+    response = api_client.get(f"/api/equipment/{component.id}/ancestors/")
+    assert [item["id"] for item in response.data] == [unit.id]
+
+
+@pytest.mark.django_db
+def test_roles_resolved_once_per_user(admin_user, django_assert_num_queries):
+    fresh = User.objects.get(pk=admin_user.pk)
+    with django_assert_num_queries(1):
+        assert get_user_roles(fresh) == {"Admin"}
+        assert get_user_roles(fresh) == {"Admin"}
+    fresh.groups.add(Group.objects.get(name="Viewer"))
+    fresh.groups.remove(Group.objects.get(name="Admin"))
+    assert get_user_roles(fresh) == {"Viewer"}
+
+
+@pytest.mark.django_db
+def test_typed_characteristic_filters(equipment_data):
+    eq_type = equipment_data.equipment_type
+    power = Characteristic.objects.create(name="Мощность", equipment_type=eq_type, value_type="number")
+    checked = Characteristic.objects.create(name="Поверка", equipment_type=eq_type, value_type="date")
+    second = Equipment.objects.create(
+        name="Пресс", inventory_number="П001", equipment_type=eq_type, workshop=equipment_data.workshop
+    )
+    EquipmentCharacteristicValue.objects.create(equipment=equipment_data, characteristic=power, value="7,5")
+    EquipmentCharacteristicValue.objects.create(equipment=second, characteristic=power, value="22")
+    EquipmentCharacteristicValue.objects.create(equipment=second, characteristic=checked, value="01.12.2025")
+
+    def ids(*conditions):
+        data = QueryDict(mutable=True)
+        data.setlist("characteristic", list(conditions))
+        filterset = EquipmentFilter(data=data, queryset=Equipment.objects.all())
+        assert filterset.is_valid(), filterset.errors
+        return set(filterset.qs.values_list("id", flat=True))
+
+    assert ids(f"{power.id}:gt:15") == {second.id}
+    assert ids(f"{power.id}:lte:7.5") == {equipment_data.id}
+    assert ids(f"{power.id}:gt:1", f"{checked.id}:lt:2026-01-01") == {second.id}
+
+    data = QueryDict(f"characteristic={power.id}:contains:x")
+    assert not EquipmentFilter(data=data, queryset=Equipment.objects.all()).is_valid()
+    with pytest.raises(ValidationError):
+        EquipmentCharacteristicValue(equipment=second, characteristic=power, value="abc").full_clean()
+
+
+@pytest.mark.django_db
+def test_reference_cache_hit_and_invalidation(
+    api_client, viewer_user, admin_user, site, django_assert_num_queries, django_capture_on_commit_callbacks
+):
+    api_client.force_authenticate(viewer_user)
+    first = api_client.get("/api/sites/")
+    assert first.status_code == 200
+    with django_assert_num_queries(2) as captured:
+        second = api_client.get("/api/sites/")
+    assert second.content == first.content
+    # Only the rate limit bucket and one read of the cache table (version and response together).
+    bucket, cached = (query["sql"] for query in captured.captured_queries)
+    assert "catalog_throttlebucket" in bucket
+    assert cached.startswith("SELECT") and "catalog_cache" in cached
+
+    with django_capture_on_commit_callbacks(execute=True):
+        site.name = "Площадка переименованная"
+        site.save()
+    api_client.force_authenticate(admin_user)
+    response = api_client.get("/api/sites/")
+    assert response.json()["results"][0]["name"] == "Площадка переименованная"
+
+
+@pytest.mark.django_db
+def test_generate_catalog_and_benchmark(tmp_path):
+    call_command(
+        "generate_catalog", "--sites", "1", "--workshops-per-site", "2", "--types", "2",
+        "--characteristics-per-type", "3", "--equipment", "40", "--tree-depth", "3", stdout=io.StringIO()
+    )
+    assert Equipment.objects.count() == 40
+    assert EquipmentCharacteristicValue.objects.count() == 120
+    assert Equipment.objects.filter(parent__parent__isnull=False).exists()
+
+    call_command("benchmark_catalog", "--iterations", "2", "--output-dir", str(tmp_path), stdout=io.StringIO())
+    results = json.loads(next(tmp_path.iterdir()).read_text())
+    assert results["scenarios"]["list"]["status"] == 200
+    slower = {"scenarios": {"list": {**results["scenarios"]["list"], "queries": 0}}}
+    assert compare(results, slower) == [f"list: queries 0 -> {results['scenarios']['list']['queries']}"]
+
+
+@pytest.mark.django_db
+def test_passport_storage_deduplicates(equipment_data, tmp_path, settings):
+    settings.MEDIA_ROOT = str(tmp_path)
+    storage = Equipment._meta.get_field("passport_scan").storage
+    first = storage.save("passport.pdf", ContentFile(b"scan"))
+    second = storage.save("other.PDF", ContentFile(b"scan"))
+    assert first == second
+    assert first.startswith("passports/blobs/")
+    assert len(list((tmp_path / "passports" / "blobs").rglob("*.pdf"))) == 1
+
+
+@pytest.mark.django_db
+def test_resumable_passport_upload(
+    api_client, admin_user, manager_user, viewer_user, equipment_data, tmp_path, settings, monkeypatch
+):
+    settings.MEDIA_ROOT = str(tmp_path)
+    monkeypatch.setattr(RoleRateThrottle, "THROTTLE_RATES", {"user": "100/min"})
+    content = b"0123456789" * 10
+    api_client.force_authenticate(manager_user)
+    response = api_client.post("/api/passport-uploads/", {
+        "filename": "passport.pdf",
+        "size": len(content),
+        "sha256": hashlib.sha256(content).hexdigest(),
+        "equipment": equipment_data.id,
+    }, format="json")
+    assert response.status_code == 201
+    url = f"/api/passport-uploads/{response.data['id']}/"
+
+    def put(offset, data):
+        return api_client.put(url + "chunk/", data, content_type="application/octet-stream",
+                              HTTP_UPLOAD_OFFSET=str(offset))
+
+    malformed = api_client.put(url + "chunk/", content[:40], content_type="application/octet-stream",
+                               HTTP_UPLOAD_OFFSET="0", CONTENT_LENGTH="forty")
+    assert malformed.status_code == 400
+    assert "Content-Length" in malformed.data
+    assert put(0, content[:40]).data["offset"] == 40
+    api_client.force_authenticate(viewer_user)
+    assert api_client.get(url).status_code == 404
+    api_client.force_authenticate(admin_user)
+    assert api_client.get(url).data["offset"] == 40
+    api_client.force_authenticate(manager_user)
+    stale = put(0, content[:40])
+    assert stale.status_code == 409
+    assert stale.data["offset"] == 40
+    assert api_client.post(url + "complete/").status_code == 400
+    assert put(40, content[40:]).data["offset"] == 100
+
+    response = api_client.post(url + "complete/")
+    assert response.status_code == 200
+    equipment_data.refresh_from_db()
+    assert equipment_data.passport_scan.name == response.data["blob"]
+    assert equipment_data.passport_scan.read() == content
+
+    orphan = Equipment._meta.get_field("passport_scan").storage.save("old.pdf", io.BytesIO(b"old"))
+    os.utime(tmp_path / orphan, (0, 0))
+    os.utime(tmp_path / response.data["blob"], (0, 0))
+    call_command("cleanup_passport_blobs", stdout=io.StringIO())
+    assert not (tmp_path / orphan).exists()
+    assert (tmp_path / response.data["blob"]).exists()
+
+
+@pytest.mark.django_db
+def test_async_read_path(viewer_user, manager_user, equipment_data, monkeypatch):
+    monkeypatch.setattr(RoleRateThrottle, "THROTTLE_RATES", {"user": "100/min"})
+    assert resolve("/api/equipment/").func.view_class.view_is_async
+
+    def auth(user):
+        return {"authorization": f"Bearer {AccessToken.for_user(user)}"} if user else {}
+
+    def get(user, url):
+        return async_to_sync(AsyncClient().get)(url, headers=auth(user))
+
+    response = get(viewer_user, f"/api/equipment/?equipment_type={equipment_data.equipment_type_id}")
+    assert response.status_code == 200
+    assert response.json()["count"] == 1
+    assert response.json()["results"][0]["site_name"] == equipment_data.workshop.site.name
+    assert get(viewer_user, "/api/equipment/?pagination=cursor").json()["results"][0]["id"] == equipment_data.id
+    assert get(viewer_user, f"/api/equipment/{equipment_data.id}/").json()["inventory_number"] == "М001"
+    assert get(viewer_user, "/api/equipment/0/").status_code == 404
+    assert get(viewer_user, "/api/equipment-types/").status_code == 200
+    assert get(None, "/api/sites/").status_code == 401
+
+    response = async_to_sync(AsyncClient().post)(
+        "/api/sites/", {"name": "Async", "address": "-"}, content_type="application/json", headers=auth(manager_user)
+    )
+    assert response.status_code == 201
+
+
+@pytest.mark.django_db
+def test_equipment_stats_counters(api_client, viewer_user, manager_user, equipment_data, django_assert_num_queries):
+    def counters():
+        return {
+            (workshop_id, type_id): count
+            for workshop_id, type_id, count in EquipmentCounter.objects.filter(count__gt=0).values_list(
+                "workshop_id", "equipment_type_id", "count"
+            )
+        }
+
+    other_workshop = Workshop.objects.create(name="Цех 2", site=equipment_data.workshop.site)
+    other_type = EquipmentType.objects.create(name="Станок")
+    child = Equipment.objects.create(
+        name="Деталь", inventory_number="Д100", equipment_type=equipment_data.equipment_type,
+        workshop=equipment_data.workshop, parent=equipment_data,
+    )
+    child.workshop = other_workshop
+    child.save()
+    moved = Equipment.objects.get(pk=child.pk)
+    moved.equipment_type = other_type
+    moved.save(update_fields=["equipment_type"])
+    bulk_upsert_equipment([
+        {"inventory_number": "Д200", "name": "Новый", "equipment_type": other_type.id, "workshop": other_workshop.id},
+        {"inventory_number": "Д100", "name": "Деталь", "equipment_type": other_type.id,
+         "workshop": equipment_data.workshop_id, "parent": None},
+    ])
+    assert counters() == count_groups() == {
+        (equipment_data.workshop_id, equipment_data.equipment_type_id): 1,
+        (equipment_data.workshop_id, other_type.id): 1,
+        (other_workshop.id, other_type.id): 1,
+    }
+
+    equipment_data.delete()
+    assert counters() == count_groups()
+    with django_assert_num_queries(1):
+        stats = equipment_stats()
+    assert stats["total"] == 2
+    assert stats["sites"] == [{"id": other_workshop.site_id, "name": "Площадка 1", "count": 2}]
+
+    EquipmentCounter.objects.update(count=5)
+    out = io.StringIO()
+    call_command("rebuild_equipment_stats", "--check", stdout=out)
+    assert "4 drifted counter(s)" in out.getvalue()
+    call_command("rebuild_equipment_stats", stdout=io.StringIO())
+    assert counters() == count_groups()
+
+    api_client.force_authenticate(viewer_user)
+    response = api_client.get("/api/equipment/stats/")
+    assert response.status_code == 200
+    assert response.data["equipment_types"] == [{"id": other_type.id, "name": "Станок", "count": 2}]
+
+
+@pytest.mark.django_db
+def test_fast_list_matches_serializer_output(api_client, viewer_user, equipment_tree, monkeypatch):
+    monkeypatch.setattr(RoleRateThrottle, "THROTTLE_RATES", {"user": "100/min"})
+    api_client.force_authenticate(viewer_user)
+    root = equipment_tree[0]
+    urls = [
+        "/api/equipment/?page_size=50",
+        "/api/equipment/?ordering=-created_at&page=2",
+        "/api/equipment/?pagination=cursor&ordering=name&page_size=2",
+        f"/api/equipment/?search={root.name}",
+        f"/api/equipment/{root.id}/descendants/",
+    ]
+    fast = [api_client.get(url).content for url in urls]
+
+    monkeypatch.setattr(EquipmentViewSet, "list_reader_class", None)
+    assert [api_client.get(url).content for url in urls] == fast
+    assert all(b'"results":[{' in content for content in fast)
+
+
+@pytest.mark.django_db
+def test_sparse_fields_and_expand(api_client, viewer_user, equipment_tree, monkeypatch, django_assert_num_queries):
+    monkeypatch.setattr(RoleRateThrottle, "THROTTLE_RATES", {"user": "100/min"})
+    api_client.force_authenticate(viewer_user)
+    root, machine, unit, component = equipment_tree
+    power = Characteristic.objects.create(name="Мощность", equipment_type=root.equipment_type, value_type="number")
+    EquipmentCharacteristicValue.objects.create(equipment=machine, characteristic=power, value="5")
+
+    response = api_client.get(f"/api/equipment/{machine.id}/?fields=id,name&expand=parent,children,characteristics")
+    assert response.data == {
+        "id": machine.id,
+        "name": machine.name,
+        "characteristics": [{"characteristic": power.id, "name": "Мощность", "value_type": "number", "value": "5"}],
+        "parent": {"id": root.id, "name": root.name, "inventory_number": root.inventory_number},
+        "children": [{"id": unit.id, "name": unit.name, "inventory_number": unit.inventory_number}],
+    }
+    response = api_client.get("/api/equipment/?fields=id,inventory_number&ordering=-created_at")
+    assert response.data["results"][0] == {"id": component.id, "inventory_number": component.inventory_number}
+    assert api_client.get("/api/equipment/?fields=id,price").status_code == 400
+    assert api_client.get("/api/equipment/?expand=workshop").status_code == 400
+
+    # Throttle bucket, page count, page rows and one query per expansion.
+    with django_assert_num_queries(3):
+        api_client.get("/api/equipment/?fields=id")
+    with django_assert_num_queries(5):
+        api_client.get("/api/equipment/?expand=characteristics,children")
+    urls = [
+        "/api/equipment/?fields=id,name,parent&expand=parent,characteristics,children&pagination=cursor&page_size=10",
+        f"/api/equipment/{root.id}/descendants/?expand=children&fields=site_name,created_at",
+        f"/api/equipment/{component.id}/ancestors/?fields=name&expand=parent",
+    ]
+    fast = [api_client.get(url).content for url in urls]
+    monkeypatch.setattr(EquipmentViewSet, "list_reader_class", None)
+    assert [api_client.get(url).content for url in urls] == fast
+    assert b'"characteristics":[{"characteristic":' in fast[0]
+
+
+@pytest.mark.django_db
+def test_server_timing_and_report(api_client, viewer_user, equipment_data, tmp_path, settings, caplog):
+    settings.CATALOG_TIMING_SAMPLE_RATE = 1
+    api_client.force_authenticate(viewer_user)
+    with caplog.at_level("INFO", logger="catalog.timing"):
+        response = api_client.get("/api/equipment/")
+    header = response["Server-Timing"]
+    assert header.startswith("total;dur=")
+    for metric in ("db;dur=", "permissions;dur=", "filter;dur=", "query;dur=", "serialize;dur=", "render;dur="):
+        assert metric in header
+    record = json.loads(caplog.records[-1].getMessage())
+    assert record["endpoint"] == "GET equipment-list"
+    assert record["queries"] >= 2
+    assert record["slowest"][0]["sql"]
+
+    log = tmp_path / "timing.log"
+    log.write_text("\n".join([caplog.records[-1].getMessage(), "not json"]), encoding="utf-8")
+    out = io.StringIO()
+    call_command("timing_report", str(log), "--json", stdout=out)
+    assert json.loads(out.getvalue())[0]["endpoint"] == "GET equipment-list"
+
+    settings.CATALOG_TIMING_SAMPLE_RATE = 0
+    assert "Server-Timing" not in api_client.get("/api/sites/")
+
+
+@pytest.mark.django_db
+def test_import_equipment_command(equipment_data, tmp_path):
+    characteristic = Characteristic.objects.create(
+        name="Вес", equipment_type=equipment_data.equipment_type, value_type=Characteristic.VALUE_TYPE_NUMBER
+    )
+    exported = tmp_path / "export.csv"
+    call_command("export_equipment", "--output", str(exported))
+    header = next(csv.reader(io.StringIO(exported.read_text(encoding="utf-8-sig"))))
+    assert header[-1] == "Ручной инструмент: Вес"
+
+    site, workshop, equipment_type = "Площадка 1", "Цех 1", "Ручной инструмент"
+    rows = [
+        ["", "И-2", "Узел", site, workshop, equipment_type, "И-1", "", "", "5"],
+        ["", "И-1", "Станок", site, workshop, equipment_type, "", "", "", "12,5"],
+        ["", "И-3", "Без цеха", site, "Цех 9", equipment_type, "", "", "", ""],
+        ["", "И-4", "Кривой вес", site, workshop, equipment_type, "", "", "", "тяжёлый"],
+        ["", "М001", "Переименован", site, workshop, equipment_type, "", "", "", ""],
+    ]
+    source = tmp_path / "import.csv"
+    with open(source, "w", encoding="utf-8-sig", newline="") as output:
+        csv.writer(output).writerows([header, *rows])
+
+    call_command("import_equipment", str(source), "--dry-run", stdout=io.StringIO())
+    assert not Equipment.objects.filter(inventory_number__startswith="И-").exists()
+
+    checkpoints = tmp_path / "checkpoints"
+    rejects = tmp_path / "rejects.csv"
+    out = io.StringIO()
+    call_command(
+        "import_equipment", str(source), "--batch-size", "2", "--checkpoint", str(checkpoints),
+        "--rejects", str(rejects), stdout=out,
+    )
+    assert "created 2, updated 1, rejected 2" in out.getvalue()
+    unit = Equipment.objects.get(inventory_number="И-2")
+    assert unit.parent.inventory_number == "И-1"
+    assert EquipmentCharacteristicValue.objects.get(equipment=unit.parent).value_number == 12.5
+    assert Equipment.objects.get(pk=equipment_data.pk).name == "Переименован"
+    assert not list(checkpoints.iterdir())
+
+    rejected = list(csv.reader(io.StringIO(rejects.read_text(encoding="utf-8-sig"))))[1:]
+    assert [row[0] for row in rejected] == ["4", "5"]
+    assert "workshop" in json.loads(rejected[0][-1])
+    assert "characteristic_values" in json.loads(rejected[1][-1])
+
+    # Resume: rows up to 5 are committed except row 2, which still waited for its parent.
+    # Rows that fail name resolution (row 4) are reported again on every run.
+    Equipment.objects.filter(inventory_number="И-2").delete()
+    Checkpoint(str(checkpoints), "all", file_fingerprint(str(source))).save(5, [2])
+    out = io.StringIO()
+    call_command("import_equipment", str(source), "--checkpoint", str(checkpoints), stdout=out)
+    assert "created 1, updated 1, rejected 1" in out.getvalue()
+    assert Equipment.objects.filter(inventory_number="И-2").exists()
+
+
+@pytest.mark.django_db
+def test_database_pool_options():
+    pooled = _database("db", "5432", pool=True)
+    assert pooled["CONN_MAX_AGE"] == 0
+    assert pooled["CONN_HEALTH_CHECKS"]
+    assert "check" not in pooled["OPTIONS"]["pool"]
+    assert "OPTIONS" not in _database("db", "5432", pool=False)
+
+    pytest.importorskip("psycopg_pool")
+    wrapper = ConnectionHandler({"default": {**pooled, "NAME": "catalog"}})["default"]
+    # Building the pool doesn't connect; Django adds its own check and configure callbacks.
+    try:
+        assert wrapper.pool.max_size == pooled["OPTIONS"]["pool"]["max_size"]
+    finally:
+        wrapper.close_pool()
+
+
+@pytest.mark.django_db
+def test_replica_router_pins_writers_to_primary(settings, viewer_user, rf):
+    settings.CATALOG_READ_REPLICAS = ["replica1"]
+    router = ReplicaRouter()
+    assert router.db_for_read(Equipment) == "default"
+    with read_from_replica():
+        assert router.db_for_read(Equipment) == "replica1"
+        assert router.db_for_write(Equipment) == "default"
+        with transaction.atomic():
+            assert router.db_for_read(Equipment) == "default"
+
+    def route_of(request):
+        token = _route.set(ReadRoute(request))
+        try:
+            return router.db_for_read(Equipment)
+        finally:
+            _route.reset(token)
+
+    write = rf.post("/api/equipment/")
+    write.user = viewer_user
+    response = ReplicaRoutingMiddleware(lambda request: HttpResponse(status=201))(write)
+    assert PIN_COOKIE in response.cookies
+
+    read = rf.get("/api/equipment/")
+    read.COOKIES[PIN_COOKIE] = response.cookies[PIN_COOKIE].value
+    assert route_of(read) == "default"
+    # Another client of the same user is pinned once authentication has run.
+    read = rf.get("/api/equipment/")
+    assert route_of(read) == "replica1"
+    read = rf.get("/api/equipment/")
+    read.user = viewer_user
+    assert route_of(read) == "default"
+    read.user = User.objects.create_user(username="other")
+    assert route_of(read) == "replica1"
+
+
+@pytest.mark.django_db
+def test_token_bucket_throttle_per_role(api_client, manager_user, viewer_user, equipment_data, monkeypatch):
+    assert take_token("test", 2, 1, now=100) == (True, 1)
+    assert take_token("test", 2, 1, now=100) == (True, 0)
+    assert take_token("test", 2, 1, now=100.5) == (False, 0.5)
+    assert take_token("test", 2, 1, now=101) == (True, 0)
+    assert take_token("test", 2, 1, now=200) == (True, 1)
+
+    monkeypatch.setattr(RoleRateThrottle, "THROTTLE_RATES", {"user": "1/min", "Manager": "3/min", "Viewer": "1/min"})
+    api_client.force_authenticate(manager_user)
+    assert [api_client.get("/api/equipment/").status_code for _ in range(4)] == [200, 200, 200, 429]
+    assert 0 < int(api_client.get("/api/equipment/")["Retry-After"]) <= 20
+    api_client.force_authenticate(viewer_user)
+    assert [api_client.get("/api/equipment/").status_code for _ in range(2)] == [200, 429]
+    assert ThrottleBucket.objects.filter(key__startswith="user:").count() == 2
+
+    call_command("prune_throttle_buckets", "--idle-hours", "0", stdout=io.StringIO())
+    assert not ThrottleBucket.objects.exists()
+
+
+@pytest.mark.django_db
+def test_batch_lookup(api_client, viewer_user, equipment_tree, django_assert_num_queries, settings, rf):
+    root, machine, unit, component = equipment_tree
+    api_client.force_authenticate(viewer_user)
+    assert api_client.post("/api/equipment/lookup/", {}, format="json").status_code == 400
+    # Throttle bucket and the lookup itself.
+    with django_assert_num_queries(2):
+        response = api_client.post(
+            "/api/equipment/lookup/?fields=id,inventory_number,site_name",
+            {"ids": [unit.id, 999999, root.id], "inventory_numbers": [component.inventory_number, root.inventory_number, "НЕТ"]},
+            format="json",
+        )
+    assert response.status_code == 200
+    assert response.data["results"] == [
+        {"id": item.id, "inventory_number": item.inventory_number, "site_name": item.workshop.site.name}
+        for item in (unit, root, component)
+    ]
+    assert response.data["missing"] == {"ids": [999999], "inventory_numbers": ["НЕТ"]}
+
+    # A read-only POST is routed like a GET and does not pin the client to the primary.
+    settings.CATALOG_READ_REPLICAS = ["replica1"]
+    request = rf.post("/api/equipment/lookup/")
+    middleware = ReplicaRoutingMiddleware(lambda request: HttpResponse())
+    token = middleware.start(request)
+    middleware.process_view(request, resolve("/api/equipment/lookup/").func, (), {})
+    _route.reset(token)
+    assert request.catalog_read_route.enabled
+    assert PIN_COOKIE not in middleware.finish(request, HttpResponse()).cookies
+
+
+@pytest.mark.django_db
+def test_sync_feed_with_tombstones(
+    api_client, viewer_user, equipment_tree, monkeypatch, django_capture_on_commit_callbacks
+):
+    monkeypatch.setattr(RoleRateThrottle, "THROTTLE_RATES", {"user": "100/min"})
+    api_client.force_authenticate(viewer_user)
+    root, machine, unit, component = equipment_tree
+
+    def sync(token=None, limit=3):
+        changes = []
+        while True:
+            params = {"limit": limit, **({"token": token} if token else {})}
+            response = api_client.get("/api/sync/", params)
+            assert response.status_code == 200, response.data
+            changes += response.data["changes"]
+            token = response.data["next_token"]
+            if not response.data["has_more"]:
+                return changes, token
+
+    changes, token = sync()
+    assert {(change["type"], change["id"]) for change in changes} >= {
+        ("site", root.workshop.site_id), ("workshop", unit.workshop_id), ("equipment_type", root.equipment_type_id),
+    } | {("equipment", item.id) for item in equipment_tree}
+    assert sync(token) == ([], token)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        power = Characteristic.objects.create(name="Мощность", equipment_type=root.equipment_type, value_type="number")
+        EquipmentCharacteristicValue.objects.create(equipment=root, characteristic=power, value="7")
+        unit_id, component_id = unit.id, component.id
+        unit.delete()
+    with django_capture_on_commit_callbacks(execute=True):
+        bulk_upsert_equipment([{
+            "inventory_number": "Н-1", "name": "Новый", "equipment_type": root.equipment_type_id,
+            "workshop": root.workshop_id,
+        }])
+    changes, token = sync(token, limit=2)
+    by_key = {(change["type"], change["id"]): change for change in changes}
+    assert by_key[("characteristic", power.id)]["data"]["value_type"] == "number"
+    assert by_key[("equipment", root.id)]["data"]["characteristics"][0]["value"] == "7"
+    assert by_key[("equipment", unit_id)] == {"type": "equipment", "id": unit_id, "deleted": True, "data": None}
+    assert by_key[("equipment", component_id)]["deleted"]
+    assert ("equipment", Equipment.objects.get(inventory_number="Н-1").id) in by_key
+
+    # Entries are part of the writing transaction: rolled back with it, never lost after its commit.
+    before = SyncChange.objects.count()
+    with pytest.raises(RuntimeError), transaction.atomic():
+        root.save(update_fields=["name"])
+        assert SyncChange.objects.count() == before + 1
+        raise RuntimeError
+    assert SyncChange.objects.count() == before
+    root.save(update_fields=["name"])
+    changes, token = sync(token)
+    assert [(change["type"], change["id"]) for change in changes] == [("equipment", root.id)]
+
+    call_command("prune_sync_changes", "--days", "0", stdout=io.StringIO())
+    assert SyncChange.objects.count() == 1
+    assert api_client.get("/api/sync/", {"token": "0"}).status_code == 410
+    assert api_client.get("/api/sync/", {"token": token}).status_code == 200
+    assert api_client.get("/api/sync/", {"token": "s1.x"}).status_code == 400
+
+
+@pytest.mark.django_db
+def test_equipment_change_history(api_client, admin_user, equipment_tree, monkeypatch):
+    monkeypatch.setattr(RoleRateThrottle, "THROTTLE_RATES", {"user": "100/min"})
+    api_client.force_authenticate(admin_user)
+    root, machine, unit, component = equipment_tree
+    created = EquipmentHistory.objects.get(equipment_id=unit.id)
+    assert (created.action, created.source, created.user_id) == ("create", "system", None)
+    assert created.changes["parent"] == [None, machine.id]
+
+    response = api_client.patch(
+        f"/api/equipment/{unit.id}/", {"name": "Узел 2", "workshop": root.workshop_id, "parent": root.id},
+        format="json",
+    )
+    assert response.status_code == 200
+    entry = EquipmentHistory.objects.filter(equipment_id=unit.id).latest("id")
+    assert (entry.action, entry.source, entry.user_id, entry.username) == ("update", "api", admin_user.id, "admin")
+    assert entry.changes == {
+        "name": ["Узел", "Узел 2"], "workshop": [unit.workshop_id, root.workshop_id], "parent": [machine.id, root.id],
+    }
+
+    # Changes of one transaction become one entry per item, written with one insert.
+    power = Characteristic.objects.create(name="Мощность", equipment_type=root.equipment_type, value_type="number")
+    with CaptureQueriesContext(connection) as queries:
+        with capture_history("admin", admin_user):
+            value = EquipmentCharacteristicValue.objects.create(equipment=root, characteristic=power, value="5")
+            value.value = "7"
+            value.save()
+            root.name = "Молоток 2"
+            root.save()
+            machine.name = "Станок 2"
+            machine.save()
+    inserts = [query for query in queries.captured_queries
+               if query["sql"].startswith("INSERT") and "equipmenthistory" in query["sql"]]
+    assert len(inserts) == 1
+    entry = EquipmentHistory.objects.filter(equipment_id=root.id).latest("id")
+    assert entry.source == "admin"
+    assert entry.changes == {f"characteristic:{power.id}": [None, "7"], "name": ["Молоток1", "Молоток 2"]}
+
+    count = EquipmentHistory.objects.count()
+    with pytest.raises(RuntimeError):
+        with capture_history("admin", admin_user):
+            root.name = "Откат"
+            root.save()
+            raise RuntimeError
+    assert EquipmentHistory.objects.count() == count
+
+    root = Equipment.objects.get(pk=root.pk)
+    bulk_upsert_equipment([{
+        "inventory_number": root.inventory_number, "name": root.name, "equipment_type": root.equipment_type_id,
+        "workshop": component.workshop_id, "characteristic_values": [{"characteristic": power.id, "value": "9"}],
+    }])
+    entry = EquipmentHistory.objects.filter(equipment_id=root.id).latest("id")
+    assert entry.source == "bulk"
+    assert entry.changes == {
+        "workshop": [root.workshop_id, component.workshop_id], f"characteristic:{power.id}": ["7", "9"],
+    }
+
+    component_id = component.id
+    assert api_client.delete(f"/api/equipment/{component_id}/").status_code == 204
+    response = api_client.get(f"/api/equipment/{component_id}/history/", {"limit": 1})
+    assert response.status_code == 200
+    assert [item["action"] for item in response.data["results"]] == ["delete"]
+    assert response.data["results"][0]["changes"]["name"] == ["Деталь", None]
+    response = api_client.get(response.data["next"])
+    assert [item["action"] for item in response.data["results"]] == ["create"]
+    assert response.data["next"] is None
+    assert api_client.get("/api/equipment/999999/history/").status_code == 404
+    assert api_client.get(f"/api/equipment/{root.id}/history/", {"cursor": "x"}).status_code == 400
+
+
+@pytest.mark.django_db
+def test_admin_changelists_bounded_queries(client, equipment_tree):
+    root, machine, unit, component = equipment_tree
+    for index in range(20):
+        Workshop.objects.create(name=f"Цех {index + 10}", site=root.workshop.site)
+    power = Characteristic.objects.create(name="Мощность", equipment_type=root.equipment_type, value_type="number")
+    for item in equipment_tree:
+        EquipmentCharacteristicValue.objects.create(equipment=item, characteristic=power, value="5")
+    client.force_login(User.objects.create_superuser("root", password="pass"))
+
+    def changelist(model, params):
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(f"/admin/catalog/{model}/", params)
+        assert response.status_code == 200
+        # Not counted: the shared cache and the savepoints around its writes.
+        return response, [
+            query["sql"] for query in queries.captured_queries
+            if "catalog_cache" not in query["sql"] and "SAVEPOINT" not in query["sql"]
+        ]
+
+    response, queries = changelist("equipment", {"workshop__id__exact": unit.workshop_id, "q": "Деталь"})
+    assert list(response.context["cl"].result_list) == [component]
+    content = response.content.decode()
+    assert 'value="%s" selected' % unit.workshop_id in content and "catalog/admin/autocomplete_filter.js" in content
+    # No filter sidebar lists whole tables, and the total is not counted separately.
+    assert not any('FROM "catalog_workshop"' in sql and "WHERE" not in sql for sql in queries)
+    assert sum("COUNT(*)" in sql for sql in queries) == 1
+    assert len(queries) <= 6
+
+    response, queries = changelist("equipmentcharacteristicvalue", {"q": "Л001"})
+    assert {value.equipment_id for value in response.context["cl"].result_list} == {machine.id, unit.id, component.id}
+    # Session, user, the user's roles, the count and the page.
+    assert len(queries) <= 5
+
+    response = client.get("/admin/autocomplete/", {
+        "term": "Узел", "app_label": "catalog", "model_name": "equipment", "field_name": "parent",
+    })
+    assert [item["id"] for item in response.json()["results"]] == [str(unit.id)]
+
+
+@pytest.mark.django_db
+def test_bulk_move_with_subtrees(
+    api_client, manager_user, equipment_tree, site, monkeypatch, django_capture_on_commit_callbacks
+):
+    monkeypatch.setattr(RoleRateThrottle, "THROTTLE_RATES", {"user": "100/min"})
+    api_client.force_authenticate(manager_user)
+    root, machine, unit, component = equipment_tree
+    target = Workshop.objects.create(name="Цех 3", site=site)
+
+    def counters():
+        return {
+            (workshop_id, type_id): count
+            for workshop_id, type_id, count in EquipmentCounter.objects.filter(count__gt=0).values_list(
+                "workshop_id", "equipment_type_id", "count"
+            )
+        }
+
+    def move(payload):
+        return api_client.post("/api/equipment/move/", payload, format="json")
+
+    response = move({"ids": [machine.id], "parent": component.id})
+    assert response.status_code == 400 and "cycle" in str(response.data["parent"])
+    assert move({"ids": [machine.id, 999999], "workshop": target.id}).status_code == 400
+    assert move({"ids": [machine.id]}).status_code == 400
+
+    with django_capture_on_commit_callbacks(execute=True), CaptureQueriesContext(connection) as queries:
+        response = move({"ids": [machine.id], "workshop": target.id, "with_descendants": True})
+    assert response.status_code == 200
+    assert response.data == {
+        "items": 1, "descendants": 2, "moved": 3, "workshop_changed": 3, "reparented": 0, "unchanged": 0,
+    }
+    updates = [query["sql"] for query in queries.captured_queries
+               if query["sql"].startswith('UPDATE "catalog_equipment"')]
+    assert len(updates) == 1
+    assert set(Equipment.objects.filter(workshop=target).values_list("id", flat=True)) == {
+        machine.id, unit.id, component.id,
+    }
+    assert counters() == count_groups()
+    assert set(SyncChange.objects.values_list("object_id", flat=True)) >= {machine.id, unit.id, component.id}
+    entry = EquipmentHistory.objects.filter(equipment_id=unit.id).latest("id")
+    assert (entry.source, entry.user_id) == ("api", manager_user.id)
+    assert entry.changes == {"workshop": [unit.workshop_id, target.id]}
+
+    # Listed items below other listed items keep their parent.
+    response = move({"ids": [unit.id, component.id], "parent": root.id, "with_descendants": True})
+    assert response.data["reparented"] == 1
+    assert dict(Equipment.objects.filter(id__in=[unit.id, component.id]).values_list("id", "parent_id")) == {
+        unit.id: root.id, component.id: unit.id,
+    }
+    response = move({"ids": [machine.id], "parent": None})
+    assert response.data["reparented"] == 1
+    assert Equipment.objects.get(pk=machine.pk).parent_id is None
+
+
+@pytest.mark.django_db
+def test_passport_previews(api_client, viewer_user, equipment_data, tmp_path, settings, monkeypatch):
+    settings.MEDIA_ROOT = str(tmp_path)
+    monkeypatch.setattr(RoleRateThrottle, "THROTTLE_RATES", {"user": "100/min"})
+    storage = Equipment._meta.get_field("passport_scan").storage
+
+    def save_scan(color, size=(1200, 800)):
+        buffer = io.BytesIO()
+        Image.new("RGB", size, color).save(buffer, "PNG")
+        return storage.save("scan.png", ContentFile(buffer.getvalue()))
+
+    first = save_scan("red")
+    equipment_data.passport_scan.name = first
+    equipment_data.save(update_fields=["passport_scan"])
+    assert Job.objects.filter(kind="passport_previews", params={"scan": first}).count() == 1
+    work(burst=True)
+    assert (tmp_path / preview_name(first)).exists()
+
+    api_client.force_authenticate(viewer_user)
+    detail = api_client.get(f"/api/equipment/{equipment_data.id}/").data["passport_preview"]
+    assert f"/api/equipment/{equipment_data.id}/passport-preview/?v=" in detail
+    fast = api_client.get("/api/equipment/?page_size=50").content
+    monkeypatch.setattr(EquipmentViewSet, "list_reader_class", None)
+    assert api_client.get("/api/equipment/?page_size=50").content == fast
+    assert detail.encode() in fast
+
+    response = api_client.get(detail)
+    assert response.status_code == 200
+    assert response["Content-Type"] == "image/jpeg"
+    with Image.open(io.BytesIO(b"".join(response.streaming_content))) as preview:
+        assert max(preview.size) == settings.CATALOG_PREVIEW_SIZE
+
+    # A new scan gets a new URL; a missing preview is generated on first request.
+    second = save_scan("blue")
+    equipment_data.passport_scan.name = second
+    equipment_data.save(update_fields=["passport_scan"])
+    assert not (tmp_path / preview_name(second)).exists()
+    url = api_client.get(f"/api/equipment/{equipment_data.id}/").data["passport_preview"]
+    assert url != detail
+    assert api_client.get(url).status_code == 202
+    assert api_client.get(url).status_code == 202
+    assert Job.objects.filter(kind="passport_previews", params={"scan": second}).count() == 1
+    work(burst=True)
+    assert api_client.get(url).status_code == 200
+    assert (tmp_path / preview_name(second)).exists()
+
+    # Oversized scans fail for good; transient errors leave no marker, so they are retried.
+    huge = save_scan("green", (400, 300))
+    settings.CATALOG_PREVIEW_MAX_PIXELS = 400 * 300 - 1
+    assert generate_preview(huge) is False and preview_state(huge) == FAILED
+    settings.CATALOG_PREVIEW_MAX_PIXELS = 400 * 300
+    os.remove(tmp_path / f"{huge}{FAILED_SUFFIX}")
+
+    def timeout(path):
+        raise subprocess.TimeoutExpired("pdftoppm", settings.CATALOG_PREVIEW_TIMEOUT)
+
+    monkeypatch.setattr("catalog.previews._open_scan", timeout)
+    with pytest.raises(subprocess.TimeoutExpired):
+        generate_preview(huge)
+    assert not (tmp_path / f"{huge}{FAILED_SUFFIX}").exists()
+
+    os.utime(tmp_path / first, (0, 0))
+    os.utime(tmp_path / preview_name(first), (0, 0))
+    call_command("cleanup_passport_blobs", stdout=io.StringIO())
+    assert not (tmp_path / first).exists()
+    assert not (tmp_path / preview_name(first)).exists()
+    assert (tmp_path / preview_name(second)).exists()
+
+
+@pytest.mark.django_db
+def test_background_jobs(api_client, viewer_user, manager_user, equipment_data, tmp_path, settings, monkeypatch):
+    settings.MEDIA_ROOT = str(tmp_path / "media")
+    settings.CATALOG_JOB_FILES_ROOT = str(tmp_path)
+    monkeypatch.setattr(RoleRateThrottle, "THROTTLE_RATES", {"user": "100/min"})
+    monkeypatch.setattr("catalog.jobs.JOB_KINDS", dict(JOB_KINDS))
+
+    def run_workers():
+        call_command("run_workers", "--processes", "0", "--burst", stdout=io.StringIO())
+
+    api_client.force_authenticate(viewer_user)
+    response = api_client.post("/api/jobs/", {"kind": "export", "params": {
+        "format": "csv", "filters": {"search": equipment_data.name},
+    }}, format="json")
+    assert response.status_code == 202
+    assert response.data["status"] == Job.STATUS_QUEUED
+    export_url = f"/api/jobs/{response.data['id']}/"
+    assert api_client.post("/api/jobs/", {"kind": "rebuild_stats"}, format="json").status_code == 403
+    assert api_client.post("/api/jobs/", {"kind": "nope"}, format="json").status_code == 400
+
+    api_client.force_authenticate(manager_user)
+    content = f"inventory_number,name,site,workshop,equipment_type\n" \
+              f"{equipment_data.inventory_number},Переименован,{equipment_data.workshop.site.name}," \
+              f"{equipment_data.workshop.name},{equipment_data.equipment_type.name}\n"
+    assert api_client.post("/api/jobs/", {"kind": "import"}, format="json").status_code == 400
+    response = api_client.post("/api/jobs/", {
+        "kind": "import",
+        "params": '{"file": "../../etc/passwd"}',
+        "file": SimpleUploadedFile("import.csv", content.encode("utf-8-sig")),
+    }, format="multipart")
+    assert response.status_code == 202
+    import_url = f"/api/jobs/{response.data['id']}/"
+    assert response.data["params"]["file"] == f"jobs/{response.data['id']}/import.csv"
+    assert api_client.get("/api/jobs/").data["count"] == 1
+
+    run_workers()
+    job = api_client.get(import_url).data
+    assert job["status"] == Job.STATUS_SUCCEEDED, job["error"]
+    assert job["result"]["updated"] == 1
+    equipment_data.refresh_from_db()
+    assert equipment_data.name == "Переименован"
+
+    api_client.force_authenticate(viewer_user)
+    assert api_client.get(import_url).status_code == 404
+    job = api_client.get(export_url).data
+    assert job["status"] == Job.STATUS_SUCCEEDED, job["error"]
+    assert job["progress_total"] == 1
+    download = api_client.get(job["download"])
+    assert download.status_code == 200
+    rows = list(csv.reader(io.StringIO(b"".join(download.streaming_content).decode("utf-8-sig"))))
+    assert [row[1] for row in rows[1:]] == [equipment_data.inventory_number]
+    # Job files stay out of MEDIA_ROOT, which is served without authentication.
+    assert (tmp_path / job["result"]["file"]).exists()
+    assert not (tmp_path / "media").exists()
+
+    # Failures are retried with a growing delay until the attempts run out.
+    calls = []
+
+    @job_kind("flaky")
+    def flaky(job, progress):
+        calls.append(job.attempts)
+        if len(calls) < 2:
+            raise RuntimeError("temporary")
+        return {"attempts": job.attempts}
+
+    job = enqueue("flaky", max_attempts=2)
+    run_workers()
+    job.refresh_from_db()
+    assert job.status == Job.STATUS_QUEUED
+    assert job.run_after > timezone.now()
+    assert "temporary" in job.error
+    Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+    run_workers()
+    job.refresh_from_db()
+    assert job.status == Job.STATUS_SUCCEEDED
+    assert job.result == {"attempts": 2}
+
+    calls.clear()
+    job = enqueue("flaky", max_attempts=1)
+    run_workers()
+    job.refresh_from_db()
+    assert job.status == Job.STATUS_FAILED
+    assert job.finished_at is not None
+
+    # A job whose worker stopped sending heartbeats is queued again.
+    lost = enqueue("flaky")
+    Job.objects.filter(pk=lost.pk).update(
+        status=Job.STATUS_RUNNING, attempts=1, heartbeat_at=timezone.now() - timedelta(hours=1)
+    )
+    assert requeue_lost_jobs() == (1, 0)
+    assert Job.objects.get(pk=lost.pk).status == Job.STATUS_QUEUED
+
+    # Finished jobs are deleted with their files after the retention period, as are files of deleted jobs.
+    export_id, import_id = export_url.split("/")[-2], import_url.split("/")[-2]
+    Job.objects.filter(pk=export_id).update(finished_at=timezone.now() - timedelta(days=30))
+    leftover = tmp_path / "jobs" / "999999"
+    leftover.mkdir()
+    os.utime(leftover, (0, 0))
+    call_command("prune_jobs", stdout=io.StringIO())
+    assert not Job.objects.filter(pk=export_id).exists()
+    assert sorted(path.name for path in (tmp_path / "jobs").iterdir()) == [import_id]
+
+
+@pytest.mark.django_db
+def test_csv_export_streams_under_asgi(viewer_user, equipment_tree, settings, monkeypatch):
+    settings.CATALOG_EXPORT_CHUNK_SIZE = 1
+    produced = []
+    iter_csv = export.iter_csv
+
+    def counting_iter_csv(queryset, *args, **kwargs):
+        for chunk in iter_csv(queryset, *args, **kwargs):
+            produced.append(chunk)
+            yield chunk
+
+    monkeypatch.setattr(export, "iter_csv", counting_iter_csv)
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": "/api/equipment/export/", "raw_path": b"/api/equipment/export/", "query_string": b"",
+        "root_path": "", "server": ("testserver", 80), "client": ("127.0.0.1", 1),
+        "headers": [(b"host", b"testserver"), (b"authorization", f"Bearer {AccessToken.for_user(viewer_user)}".encode())],
+    }
+    messages = []
+    received = []
+
+    async def receive():
+        if received:
+            # No disconnect: wait until the handler is done and cancels the listener.
+            await asyncio.Event().wait()
+        received.append(True)
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append((message, len(produced)))
+
+    # Keep the test database connection open, as the test client does.
+    request_started.disconnect(close_old_connections)
+    request_finished.disconnect(close_old_connections)
+    try:
+        async_to_sync(ASGIHandler())(scope, receive, send)
+    finally:
+        request_started.connect(close_old_connections)
+        request_finished.connect(close_old_connections)
+
+    start, _ = messages[0]
+    assert start["status"] == 200
+    bodies = [(message["body"], count) for message, count in messages[1:] if message.get("body")]
+    assert b"".join(body for body, _ in bodies).decode("utf-8-sig").count("\n") == len(equipment_tree) + 1
+    # The first rows went out before the rest of the file was produced.
+    assert bodies[0][1] < len(produced)
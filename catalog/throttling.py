@@ -0,0 +1,93 @@
+import time
+
+from django.db import connections, router
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle, SimpleRateThrottle
+
+from .models import ThrottleBucket
+from .roles import get_user_roles
+
+
+def take_token(key, capacity, per_second, now=None):
+    """
+    Refill bucket ``key`` for the time since its last use and take one token,
+    in a single upsert so concurrent requests of every worker serialize on the
+    row. Returns ``(allowed, tokens_left)``; a refused request takes nothing.
+    """
+    now = time.time() if now is None else now
+    connection = connections[router.db_for_write(ThrottleBucket)]
+    least, greatest = ("MIN", "MAX") if connection.vendor == "sqlite" else ("LEAST", "GREATEST")
+    quote = connection.ops.quote_name
+    table = quote(ThrottleBucket._meta.db_table)
+    key_column, tokens, updated_at, allowed = (quote(name) for name in ("key", "tokens", "updated_at", "allowed"))
+    refilled = (
+        f"{least}(%(capacity)s, {table}.{tokens} + {greatest}(0, %(now)s - {table}.{updated_at}) * %(per_second)s)"
+    )
+    sql = f"""
+        INSERT INTO {table} ({key_column}, {tokens}, {updated_at}, {allowed})
+        VALUES (%(key)s, %(capacity)s - 1, %(now)s, %(allowed)s)
+        ON CONFLICT ({key_column}) DO UPDATE SET
+            {tokens} = CASE WHEN {refilled} >= 1 THEN {refilled} - 1 ELSE {refilled} END,
+            {allowed} = {refilled} >= 1,
+            {updated_at} = {greatest}({table}.{updated_at}, %(now)s)
+        RETURNING {allowed}, {tokens}
+    """
+    params = {"key": key, "capacity": float(capacity), "per_second": float(per_second), "now": now, "allowed": True}
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        granted, left = cursor.fetchone()
+    return bool(granted), left
+
+
+def prune_buckets(idle_seconds, now=None):
+    """Delete buckets unused for ``idle_seconds``; any bucket full again is as good as a new one."""
+    now = time.time() if now is None else now
+    return ThrottleBucket.objects.filter(updated_at__lt=now - idle_seconds).delete()[0]
+
+
+class RoleRateThrottle(BaseThrottle):
+    """
+    Token bucket per user (per address without login) stored in one
+    ``ThrottleBucket`` row, so all workers share the limit and the state stays
+    the same size however many requests arrive. A rate of ``N/period`` allows
+    bursts of ``N`` and refills ``N`` tokens per period.
+
+    A user gets the most generous ``DEFAULT_THROTTLE_RATES`` entry among their
+    role groups (``Admin``, ``Manager``, ``Viewer``), otherwise ``user``;
+    anonymous clients get ``anon``.
+    """
+    THROTTLE_RATES = api_settings.DEFAULT_THROTTLE_RATES
+    parse_rate = SimpleRateThrottle.parse_rate
+
+    def __init__(self):
+        self.retry_after = None
+
+    def get_rate(self, request):
+        if request.user and request.user.is_authenticated:
+            rates = [self.THROTTLE_RATES[role] for role in get_user_roles(request.user) if self.THROTTLE_RATES.get(role)]
+            if rates:
+                return max(rates, key=self.per_second)
+            return self.THROTTLE_RATES.get("user")
+        return self.THROTTLE_RATES.get("anon")
+
+    def per_second(self, rate):
+        num_requests, duration = self.parse_rate(rate)
+        return num_requests / duration
+
+    def get_bucket_key(self, request):
+        if request.user and request.user.is_authenticated:
+            return f"user:{request.user.pk}"
+        return f"anon:{self.get_ident(request)}"
+
+    def allow_request(self, request, view):
+        rate = self.get_rate(request)
+        if rate is None:
+            return True
+        capacity, _ = self.parse_rate(rate)
+        per_second = self.per_second(rate)
+        allowed, tokens = take_token(self.get_bucket_key(request), capacity, per_second)
+        self.retry_after = None if allowed else (1 - tokens) / per_second
+        return allowed
+
+    def wait(self):
+        return self.retry_after
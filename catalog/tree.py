@@ -0,0 +1,106 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models.expressions import RawSQL
+
+from .models import Equipment
+
+
+class TreeTooDeep(Exception):
+    """The tree goes deeper than ``CATALOG_TREE_MAX_DEPTH``, so a walk would be incomplete."""
+
+
+def _table():
+    return connection.ops.quote_name(Equipment._meta.db_table)
+
+
+def descendants(root_ids, max_depth=None):
+    """
+    Subquery of the ids below ``root_ids`` (roots excluded), for use as
+    ``filter(id__in=descendants(...))``.
+
+    The tree is walked with a recursive CTE over ``parent_id`` on every call,
+    so results always reflect the current parents. Depth is capped by
+    ``CATALOG_TREE_MAX_DEPTH`` which also bounds the walk if a cycle exists.
+    """
+    root_ids = list(root_ids)
+    depth = min(max_depth or settings.CATALOG_TREE_MAX_DEPTH, settings.CATALOG_TREE_MAX_DEPTH)
+    placeholders = ", ".join(["%s"] * len(root_ids))
+    table = _table()
+    sql = f"""
+        WITH RECURSIVE subtree(id, depth) AS (
+            SELECT id, 1 FROM {table} WHERE parent_id IN ({placeholders})
+            UNION ALL
+            SELECT child.id, subtree.depth + 1 FROM {table} child
+            JOIN subtree ON child.parent_id = subtree.id
+            WHERE subtree.depth < %s
+        )
+        SELECT id FROM subtree
+    """
+    return RawSQL(sql, (*root_ids, depth))
+
+
+def exceeds_max_depth(root_ids):
+    """
+    Whether equipment lies more than ``CATALOG_TREE_MAX_DEPTH`` levels below
+    ``root_ids``, so ``descendants()`` would leave it out.
+    """
+    root_ids = list(root_ids)
+    placeholders = ", ".join(["%s"] * len(root_ids))
+    table = _table()
+    sql = f"""
+        WITH RECURSIVE subtree(id, depth) AS (
+            SELECT id, 1 FROM {table} WHERE parent_id IN ({placeholders})
+            UNION ALL
+            SELECT child.id, subtree.depth + 1 FROM {table} child
+            JOIN subtree ON child.parent_id = subtree.id
+            WHERE subtree.depth < %s
+        )
+        SELECT 1 FROM subtree JOIN {table} child ON child.parent_id = subtree.id
+        WHERE subtree.depth = %s LIMIT 1
+    """
+    depth = settings.CATALOG_TREE_MAX_DEPTH
+    with connection.cursor() as cursor:
+        cursor.execute(sql, (*root_ids, depth, depth))
+        return cursor.fetchone() is not None
+
+
+def path_to(item_id):
+    """Subquery of ``item_id`` and all of its ancestors."""
+    return paths_to([item_id])
+
+
+def paths_to(item_ids):
+    """Subquery of ``item_ids`` and all of their ancestors."""
+    item_ids = list(item_ids)
+    placeholders = ", ".join(["%s"] * len(item_ids))
+    table = _table()
+    sql = f"""
+        WITH RECURSIVE path(id, parent_id, depth) AS (
+            SELECT id, parent_id, 0 FROM {table} WHERE id IN ({placeholders})
+            UNION ALL
+            SELECT parent.id, parent.parent_id, path.depth + 1 FROM {table} parent
+            JOIN path ON parent.id = path.parent_id
+            WHERE path.depth < %s
+        )
+        SELECT id FROM path
+    """
+    return RawSQL(sql, (*item_ids, settings.CATALOG_TREE_MAX_DEPTH))
+
+
+def ancestors(queryset, item_id):
+    """
+    Ancestors of ``item_id`` ordered from the root down, fetched in one query.
+    Raises ``TreeTooDeep`` when the root is beyond ``CATALOG_TREE_MAX_DEPTH``.
+    """
+    nodes = {node.pk: node for node in queryset.filter(id__in=path_to(item_id))}
+    if item_id not in nodes:
+        return None
+    chain = []
+    parent_id = nodes[item_id].parent_id
+    while parent_id in nodes and len(chain) < len(nodes):
+        chain.append(nodes[parent_id])
+        parent_id = nodes[parent_id].parent_id
+    if parent_id is not None:
+        raise TreeTooDeep(f"Equipment {item_id} is more than {settings.CATALOG_TREE_MAX_DEPTH} levels deep.")
+    chain.reverse()
+    return chain
@@ -1,13 +1,17 @@
 from django.urls import path, include
-from rest_framework.routers import DefaultRouter
 
-from catalog.views import SiteViewSet, WorkshopViewSet, EquipmentTypeViewSet, EquipmentViewSet
+from catalog.async_views import AsyncReadRouter
+from catalog.views import (SiteViewSet, WorkshopViewSet, EquipmentTypeViewSet, EquipmentViewSet, JobViewSet,
+                           PassportUploadViewSet, SyncViewSet)
 
-router = DefaultRouter()
+router = AsyncReadRouter()
 router.register("sites", SiteViewSet)
 router.register("workshops", WorkshopViewSet)
 router.register("equipment-types", EquipmentTypeViewSet)
 router.register("equipment", EquipmentViewSet)
+router.register("passport-uploads", PassportUploadViewSet)
+router.register("sync", SyncViewSet, basename="sync")
+router.register("jobs", JobViewSet)
 
 urlpatterns = [
     path("", include(router.urls)),
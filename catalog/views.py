@@ -1,42 +1,440 @@
-from drf_spectacular.utils import extend_schema
-from rest_framework.viewsets import ModelViewSet
-from rest_framework.throttling import UserRateThrottle
+import os
+import shutil
+import tempfile
 
-from .models import Site, Workshop, EquipmentType, Equipment
-from .serializers import (SiteSerializer, WorkshopSerializer, EquipmentTypeSerializer, EquipmentSerializer)
-from .permissions import RolesPermissions
-from .filters import EquipmentFilter
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
+from django.db.models import Q
+from django.http import FileResponse, Http404
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import OpenApiParameter, extend_schema
+from django_filters.rest_framework import DjangoFilterBackend
+from rest_framework.decorators import action
+from rest_framework.filters import OrderingFilter
+from rest_framework.utils.urls import replace_query_param
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from rest_framework import mixins, status
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
+from rest_framework.viewsets import GenericViewSet, ModelViewSet
 
+from .models import Site, Workshop, EquipmentType, Equipment, Job, PassportUpload
+from .serializers import (SiteSerializer, WorkshopSerializer, EquipmentTypeSerializer, EquipmentSerializer,
+                          EquipmentBulkItemSerializer, EquipmentFieldSelection, EquipmentListReader,
+                          EquipmentHistorySerializer, EquipmentLookupSerializer, EquipmentMoveSerializer,
+                          JobSerializer, PassportUploadSerializer)
+from .storage import hash_file, job_storage
+from .async_views import AsyncReadMixin
+from .instrumentation import PhaseTimingMixin
+from .throttling import RoleRateThrottle
+from .bulk import bulk_move_equipment, bulk_upsert_equipment
+from .cache import CachedReferenceMixin
+from .export import csv_response, write_xlsx
+from .stats import equipment_stats
+from .sync import read_feed
+from .history import ChangeHistoryMixin, capture_history, history_page
+from .roles import ROLE_ADMIN, get_user_roles
+from .previews import FAILED, READY, can_preview, preview_name, preview_state
+from .jobs import schedule_preview
+from .tree import TreeTooDeep, ancestors, descendants, exceeds_max_depth
+from .permissions import JobPermissions, RolesPermissions
+from .filters import EquipmentFilter, EquipmentSearchFilter
+from .pagination import EquipmentPagination, positive_int
 
-class SiteViewSet(ModelViewSet):
+
+class SiteViewSet(PhaseTimingMixin, CachedReferenceMixin, AsyncReadMixin, ModelViewSet):
+    cache_namespace = "sites"
     queryset = Site.objects.all()
     serializer_class = SiteSerializer
     permission_classes = [RolesPermissions]
-    throttle_classes = [UserRateThrottle]
+    throttle_classes = [RoleRateThrottle]
 
 
-class WorkshopViewSet(ModelViewSet):
+class WorkshopViewSet(PhaseTimingMixin, CachedReferenceMixin, AsyncReadMixin, ModelViewSet):
+    cache_namespace = "workshops"
     queryset = Workshop.objects.select_related("site")
     serializer_class = WorkshopSerializer
     permission_classes = [RolesPermissions]
-    throttle_classes = [UserRateThrottle]
+    throttle_classes = [RoleRateThrottle]
 
 
-class EquipmentTypeViewSet(ModelViewSet):
+class EquipmentTypeViewSet(PhaseTimingMixin, CachedReferenceMixin, AsyncReadMixin, ModelViewSet):
+    cache_namespace = "equipment-types"
     queryset = EquipmentType.objects.prefetch_related("characteristics")
     serializer_class = EquipmentTypeSerializer
     permission_classes = [RolesPermissions]
-    throttle_classes = [UserRateThrottle]
+    throttle_classes = [RoleRateThrottle]
 
 
 @extend_schema(description="Equipment API")
-class EquipmentViewSet(ModelViewSet):
-    queryset = Equipment.objects.select_related(
-        "equipment_type", "workshop", "workshop__site", "parent"
-    ).prefetch_related("characteristic_values__characteristic")
+class EquipmentViewSet(ChangeHistoryMixin, PhaseTimingMixin, AsyncReadMixin, ModelViewSet):
+    """
+    Reads take ``?fields=a,b`` and ``?expand=characteristics,parent,children``;
+    the queryset joins and prefetches only what the response renders.
+    """
+    queryset = Equipment.objects.all()
     serializer_class = EquipmentSerializer
+    filter_backends = [DjangoFilterBackend, EquipmentSearchFilter, OrderingFilter]
     filterset_class = EquipmentFilter
     search_fields = ["name", "inventory_number"]
     ordering_fields = ["name", "created_at"]
+    pagination_class = EquipmentPagination
+    list_reader_class = EquipmentListReader
+    permission_classes = [RolesPermissions]
+    throttle_classes = [RoleRateThrottle]
+    selectable_actions = ("list", "retrieve", "descendants", "ancestors", "lookup")
+    # POST actions that only read: allowed to viewers and served like GET by catalog.db_router.
+    read_only_actions = ("lookup",)
+
+    def get_field_selection(self):
+        if not hasattr(self, "_field_selection"):
+            params = self.request.query_params if self.action in self.selectable_actions else {}
+            self._field_selection = EquipmentFieldSelection.from_params(params)
+        return self._field_selection
+
+    def get_queryset(self):
+        return self.get_field_selection().apply(super().get_queryset())
+
+    def get_serializer(self, *args, **kwargs):
+        if self.action in self.selectable_actions:
+            kwargs = {**self.get_field_selection().serializer_kwargs(), **kwargs}
+        return super().get_serializer(*args, **kwargs)
+
+    def get_list_reader_kwargs(self):
+        return {"selection": self.get_field_selection(), "request": self.request}
+
+    @extend_schema(request=EquipmentBulkItemSerializer(many=True), description="Bulk upsert by inventory_number")
+    @action(detail=False, methods=["post"], url_path="bulk")
+    def bulk(self, request):
+        if not isinstance(request.data, list):
+            raise ValidationError({"non_field_errors": ["Expected a list of items."]})
+        if len(request.data) > settings.CATALOG_BULK_MAX_ITEMS:
+            raise ValidationError({"non_field_errors": [f"At most {settings.CATALOG_BULK_MAX_ITEMS} items per request."]})
+        with self.capture_history_for():
+            return Response(bulk_upsert_equipment(request.data))
+
+    @extend_schema(
+        request=EquipmentMoveSerializer,
+        responses=OpenApiTypes.OBJECT,
+        description="Move items (optionally with their subtrees) to another workshop and/or parent in one "
+                    "operation; a parent inside a moved subtree is rejected as a cycle",
+    )
+    @action(detail=False, methods=["post"])
+    def move(self, request):
+        serializer = EquipmentMoveSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        try:
+            with self.capture_history_for():
+                summary = bulk_move_equipment(
+                    data["ids"],
+                    workshop=data.get("workshop"),
+                    parent=data.get("parent"),
+                    with_descendants=data["with_descendants"],
+                    move_parent="parent" in data,
+                )
+        except DjangoValidationError as exc:
+            raise ValidationError(exc.message_dict)
+        return Response(summary)
+
+    @extend_schema(
+        request=EquipmentLookupSerializer,
+        description="Fetch many items by id and/or exact inventory number in one query (?fields=, ?expand= apply); "
+                    "keys that match nothing are listed under 'missing'",
+    )
+    @action(detail=False, methods=["post"])
+    def lookup(self, request):
+        keys = EquipmentLookupSerializer(data=request.data)
+        keys.is_valid(raise_exception=True)
+        ids, numbers = keys.validated_data["ids"], keys.validated_data["inventory_numbers"]
+        items = list(self.get_queryset().filter(Q(id__in=ids) | Q(inventory_number__in=numbers)))
+        by_id = {item.id: item for item in items}
+        by_number = {item.inventory_number: item for item in items}
+
+        found = {}
+        for item in [by_id.get(key) for key in ids] + [by_number.get(key) for key in numbers]:
+            if item is not None:
+                found.setdefault(item.id, item)
+        return Response({
+            "results": self.get_serializer(list(found.values()), many=True).data,
+            "missing": {
+                "ids": [key for key in dict.fromkeys(ids) if key not in by_id],
+                "inventory_numbers": [key for key in dict.fromkeys(numbers) if key not in by_number],
+            },
+        })
+
+    @extend_schema(description="Stream the filtered catalog as CSV or XLSX (?export_format=csv|xlsx)")
+    @action(detail=False, methods=["get"], url_path="export")
+    def export(self, request):
+        queryset = self.filter_queryset(self.get_queryset())
+        export_format = request.query_params.get("export_format", "csv")
+        if export_format == "csv":
+            return csv_response(queryset, request._request)
+        if export_format == "xlsx":
+            fileobj = tempfile.TemporaryFile()
+            write_xlsx(queryset, fileobj)
+            fileobj.seek(0)
+            return FileResponse(fileobj, as_attachment=True, filename="equipment.xlsx")
+        raise ValidationError({"export_format": ["Expected csv or xlsx."]})
+
+    @extend_schema(description="Equipment counts per site, workshop and type from incrementally maintained counters")
+    @action(detail=False, methods=["get"])
+    def stats(self, request):
+        return Response(equipment_stats())
+
+    @extend_schema(description="All equipment below this item (?max_depth=N), with the list filters applied")
+    @action(detail=True, methods=["get"])
+    def descendants(self, request, pk=None):
+        if not str(pk).isdigit() or not Equipment.objects.filter(pk=pk).exists():
+            raise Http404
+        max_depth = request.query_params.get("max_depth")
+        limit = settings.CATALOG_TREE_MAX_DEPTH
+        if max_depth is not None and (not max_depth.isdigit() or not 1 <= int(max_depth) <= limit):
+            raise ValidationError({"max_depth": [f"Expected an integer between 1 and {limit}."]})
+        if max_depth is None and exceeds_max_depth([pk]):
+            raise ValidationError({"max_depth": [f"The subtree is more than {limit} levels deep; pass max_depth."]})
+        queryset = self.filter_queryset(self.get_queryset()).filter(
+            id__in=descendants([pk], int(max_depth) if max_depth else None)
+        )
+        queryset = self.get_list_queryset(queryset)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.serialize_list(page))
+        return Response(self.serialize_list(queryset))
+
+    @extend_schema(description="Ancestor path of this item, from the root down")
+    @action(detail=True, methods=["get"])
+    def ancestors(self, request, pk=None):
+        try:
+            chain = ancestors(self.get_queryset(), int(pk) if str(pk).isdigit() else None)
+        except TreeTooDeep as exc:
+            raise ValidationError({"detail": str(exc)})
+        if chain is None:
+            raise Http404
+        return Response(self.get_serializer(chain, many=True).data)
+
+    @extend_schema(
+        description="Change history of this item, newest first; follow ``next`` for older entries",
+        parameters=[
+            OpenApiParameter("cursor", int, description="Return entries older than this entry id"),
+            OpenApiParameter("limit", int, description="Entries per page"),
+        ],
+        responses=EquipmentHistorySerializer(many=True),
+    )
+    @action(detail=True, methods=["get"])
+    def history(self, request, pk=None):
+        if not str(pk).isdigit():
+            raise Http404
+        try:
+            limit = positive_int(request.query_params.get("limit", 50), settings.CATALOG_MAX_PAGE_SIZE)
+        except ValueError:
+            raise ValidationError({"limit": ["Expected a positive integer."]})
+        cursor = request.query_params.get("cursor")
+        if cursor is not None and not cursor.isdigit():
+            raise ValidationError({"cursor": ["Expected an entry id."]})
+        cursor = int(cursor) if cursor else None
+        entries, next_cursor = history_page(int(pk), cursor, limit)
+        if not entries and cursor is None and not Equipment.objects.filter(pk=pk).exists():
+            raise Http404
+        url = request.build_absolute_uri()
+        return Response({
+            "next": replace_query_param(url, "cursor", next_cursor) if next_cursor else None,
+            "results": EquipmentHistorySerializer(entries, many=True).data,
+        })
+
+    @extend_schema(
+        description="JPEG preview of the passport scan; 202 with Retry-After while it is being generated",
+        responses={(200, "image/jpeg"): OpenApiTypes.BINARY, 202: None},
+    )
+    @action(detail=True, methods=["get"], url_path="passport-preview")
+    def passport_preview(self, request, pk=None):
+        equipment = get_object_or_404(Equipment.objects.only("id", "passport_scan"), pk=pk)
+        name = equipment.passport_scan.name
+        if not can_preview(name):
+            raise Http404
+        state = preview_state(name)
+        if state == FAILED:
+            raise Http404
+        if state != READY:
+            schedule_preview(name)
+            return Response(status=status.HTTP_202_ACCEPTED, headers={"Retry-After": "2"})
+        storage = equipment.passport_scan.storage
+        response = FileResponse(storage.open(preview_name(name)), content_type="image/jpeg")
+        # The URL carries the scan version, so a cached preview never goes stale.
+        response["Cache-Control"] = "private, max-age=31536000, immutable"
+        return response
+
+
+class PassportUploadViewSet(PhaseTimingMixin, mixins.CreateModelMixin, mixins.RetrieveModelMixin, GenericViewSet):
+    """
+    Resumable passport scan uploads: create a session, PUT raw chunks to
+    ``chunk/`` with an ``Upload-Offset`` header, then POST ``complete/``.
+    After a dropped connection the client reads ``offset`` and continues.
+    """
+    queryset = PassportUpload.objects.all()
+    serializer_class = PassportUploadSerializer
     permission_classes = [RolesPermissions]
-    throttle_classes = [UserRateThrottle]
+    throttle_classes = [RoleRateThrottle]
+    read_chunk_size = 1024 * 1024
+
+    @property
+    def storage(self):
+        return Equipment._meta.get_field("passport_scan").storage
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if ROLE_ADMIN in get_user_roles(self.request.user):
+            return queryset
+        return queryset.filter(created_by=self.request.user.pk)
+
+    def perform_create(self, serializer):
+        upload = serializer.save(created_by=self.request.user)
+        open(self.storage.temporary_path(upload.part_name), "wb").close()
+
+    def check_chunk(self, upload, offset, length):
+        """Raise for a chunk that cannot be appended; a ``409`` response when ``offset`` is stale."""
+        if upload.completed_at:
+            raise ValidationError({"detail": "Upload is already completed."})
+        if offset != upload.offset:
+            return Response(self.get_serializer(upload).data, status=status.HTTP_409_CONFLICT)
+        if upload.offset + length > upload.size:
+            raise ValidationError({"detail": "Chunk exceeds the declared size."})
+        return None
+
+    @extend_schema(request={"application/octet-stream": {"type": "string", "format": "binary"}})
+    @action(detail=True, methods=["put"])
+    def chunk(self, request, pk=None):
+        offset = request.headers.get("Upload-Offset", "")
+        if not offset.isdigit():
+            raise ValidationError({"Upload-Offset": ["Header is required."]})
+        offset = int(offset)
+        length = request.headers.get("Content-Length") or "0"
+        if not length.isdigit():
+            raise ValidationError({"Content-Length": ["Must be a whole number of bytes."]})
+        length = int(length)
+        if length > settings.CATALOG_UPLOAD_MAX_CHUNK:
+            raise ValidationError({"detail": f"Chunks are limited to {settings.CATALOG_UPLOAD_MAX_CHUNK} bytes."})
+        conflict = self.check_chunk(self.get_object(), offset, length)
+        if conflict:
+            return conflict
+
+        # The body arrives at the client's pace, so it is staged without holding the upload's row lock;
+        # the lock is only taken to check the offset again and append the staged bytes.
+        staged = self.storage.temporary_path()
+        try:
+            written = 0
+            with open(staged, "wb") as destination:
+                stream = request.stream
+                while stream is not None and written < length:
+                    data = stream.read(min(self.read_chunk_size, length - written))
+                    if not data:
+                        break
+                    destination.write(data)
+                    written += len(data)
+            with transaction.atomic():
+                upload = get_object_or_404(self.get_queryset().select_for_update(), pk=pk)
+                conflict = self.check_chunk(upload, offset, written)
+                if conflict:
+                    return conflict
+                with open(self.storage.temporary_path(upload.part_name), "r+b") as part, open(staged, "rb") as data:
+                    part.seek(upload.offset)
+                    part.truncate()
+                    shutil.copyfileobj(data, part, self.read_chunk_size)
+                upload.offset += written
+                upload.save(update_fields=["offset", "updated_at"])
+        finally:
+            os.remove(staged)
+        return Response(self.get_serializer(upload).data)
+
+    @action(detail=True, methods=["post"])
+    def complete(self, request, pk=None):
+        upload = self.get_object()
+        if upload.completed_at:
+            return Response(self.get_serializer(upload).data)
+        if upload.offset != upload.size:
+            raise ValidationError({"detail": f"Received {upload.offset} of {upload.size} bytes."})
+        # Once every byte is received chunks can no longer change the file, so it is hashed before locking.
+        path = self.storage.temporary_path(upload.part_name)
+        digest = hash_file(path)
+        if upload.sha256 and upload.sha256.lower() != digest:
+            raise ValidationError({"sha256": ["Checksum does not match the uploaded content."]})
+
+        with transaction.atomic():
+            upload = get_object_or_404(self.get_queryset().select_for_update(), pk=pk)
+            if upload.completed_at:
+                return Response(self.get_serializer(upload).data)
+            upload.blob = self.storage.store_file(path, digest, os.path.splitext(upload.filename)[1])
+            upload.completed_at = timezone.now()
+            upload.save(update_fields=["blob", "completed_at", "updated_at"])
+            if upload.equipment_id:
+                equipment = upload.equipment
+                equipment.passport_scan.name = upload.blob
+                with capture_history("api", request.user):
+                    equipment.save(update_fields=["passport_scan", "updated_at"])
+        return Response(self.get_serializer(upload).data)
+
+
+class SyncViewSet(PhaseTimingMixin, GenericViewSet):
+    """
+    Changes feed for offline clients: GET with the ``token`` of the previous
+    page (none for a first sync) until ``has_more`` is false, then keep the
+    last ``next_token`` for the next sync. ``410`` means start over.
+    """
+    permission_classes = [RolesPermissions]
+    throttle_classes = [RoleRateThrottle]
+
+    @extend_schema(
+        description="Records created, updated or deleted since ?token=",
+        parameters=[
+            OpenApiParameter("token", str, description="next_token of the previous page; omit for a first sync"),
+            OpenApiParameter("limit", int, description="Changes per page"),
+        ],
+        responses=OpenApiTypes.OBJECT,
+    )
+    def list(self, request):
+        try:
+            limit = positive_int(request.query_params.get("limit", 500), settings.CATALOG_MAX_PAGE_SIZE)
+        except ValueError:
+            raise ValidationError({"limit": ["Expected a positive integer."]})
+        return Response(read_feed(request.query_params.get("token"), limit))
+
+
+class JobViewSet(PhaseTimingMixin, mixins.CreateModelMixin, mixins.ListModelMixin, mixins.RetrieveModelMixin,
+                 GenericViewSet):
+    """
+    Background jobs run by ``manage.py run_workers``: POST ``kind`` and
+    ``params`` (multipart with ``file`` for imports), then poll the job for
+    ``status`` and progress and fetch a produced file from ``download/``.
+    Users see their own jobs, admins every job.
+    """
+    queryset = Job.objects.order_by("-id")
+    serializer_class = JobSerializer
+    permission_classes = [JobPermissions]
+    throttle_classes = [RoleRateThrottle]
+    parser_classes = [JSONParser, MultiPartParser, FormParser]
+    filter_backends = [DjangoFilterBackend]
+    filterset_fields = ["status", "kind"]
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if ROLE_ADMIN in get_user_roles(self.request.user):
+            return queryset
+        return queryset.filter(created_by=self.request.user.pk)
+
+    def create(self, request, *args, **kwargs):
+        response = super().create(request, *args, **kwargs)
+        response.status_code = status.HTTP_202_ACCEPTED
+        return response
+
+    @extend_schema(description="File produced by the job, e.g. an export", responses=OpenApiTypes.BINARY)
+    @action(detail=True, methods=["get"])
+    def download(self, request, pk=None):
+        job = self.get_object()
+        name = (job.result or {}).get("file") if job.status == Job.STATUS_SUCCEEDED else None
+        storage = job_storage()
+        if not name or not storage.exists(name):
+            raise Http404
+        return FileResponse(storage.open(name), as_attachment=True, filename=os.path.basename(name))
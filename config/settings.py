@@ -82,17 +82,85 @@ REST_FRAMEWORK = {
         'rest_framework.filters.SearchFilter',
         'rest_framework.filters.OrderingFilter',
     ),
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    'DEFAULT_PAGINATION_CLASS': 'catalog.pagination.AsyncPageNumberPagination',
     'PAGE_SIZE': 2,
     'DEFAULT_THROTTLE_CLASSES': [
-        'rest_framework.throttling.UserRateThrottle',
+        'catalog.throttling.RoleRateThrottle',
     ],
+    # RoleRateThrottle: the best rate among the user's role groups, else 'user'.
     'DEFAULT_THROTTLE_RATES': {
+        'Admin': os.getenv("THROTTLE_RATE_ADMIN", '10000/day'),
+        'Manager': os.getenv("THROTTLE_RATE_MANAGER", '5000/day'),
+        'Viewer': os.getenv("THROTTLE_RATE_VIEWER", '2000/day'),
         'user': '1000/day',
+        'anon': '100/hour',
     },
     'DEFAULT_SCHEMA_CLASS': "drf_spectacular.openapi.AutoSchema",
 }
 
+CATALOG_MAX_PAGE_SIZE = int(os.getenv("CATALOG_MAX_PAGE_SIZE", 500))
+CATALOG_BULK_MAX_ITEMS = int(os.getenv("CATALOG_BULK_MAX_ITEMS", 50000))
+CATALOG_LOOKUP_MAX_ITEMS = int(os.getenv("CATALOG_LOOKUP_MAX_ITEMS", 1000))
+CATALOG_BULK_BATCH_SIZE = int(os.getenv("CATALOG_BULK_BATCH_SIZE", 1000))
+CATALOG_EXPORT_CHUNK_SIZE = int(os.getenv("CATALOG_EXPORT_CHUNK_SIZE", 2000))
+CATALOG_TREE_MAX_DEPTH = int(os.getenv("CATALOG_TREE_MAX_DEPTH", 32))
+CATALOG_REFERENCE_CACHE_TIMEOUT = int(os.getenv("CATALOG_REFERENCE_CACHE_TIMEOUT", 3600))
+CATALOG_UPLOAD_MAX_SIZE = int(os.getenv("CATALOG_UPLOAD_MAX_SIZE", 1024 ** 3))
+CATALOG_UPLOAD_MAX_CHUNK = int(os.getenv("CATALOG_UPLOAD_MAX_CHUNK", 16 * 1024 ** 2))
+CATALOG_SYNC_RETENTION_DAYS = int(os.getenv("CATALOG_SYNC_RETENTION_DAYS", 30))
+# Monthly partitions of the equipment history kept ahead of time (PostgreSQL).
+CATALOG_HISTORY_PARTITION_MONTHS = int(os.getenv("CATALOG_HISTORY_PARTITION_MONTHS", 3))
+# Admin changelists count exactly only when the planner estimates fewer rows than this.
+CATALOG_ADMIN_EXACT_COUNT_LIMIT = int(os.getenv("CATALOG_ADMIN_EXACT_COUNT_LIMIT", 10000))
+# Passport previews, rendered by the job workers: longest side in pixels, PDF render timeout,
+# and the largest scans (bytes, image pixels) that are rendered at all.
+CATALOG_PREVIEW_SIZE = int(os.getenv("CATALOG_PREVIEW_SIZE", 320))
+CATALOG_PREVIEW_TIMEOUT = int(os.getenv("CATALOG_PREVIEW_TIMEOUT", 60))
+CATALOG_PREVIEW_MAX_SIZE = int(os.getenv("CATALOG_PREVIEW_MAX_SIZE", 100 * 1024 ** 2))
+CATALOG_PREVIEW_MAX_PIXELS = int(os.getenv("CATALOG_PREVIEW_MAX_PIXELS", 50_000_000))
+# Background jobs (catalog.jobs, manage.py run_workers).
+CATALOG_JOB_WORKERS = int(os.getenv("CATALOG_JOB_WORKERS", 2))
+CATALOG_JOB_POLL_SECONDS = float(os.getenv("CATALOG_JOB_POLL_SECONDS", 2))
+CATALOG_JOB_MAX_ATTEMPTS = int(os.getenv("CATALOG_JOB_MAX_ATTEMPTS", 3))
+# Delay before the first retry, doubled after every further failed attempt.
+CATALOG_JOB_RETRY_SECONDS = int(os.getenv("CATALOG_JOB_RETRY_SECONDS", 30))
+CATALOG_JOB_PROGRESS_SECONDS = float(os.getenv("CATALOG_JOB_PROGRESS_SECONDS", 1))
+# A running job without a heartbeat for this long has lost its worker and is retried.
+CATALOG_JOB_STALE_SECONDS = int(os.getenv("CATALOG_JOB_STALE_SECONDS", 900))
+CATALOG_JOB_HEARTBEAT_SECONDS = float(os.getenv("CATALOG_JOB_HEARTBEAT_SECONDS", 60))
+# Finished jobs and their files are deleted after this many days (manage.py prune_jobs).
+CATALOG_JOB_RETENTION_DAYS = int(os.getenv("CATALOG_JOB_RETENTION_DAYS", 7))
+CATALOG_JOB_MAX_REJECTS = int(os.getenv("CATALOG_JOB_MAX_REJECTS", 1000))
+CATALOG_JOB_UPLOAD_MAX_SIZE = int(os.getenv("CATALOG_JOB_UPLOAD_MAX_SIZE", 512 * 1024 ** 2))
+# Uploaded and produced job files; outside MEDIA_ROOT, so only /api/jobs/<id>/download/ serves them.
+CATALOG_JOB_FILES_ROOT = os.getenv("CATALOG_JOB_FILES_ROOT", str(BASE_DIR / "jobfiles"))
+# Serve GET list/detail of the catalog viewsets from async views (see catalog.async_views).
+CATALOG_ASYNC_READS = os.getenv("CATALOG_ASYNC_READS", "1") == "1"
+# Share of requests profiled by catalog.instrumentation.ServerTimingMiddleware; set 1 to profile every request.
+CATALOG_TIMING_SAMPLE_RATE = float(os.getenv("CATALOG_TIMING_SAMPLE_RATE", 0.05))
+CATALOG_TIMING_SLOW_QUERIES = int(os.getenv("CATALOG_TIMING_SLOW_QUERIES", 3))
+CATALOG_TIMING_LOG = os.getenv("CATALOG_TIMING_LOG")
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "message": {"format": "%(message)s"},
+    },
+    "handlers": {
+        "timing": (
+            {"class": "logging.FileHandler", "filename": CATALOG_TIMING_LOG, "formatter": "message"}
+            if CATALOG_TIMING_LOG else {"class": "logging.StreamHandler", "formatter": "message"}
+        ),
+        "console": {"class": "logging.StreamHandler", "formatter": "message"},
+    },
+    "loggers": {
+        "catalog.timing": {"handlers": ["timing"], "level": "INFO", "propagate": False},
+        # Progress of the import_equipment worker processes.
+        "catalog.importer": {"handlers": ["console"], "level": "INFO", "propagate": False},
+    },
+}
+
 if "pytest" in sys.argv[0]:
     REST_FRAMEWORK["DEFAULT_THROTTLE_RATES"] = {
         "user": "2/minute",
@@ -106,6 +174,8 @@ SPECTACULAR_SETTINGS = {
 }
 
 MIDDLEWARE = [
+    'catalog.instrumentation.ServerTimingMiddleware',
+    'catalog.db_router.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -137,16 +207,53 @@ WSGI_APPLICATION = 'config.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/6.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
+# Connections come from a psycopg pool per process (DB_POOL=1, the default), which
+# suits ASGI where each request runs its sync code in a fresh thread. With DB_POOL=0
+# connections persist per thread for DB_CONN_MAX_AGE seconds instead. Either way a
+# connection is checked before it is handed out.
+# Read replicas: DB_REPLICA_HOSTS=host[:port],... routed by catalog.db_router.
+
+DB_POOL = os.getenv("DB_POOL", "1") == "1"
+
+
+def _database(host, port, pool=DB_POOL):
+    database = {
         'ENGINE': 'django.db.backends.postgresql',
         'NAME': os.getenv("DB_NAME"),
         'USER': os.getenv("DB_USER"),
         'PASSWORD': os.getenv("DB_PASSWORD"),
-        'HOST': os.getenv("DB_HOST"),
-        'PORT': os.getenv("DB_PORT"),
+        'HOST': host,
+        'PORT': port,
+        'CONN_MAX_AGE': 0 if pool else int(os.getenv("DB_CONN_MAX_AGE", 60)),
+        # With a pool, Django passes psycopg_pool's own check to it.
+        'CONN_HEALTH_CHECKS': True,
     }
+    if pool:
+        database['OPTIONS'] = {
+            'pool': {
+                'min_size': int(os.getenv("DB_POOL_MIN_SIZE", 2)),
+                'max_size': int(os.getenv("DB_POOL_MAX_SIZE", 10)),
+                'timeout': float(os.getenv("DB_POOL_TIMEOUT", 10)),
+                'max_idle': float(os.getenv("DB_POOL_MAX_IDLE", 600)),
+            },
+        }
+    return database
+
+
+DATABASES = {
+    'default': _database(os.getenv("DB_HOST"), os.getenv("DB_PORT")),
 }
+for _number, _replica in enumerate(filter(None, os.getenv("DB_REPLICA_HOSTS", "").split(",")), start=1):
+    _host, _, _port = _replica.strip().partition(":")
+    DATABASES[f"replica{_number}"] = {
+        **_database(_host, _port or os.getenv("DB_PORT")),
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['catalog.db_router.ReplicaRouter']
+CATALOG_READ_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+# After a write, the same client (cookie) or user reads from the primary for this long.
+CATALOG_REPLICA_PIN_SECONDS = int(os.getenv("CATALOG_REPLICA_PIN_SECONDS", 10))
 
 # DATABASES = {
 #     'default': {
@@ -155,6 +262,20 @@ DATABASES = {
 #     }
 # }
 
+# Cache
+# Shared by every worker process, so invalidating reference responses reaches all of them.
+# The database table is created by `python manage.py createcachetable`; a cached reference
+# response then costs one query. CACHE_BACKEND=django.core.cache.backends.redis.RedisCache with
+# CACHE_LOCATION=redis://... takes it off the database. A local memory cache
+# (django.core.cache.backends.locmem.LocMemCache) disables the reference cache.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv("CACHE_BACKEND", "django.core.cache.backends.db.DatabaseCache"),
+        'LOCATION': os.getenv("CACHE_LOCATION", "catalog_cache"),
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
 